@@ -0,0 +1,201 @@
+"""
+Caches for Customer Service
+
+LRUCache - A bounded in-process cache that evicts the least recently used
+entries and expires entries after a time to live
+QueryCache - A cache of encoded query results per write generation, in process
+and optionally shared through Redis
+"""
+
+import time
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+######################################################################
+# LRU Cache with a time to live
+######################################################################
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache
+
+    Every invalidation moves the cache to a new epoch. A value read from
+    the database can be put with the epoch taken before it was read, and
+    it is then dropped if its key was invalidated since, so a write that
+    lands between the read and the put never leaves stale data behind.
+    """
+
+    def __init__(self, size, ttl=None):
+        """
+        Constructor
+
+        Args:
+            size (int): the maximum number of entries
+            ttl (float): the seconds an entry stays valid (None to keep it until evicted)
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        # the epoch of the last invalidation of each recently invalidated key,
+        # and the latest epoch of the invalidations that were forgotten
+        self.__epoch = 0
+        self.__invalidated = OrderedDict()
+        self.__forgotten = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """ Returns the value cached for a key (None if it is missing or expired) """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.__entries[key] = entry  # move it to the most recently used end
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        """ Returns the value cached for a key without counting it or making it recently used """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+                return None
+            return entry[1]
+
+    def epoch(self):
+        """ Returns the current epoch, to be taken before reading a value to put """
+        with self.__lock:
+            return self.__epoch
+
+    def put(self, key, value, epoch=None):
+        """
+        Caches a value for a key, evicting the least recently used entry when full
+
+        Args:
+            key: the key of the value
+            value: the value to cache
+            epoch (int): the epoch() taken before the value was read, to drop
+                the value if the key has been invalidated since
+
+        Returns:
+            True if the value was cached
+        """
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.__lock:
+            if epoch is not None and (self.__forgotten > epoch or
+                                      self.__invalidated.get(key, 0) > epoch):
+                return False
+            self.__entries.pop(key, None)
+            self.__entries[key] = (expires, value)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        """ Removes a key from the cache """
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__epoch += 1
+            self.__invalidated.pop(key, None)
+            self.__invalidated[key] = self.__epoch
+            while len(self.__invalidated) > self.size:
+                self.__forgotten = self.__invalidated.popitem(last=False)[1]
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self.__lock:
+            self.__entries.clear()
+            self.__epoch += 1
+            self.__invalidated.clear()
+            self.__forgotten = self.__epoch
+
+    def stats(self):
+        """ Returns the size and the counters of the cache """
+        return {
+            'size': len(self.__entries),
+            'capacity': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+######################################################################
+# Query result cache
+######################################################################
+
+class QueryCache(object):
+    """
+    Caches the encoded results of queries for a write generation
+
+    The generation is part of the key, so a write (which bumps it) makes
+    every cached result unreachable at once: stale entries are never
+    read again and simply age out. Results are dictionaries of strings
+    so they can also be stored as Redis hashes and shared between the
+    instances of the service.
+    """
+
+    def __init__(self, size, ttl=None, redis=None, prefix='customer:query:'):
+        """
+        Constructor
+
+        Args:
+            size (int): the maximum number of results cached in process
+            ttl (float): the seconds a result stays valid (required with redis, as the
+                results of old generations are only removed when they expire)
+            redis (Redis): a connection to also cache the results in (None for none)
+            prefix (string): the prefix of the Redis keys of the results
+        """
+        if redis is not None and not ttl:
+            raise ValueError('A query cache shared in Redis needs a time to live')
+        self.local = LRUCache(size, ttl)
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+        self.redis_hits = 0
+
+    def __key(self, generation, query):
+        """ Returns the Redis key of a query result """
+        return '{}{}:{}'.format(self.prefix, generation, hashlib.md5(query).hexdigest())
+
+    def get(self, generation, query):
+        """ Returns the cached result of a query (None if it is not cached) """
+        result = self.local.get((generation, query))
+        if result is None and self.redis is not None:
+            result = self.redis.hgetall(self.__key(generation, query)) or None
+            if result is not None:
+                self.redis_hits += 1
+                self.local.put((generation, query), result)
+        return result
+
+    def put(self, generation, query, result):
+        """ Caches the result of a query """
+        self.local.put((generation, query), result)
+        if self.redis is not None:
+            key = self.__key(generation, query)
+            pipe = self.redis.pipeline()
+            pipe.hmset(key, result)
+            pipe.expire(key, int(math.ceil(self.ttl)))
+            pipe.execute()
+
+    def stats(self):
+        """ Returns the counters of the cache """
+        stats = self.local.stats()
+        stats['redis_hits'] = self.redis_hits
+        return stats
@@ -3,3 +3,22 @@
 ######################################################################
 class DataValidationError(ValueError):
     pass
+
+
+class DatabaseNotReadyError(Exception):
+    pass
+
+
+class DuplicateValueError(DataValidationError):
+    """ A unique value that another record already has """
+
+    def __init__(self, duplicates):
+        """
+        Constructor
+
+        Args:
+            duplicates (list): the (id, attribute, value, owner id) of each
+                unique value that the owner already has
+        """
+        super(DuplicateValueError, self).__init__('Duplicate unique values')
+        self.duplicates = duplicates
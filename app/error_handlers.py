@@ -6,7 +6,7 @@ Handles all of the HTTP Error Codes as JSON
 
 from flask import jsonify, make_response
 from app.server import app
-from app.custom_exceptions import DataValidationError
+from app.custom_exceptions import DataValidationError, DatabaseNotReadyError
 
 ######################################################################
 # Error Handlers
@@ -16,6 +16,11 @@ def request_validation_error(error):
     """ Handles Value Errors from bad data """
     return bad_request(error)
 
+@app.errorhandler(DatabaseNotReadyError)
+def database_not_ready(error):
+    """ Handles requests that need the indexes while they are being built """
+    return service_unavailable(error)
+
 @app.errorhandler(400)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -50,3 +55,10 @@ def internal_server_error(error):
     message = error.message or str(error)
     app.logger.info(message)
     return make_response(jsonify(status=500, error='Internal Server Error', message=message), 500)
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    """ Handles requests that can't be served yet with 503_SERVICE_UNAVAILABLE """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return make_response(jsonify(status=503, error='Service Unavailable', message=message), 503)
@@ -22,12 +22,17 @@ promo (boolean) - the subscription status of the customer
 """
 
 import os
+import re
+import time
 import logging
+import threading
 import json
-import pickle
-from redis import Redis
-from redis.exceptions import ConnectionError
-from app.custom_exceptions import DataValidationError
+from redis import Redis, BlockingConnectionPool
+from redis.exceptions import ConnectionError, TimeoutError
+from app.custom_exceptions import DataValidationError, DuplicateValueError
+from app.cache import LRUCache
+from app.sharding import Router
+from app.storage import MemoryEngine, RedisEngine
 
 # Validator allow to creat a schema
 from cerberus import Validator
@@ -44,14 +49,42 @@ class Customer(object):
     logger = logging.getLogger(__name__)
     redis = None
 
+    # indexed attributes: unique, by value, by prefix and by trigram
+    unique_indexes = ('username', 'email')
+    set_indexes = ('firstname', 'lastname', 'active', 'promo')
+    prefix_indexes = ('lastname', 'username')
+    text_indexes = ('firstname', 'lastname', 'address', 'email')
+    batch_size = 500
+    bulk_fields = ('active', 'promo')
+    bulk_pause = 0
+    # the storage engine and codec that init_db sets up
+    storage_engine = 'redis'
+    storage_engines = ('redis', 'memory')
+    codec = 'hash'
+    engine = None
+    pool_options = {
+        'max_connections': 50,
+        'timeout': 5,
+        'socket_timeout': 5,
+        'socket_connect_timeout': 2,
+        'socket_keepalive': True
+    }
+    pool_warm = 2
+    replica_endpoint = None
+    shard_urls = []
+    # routes the Customers to their shard and the reads to the replica
+    router = Router()
+    cache = None
+    listener = None
+
     schema = {
         'id': {'type': 'integer'},
         'username': {'type': 'string', 'required': True},
         'password': {'type': 'string', 'required': True},
         'firstname': {'type': 'string', 'required': True},
         'lastname': {'type': 'string', 'required': True},
-        'address': {'type': 'string'},
-        'phone': {'type': 'string'},
+        'address': {'type': 'string', 'nullable': True},
+        'phone': {'type': 'string', 'nullable': True},
         'email': {'type': 'string', 'required': True},
         'active': {'type': 'boolean', 'required': True},
         'promo': {'type': 'boolean', 'required': True}
@@ -86,17 +119,31 @@ class Customer(object):
             raise DataValidationError('lastname is not set')
         if self.email is None:
             raise DataValidationError('email is not set')
-        if self.id == 0:
-            self.id = Customer.__next_index()
-        Customer.redis.set(self.id, pickle.dumps(self.serialize()))
+        data = self.serialize()
+        if not self.id:
+            # checked before an id is reserved for the new Customer
+            Customer.engine.check_indexes(None, data)
+        customer_id = self.id or Customer.engine.next_id()
+        data['id'] = customer_id
+        try:
+            Customer.engine.put(customer_id, data)
+        except DuplicateValueError as error:
+            raise DataValidationError(Customer.__refused(error))
+        Customer.__invalidate([customer_id])
+        self.id = customer_id
 
     def delete(self):
         """ Deletes a Customer from the database """
-        Customer.redis.delete(self.id)
+        Customer.remove(self.id)
 
-    def serialize(self):
-        """ Serializes a Customer into a dictionary """
-        return {
+    def serialize(self, fields=None):
+        """
+        Serializes a Customer into a dictionary
+
+        Args:
+            fields (list): only serialize these fields (the id is always included)
+        """
+        data = {
             "id": self.id,
             "username": self.username,
             "password": self.password,
@@ -108,6 +155,9 @@ class Customer(object):
             "active": self.active,
             "promo": self.promo
         }
+        if fields:
+            data = {field: data[field] for field in ['id'] + list(fields)}
+        return data
 
     def deserialize(self, data):
         """ Deserializes a Customer by marshalling the data """
@@ -116,8 +166,8 @@ class Customer(object):
             self.password = data['password']
             self.firstname = data['firstname']
             self.lastname = data['lastname']
-            self.address = data['address']
-            self.phone = data['phone']
+            self.address = data.get('address')
+            self.phone = data.get('phone')
             self.email = data['email']
             self.active = data['active']
             self.promo = data['promo']
@@ -132,26 +182,325 @@ class Customer(object):
 ######################################################################
 
     @staticmethod
-    def __next_index():
-        """ Increments the index and returns it """
-        return Customer.redis.incr('index')
+    def __invalidate(customer_ids):
+        """ Drops Customers that were written or deleted from the cache """
+        if Customer.cache is not None:
+            for customer_id in customer_ids:
+                Customer.cache.invalidate(int(customer_id))
+
+    @staticmethod
+    def __refused(error):
+        """ Returns the message for the first unique value refused by a DuplicateValueError """
+        _, attribute, value, _ = error.duplicates[0]
+        return Customer.__duplicate(attribute, value)
+
+    @staticmethod
+    def __duplicate(attribute, value):
+        """ Returns the message for a unique value that another Customer already has """
+        return u'Customer with {} \'{}\' already exists'.format(attribute, value)
+
+    @staticmethod
+    def __index_value(value):
+        """ Normalizes a value so that index lookups are case insensitive """
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        value = value.lower()
+        if not isinstance(value, str):
+            value = value.encode('utf-8')
+        return value
+
+    @staticmethod
+    def __trigrams(text):
+        """ Returns the (UTF-8 encoded) trigrams of every word in a text """
+        trigrams = set()
+        for word in re.split(r'\W+', text.lower(), flags=re.UNICODE):
+            if not word:
+                continue
+            word = '  ' + word + ' '
+            for i in range(len(word) - 2):
+                trigram = word[i:i + 3]
+                if not isinstance(trigram, str):
+                    trigram = trigram.encode('utf-8')
+                trigrams.add(trigram)
+        return trigrams
+
+    @staticmethod
+    def __ngrams(data):
+        """ Returns the trigrams of all the text indexed attributes of a Customer """
+        ngrams = set()
+        if data:
+            for attribute in Customer.text_indexes:
+                if data[attribute]:
+                    ngrams.update(Customer.__trigrams(data[attribute]))
+        return ngrams
+
+    @staticmethod
+    def create_many(customers):
+        """
+        Saves a batch of new Customers with pipelined writes
+
+        The Customers that collide with an earlier one in the batch are
+        refused first, then the ids of the others are reserved with a single
+        call and the engine writes them a chunk at a time, refusing on its
+        own each Customer that collides with an existing one.
+
+        Args:
+            customers (list): the new Customers to save
+
+        Returns:
+            a list with None for each Customer that was saved (its id is set)
+            or the error message explaining why it was not
+        """
+        Customer.engine.check_indexes()
+        errors = [None] * len(customers)
+        claimed = {}
+        for i, customer in enumerate(customers):
+            data = customer.serialize()
+            for attribute in Customer.unique_indexes:
+                value = Customer.__index_value(data[attribute])
+                if (attribute, value) in claimed:
+                    errors[i] = Customer.__duplicate(attribute, data[attribute])
+                    break
+            else:
+                for attribute in Customer.unique_indexes:
+                    claimed[attribute, Customer.__index_value(data[attribute])] = i
+
+        pending = [i for i, error in enumerate(errors) if error is None]
+        if not pending:
+            return errors
+        last_id = Customer.engine.next_id(len(pending))
+        records = [(customer_id, dict(customers[i].serialize(), id=customer_id))
+                   for i, customer_id in zip(pending, range(last_id - len(pending) + 1,
+                                                            last_id + 1))]
+        for i, (customer_id, _), error in zip(pending, records,
+                                              Customer.engine.insert_many(records)):
+            if error is None:
+                customers[i].id = customer_id
+            else:
+                errors[i] = Customer.__refused(error)
+        return errors
+
+    @staticmethod
+    def update_where(changes, filters=None, customer_ids=None, batch_size=None, pause=None):
+        """
+        Applies the same change to every Customer that matches a filter or an id list
+
+        The matching ids come from the indexes. They are updated in batches,
+        which the engine rewrites together with their index entries in one
+        transaction per node that WATCHes the records, so a concurrent save()
+        is never overwritten. Pausing between batches keeps a large update
+        from monopolising Redis.
+
+        Args:
+            changes (dict): the attributes to set, e.g. {'promo': True}
+            filters (dict): only update the Customers that match these attributes
+            customer_ids (list): only update the Customers with these ids
+            batch_size (int): the number of Customers updated per transaction
+            pause (float): the seconds to wait between batches
+
+        Returns:
+            a tuple of the number of Customers matched and the number changed
+        """
+        if not changes:
+            raise DataValidationError('No changes to apply')
+        for attribute, value in changes.items():
+            if attribute not in Customer.bulk_fields:
+                raise DataValidationError('{} can not be changed in bulk'.format(attribute))
+            if not isinstance(value, bool):
+                raise DataValidationError('{} must be a boolean'.format(attribute))
+        if not filters and customer_ids is None:
+            raise DataValidationError('A filter or a list of ids is required')
+        for attribute, value in (filters or {}).items():
+            value_type = bool if Customer.schema.get(attribute, {}).get('type') == 'boolean' \
+                else basestring
+            if not isinstance(value, value_type):
+                raise DataValidationError('Invalid value for {}: {}'.format(attribute, value))
+        batch_size = batch_size or Customer.batch_size
+        pause = Customer.bulk_pause if pause is None else pause
+
+        if filters:
+            Customer.__check_filters(filters)
+            matching = Customer.engine.match(filters, primary=True)
+            if customer_ids is not None:
+                matching = sorted(set(matching) & set(int(i) for i in customer_ids))
+        else:
+            matching = sorted(set(int(customer_id) for customer_id in customer_ids))
+
+        matched = updated = 0
+        for start in range(0, len(matching), batch_size):
+            if start and pause:
+                time.sleep(pause)
+            batch = matching[start:start + batch_size]
+            batch_matched, batch_updated = Customer.engine.update_many(batch, changes)
+            matched += batch_matched
+            updated += batch_updated
+            Customer.__invalidate(batch)
+        Customer.logger.info('Bulk update of %s matched %d and changed %d Customers',
+                             changes, matched, updated)
+        return matched, updated
+
+    @staticmethod
+    def update_fields(customer_id, changes):
+        """
+        Changes some of the fields of a Customer and returns the updated Customer
+
+        Only the given fields are validated and written, and only the
+        indexes of the fields whose values change are touched.
+
+        Args:
+            customer_id (int): the id of the Customer
+            changes (dict): the fields to change and their new values
+
+        Returns:
+            the updated Customer or None if it was not found
+        """
+        if not isinstance(changes, dict) or not changes:
+            raise DataValidationError('No fields to update')
+        if 'id' in changes:
+            raise DataValidationError('The id of a Customer can not be changed')
+        if not Customer.__validator.validate(changes, update=True):
+            raise DataValidationError('Invalid customer data: ' + str(Customer.__validator.errors))
+        try:
+            new_data = Customer.engine.update(customer_id, changes)[1]
+        except DuplicateValueError as error:
+            raise DataValidationError(Customer.__refused(error))
+        Customer.__invalidate([customer_id])
+        return Customer.__from_data(new_data) if new_data is not None else None
+
+    @staticmethod
+    def set_flag(customer_id, attribute, value):
+        """
+        Sets active or promo on a Customer and returns the updated Customer
+
+        A Customer that already has the value is left alone, version
+        included. The Redis engine sets the flag of a hash record with a Lua
+        script in one atomic round trip.
+
+        Args:
+            customer_id (int): the id of the Customer
+            attribute (string): 'active' or 'promo'
+            value (bool): the new value
+
+        Returns:
+            the updated Customer or None if it was not found
+        """
+        if Customer.schema.get(attribute, {}).get('type') != 'boolean':
+            raise DataValidationError('{} is not a flag'.format(attribute))
+        new_data = Customer.engine.update(customer_id, {attribute: bool(value)}, force=False)[1]
+        Customer.__invalidate([customer_id])
+        return Customer.__from_data(new_data) if new_data is not None else None
+
+    @staticmethod
+    def remove(customer_id):
+        """
+        Deletes a Customer and its index entries
+
+        Args:
+            customer_id (int): the id of the Customer
+
+        Returns:
+            True if the Customer was deleted, False if it was not found
+        """
+        removed = Customer.engine.delete(customer_id)
+        Customer.__invalidate([customer_id])
+        return removed
 
     @staticmethod
     def remove_all():
         """ Removes all Customers from the database """
-        Customer.redis.flushall()
+        # the generation is kept (and bumped) so that no version is ever reused
+        Customer.engine.clear()
+        if Customer.cache is not None:
+            Customer.cache.clear()
 
     @staticmethod
-    def all():
-        """ Query that returns all Customers """
-        # results = [Customer.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
-        results = []
-        for key in Customer.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Customer.redis.get(key))
-                customer = Customer(data['id']).deserialize(data)
-                results.append(customer)
-        return results
+    def migrate_keys(batch_size=None):
+        """
+        Moves Customers stored under bare integer keys to 'customer:{id}'
+
+        The migration runs online and resumes where it stopped if it is
+        interrupted. The legacy 'index' counter is renamed to 'customer:seq'
+        once every record has been moved.
+
+        Args:
+            batch_size (int): the number of keys to ask SCAN for per call
+        """
+        count = Customer.engine.migrate_keys(batch_size)
+        Customer.logger.info('Migrated %d Customers', count)
+        return count
+
+    @staticmethod
+    def reindex():
+        """
+        Rebuilds all of the indexes from the stored Customers
+
+        It can run while the service is up: the usernames and emails stay
+        unique and the queries keep their results. The indexes are then
+        marked as built, which lets every process take new usernames and
+        emails.
+
+        Returns:
+            the number of Customers indexed
+
+        Raises:
+            DataValidationError listing the usernames and emails that several
+            Customers have (the index keeps the first one that claimed it)
+        """
+        Customer.logger.info('Rebuilding the Customer indexes')
+        try:
+            count = Customer.engine.reindex()
+        except DuplicateValueError as error:
+            for customer_id, attribute, value, owner in error.duplicates:
+                Customer.logger.error('Customer %s has the %s %s of Customer %s',
+                                      customer_id, attribute, value, owner)
+            raise DataValidationError('Customers share a username or email: {}'.format(
+                ', '.join('Customer {} has the {} \'{}\' of Customer {}'.format(*duplicate)
+                          for duplicate in error.duplicates)))
+        Customer.logger.info('Reindexed %d Customers', count)
+        return count
+
+    @staticmethod
+    def rebalance(batch_size=None):
+        """
+        Moves the Customers that are not on the shard the ring maps them to
+
+        Run it after adding a shard, or to spread a database that was on the
+        primary alone. About 1/N of the Customers move, and each one can be
+        read throughout.
+
+        Args:
+            batch_size (int): the number of keys to ask SCAN for per call
+
+        Returns:
+            the number of Customers moved
+        """
+        count = Customer.engine.rebalance(batch_size)
+        if count and Customer.cache is not None:
+            Customer.cache.clear()
+        Customer.logger.info('Moved %d Customers to their shards', count)
+        return count
+
+    @staticmethod
+    def all(fields=None):
+        """ Query that returns all Customers (walking the shards in parallel) """
+        fields = Customer.__projection(fields)
+        return [Customer.__from_data(data, fields) for data in Customer.engine.load_all(fields)]
+
+    @staticmethod
+    def iter_all(batch_size=None, fields=None):
+        """
+        Generator that yields all Customers
+
+        The engine loads the Customers one batch at a time, so memory does
+        not grow with the database.
+
+        Args:
+            batch_size (int): the number of keys to ask SCAN for per call
+            fields (list): only load these fields of the Customers
+        """
+        fields = Customer.__projection(fields)
+        return (Customer.__from_data(data, fields)
+                for data in Customer.engine.scan(batch_size, fields))
 
 
 ######################################################################
@@ -159,95 +508,300 @@ class Customer(object):
 ######################################################################
 
     @staticmethod
-    def find(customer_id):
-        """ Finds a Customer by their ID """
-        if Customer.redis.exists(customer_id):
-            data = pickle.loads(Customer.redis.get(customer_id))
-            customer = Customer(data['id']).deserialize(data)
-            return customer
+    def find(customer_id, fields=None):
+        """
+        Finds a Customer by their ID
+
+        Args:
+            customer_id (int): the id of the Customer
+            fields (list): only load these fields of the Customer
+        """
+        fields = Customer.__projection(fields)
+        if Customer.cache is not None:
+            cached = Customer.cache.get(int(customer_id))
+            if cached:
+                # the cached data was validated when it was loaded
+                return Customer.__from_data(cached[1], fields or list(Customer.schema))
+        # the cache is only filled from the primary, so it is never staler
+        # than the last change event, and a write (or change event) that
+        # lands after the read invalidates the id, which keeps the data read
+        # before it out of the cache. The version is cached with the data and
+        # read before it, so it is never newer than the data
+        caching = Customer.cache is not None and not fields
+        if caching:
+            epoch = Customer.cache.epoch()
+            version = Customer.engine.version(customer_id, primary=True)
+        data = Customer.engine.get([customer_id], fields, primary=Customer.cache is not None)[0]
+        if data and caching:
+            Customer.cache.put(int(customer_id), (version, data), epoch)
+        if data:
+            return Customer.__from_data(data, fields)
         return None
 
     @staticmethod
-    def __find_by(attribute, value):
+    def __projection(fields):
+        """ Validates the requested fields and adds the id to them """
+        if not fields:
+            return None
+        unknown = [field for field in fields if field not in Customer.schema]
+        if unknown:
+            raise DataValidationError('Unknown fields: {}'.format(', '.join(unknown)))
+        return ['id'] + [field for field in fields if field != 'id']
+
+    @staticmethod
+    def __from_data(data, fields=None):
+        """
+        Creates a Customer from stored data
+
+        Complete records are validated with deserialize(); a projection of
+        some fields can't be, so only those fields are set.
+        """
+        if fields is None:
+            return Customer(data['id']).deserialize(data)
+        customer = Customer(data['id'], active=None, promo=None)
+        for field in fields:
+            setattr(customer, field, data.get(field))
+        return customer
+
+    @staticmethod
+    def __find_many(customer_ids, fields=None):
+        """ Fetches the Customers with the given ids in their order, a batch at a time """
+        results = []
+        for start in range(0, len(customer_ids), Customer.batch_size):
+            batch = customer_ids[start:start + Customer.batch_size]
+            results += [Customer.__from_data(data, fields)
+                        for data in Customer.engine.get(batch, fields) if data]
+        return results
+
+    @staticmethod
+    def __check_filters(filters):
+        """ Raises a DataValidationError for the filters on attributes that are not indexed """
+        unknown = [attribute for attribute in filters
+                   if attribute not in Customer.unique_indexes + Customer.set_indexes]
+        if unknown:
+            raise DataValidationError('Customers can not be filtered by: {}'
+                                      .format(', '.join(sorted(unknown))))
+
+    @staticmethod
+    def __find_by(attribute, value, fields=None):
         """ Generic Query that finds a key with a specific value """
         Customer.logger.info('Processing %s query for %s', attribute, value)
-        if isinstance(value, str):
-            search_criteria = value.lower() # make case insensitive
+        fields = Customer.__projection(fields)
+        return Customer.__find_many(Customer.engine.match({attribute: value}), fields)
+
+    @staticmethod
+    def query(filters=None, fields=None, limit=None, cursor=None):
+        """
+        Returns a page of the Customers that match all of the filters in id order
+
+        Pages are cut from the ordered ids (or the ids that match the
+        filters) from the cursor on, so only the Customers on the page are
+        ever loaded.
+
+        Args:
+            filters (dict): the attributes and values to match, e.g. {'lastname': 'smith'}
+            fields (list): only load these fields of the Customers
+            limit (int): the maximum number of Customers to return
+            cursor (int): return the Customers after this id
+
+        Returns:
+            a tuple of the Customers and the cursor of the next page (None on the last page)
+        """
+        fields = Customer.__projection(fields)
+        num = limit + 1 if limit else None
+        if filters:
+            Customer.__check_filters(filters)
+            customer_ids = Customer.engine.match(filters, cursor, num)
         else:
-            search_criteria = value
+            customer_ids = Customer.engine.ids(cursor, num)
+        next_cursor = None
+        if limit and len(customer_ids) > limit:
+            customer_ids = customer_ids[:limit]
+            next_cursor = customer_ids[-1]
+        return Customer.__find_many(customer_ids, fields), next_cursor
 
-        results = []
-        for key in Customer.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Customer.redis.get(key))
-                # perform case insensitive search on strings
-                if isinstance(data[attribute], str):
-                    test_value = data[attribute].lower()
-                else:
-                    test_value = data[attribute]
-
-                if test_value == search_criteria:
-                    results.append(Customer(data['id']).deserialize(data))
-        return results
+    @staticmethod
+    def search_prefix(prefix, attributes=None, limit=10, fields=None):
+        """
+        Returns the first Customers with an attribute that starts with a prefix
+
+        The prefix indexes are kept in order, so the cost depends on the
+        number of results and not the number of Customers.
+
+        Args:
+            prefix (string): the start of the values to match (case insensitive)
+            attributes (list): the attributes to search, by default lastname and username
+            limit (int): the maximum number of Customers to return
+            fields (list): only load these fields of the Customers
+
+        Returns:
+            the Customers in the order of the attributes and then of the values
+        """
+        attributes = attributes or Customer.prefix_indexes
+        unknown = [attribute for attribute in attributes
+                   if attribute not in Customer.prefix_indexes]
+        if unknown:
+            raise DataValidationError('Customers can not be searched by: {}'
+                                      .format(', '.join(unknown)))
+        fields = Customer.__projection(fields)
+        customer_ids = []
+        for attribute in attributes:
+            for _, customer_id in Customer.engine.prefix(attribute, prefix, limit):
+                if customer_id not in customer_ids:
+                    customer_ids.append(customer_id)
+        return Customer.__find_many(customer_ids[:limit], fields)
+
+    @staticmethod
+    def search(text, limit=10, fields=None, min_score=0.3):
+        """
+        Returns the Customers that best match a text, ranked by similarity
+
+        The text is split into trigrams and each Customer is scored by the
+        share of them that the trigram index finds in its firstname,
+        lastname, address or email, so partial words and typos still match.
+
+        Args:
+            text (string): the text to search for
+            limit (int): the maximum number of Customers to return
+            fields (list): only load these fields of the Customers
+            min_score (float): the share of trigrams a Customer must match
+
+        Returns:
+            the best matching Customers, best first
+        """
+        trigrams = sorted(Customer.__trigrams(text))
+        if not trigrams:
+            return []
+        scores = Customer.engine.trigram(trigrams)
+        threshold = min_score * len(trigrams)
+        ranked = sorted((-score, customer_id) for customer_id, score in scores.items()
+                        if score >= threshold)
+        return Customer.__find_many([customer_id for _, customer_id in ranked[:limit]],
+                                    Customer.__projection(fields))
+
+    @staticmethod
+    def count(filters=None):
+        """
+        Returns the number of Customers that match all of the filters
+
+        The count comes from the indexes without loading any Customer.
+
+        Args:
+            filters (dict): the attributes and values to match, e.g. {'promo': True}
+        """
+        Customer.__check_filters(filters or {})
+        return Customer.engine.count(filters)
 
     @staticmethod
-    def find_by_username(username):
+    def version(customer_id):
+        """
+        Returns the version of a Customer without loading it
+
+        The version is the generation of the last write to the Customer, so
+        it changes whenever the Customer does and is never reused. A cached
+        Customer answers from the cache without reading the database.
+
+        Args:
+            customer_id (int): the id of the Customer
+
+        Returns:
+            the version or None if the Customer has none (or does not exist)
+        """
+        if Customer.cache is not None:
+            cached = Customer.cache.peek(int(customer_id))
+            if cached:
+                return cached[0]
+        return Customer.engine.version(customer_id)
+
+    @staticmethod
+    def generation():
+        """ Returns the number of writes made to the Customers, which changes with any of them """
+        return Customer.engine.generation()
+
+    @staticmethod
+    def find_by_username(username, fields=None):
         """ Returns a Customer with the given username
 
         Args:
             username (string): the username of the Customer you want to match
+            fields (list): only load these fields of the Customers
         """
-        return Customer.__find_by('username', username)
+        return Customer.__find_by('username', username, fields)
 
     @staticmethod
-    def find_by_email(email):
+    def find_by_email(email, fields=None):
         """
         Returns a Customer with the given email
 
         Args:
             email (string): the email of the Customer you want to match
+            fields (list): only load these fields of the Customers
         """
-        return Customer.__find_by('email', email)
+        return Customer.__find_by('email', email, fields)
 
     @staticmethod
-    def find_by_firstname(firstname):
+    def find_by_firstname(firstname, fields=None):
         """
         Returns a Customer with the given firstname
 
         Args:
             firstname (string): the firstname of the Customer you want to match
+            fields (list): only load these fields of the Customers
         """
-        return Customer.__find_by('firstname', firstname)
+        return Customer.__find_by('firstname', firstname, fields)
 
     @staticmethod
-    def find_by_lastname(lastname):
+    def find_by_lastname(lastname, fields=None):
         """
         Returns a Customer with the given lastname
 
         Args:
             lastname (string): the lastname of the Customer you want to match
+            fields (list): only load these fields of the Customers
         """
-        return Customer.__find_by('lastname', lastname)
+        return Customer.__find_by('lastname', lastname, fields)
 
     @staticmethod
-    def find_by_active(active):
+    def find_by_active(active, fields=None):
         """
         Returns all of Customers by their status
 
         Args:
             status (int): the status of the Customers you want to match
+            fields (list): only load these fields of the Customers
         """
-        return Customer.__find_by('active', active)
+        return Customer.__find_by('active', active, fields)
 
     @staticmethod
-    def find_by_promo(promo):
+    def find_by_promo(promo, fields=None):
         """
         Returns all of Customers by their promo
 
         Args:
             promo (int): the status of the Customers you want to match
+            fields (list): only load these fields of the Customers
+        """
+        return Customer.__find_by('promo', promo, fields)
+
+    @staticmethod
+    def count_by_active(active):
+        """
+        Returns the number of Customers with the given status
+
+        Args:
+            active (boolean): the status of the Customers you want to count
+        """
+        return Customer.count({'active': active})
+
+    @staticmethod
+    def count_by_promo(promo):
+        """
+        Returns the number of Customers with the given promo
+
+        Args:
+            promo (boolean): the promo of the Customers you want to count
         """
-        return Customer.__find_by('promo', promo)
+        return Customer.count({'promo': promo})
 
 
 ######################################################################
@@ -256,17 +810,167 @@ class Customer(object):
 
     @staticmethod
     def connect_to_redis(hostname, port, password):
-        """ Connects to Redis and tests the connection """
+        """ Connects to Redis through a connection pool and tests the connection """
         Customer.logger.info("Testing Connection to: %s:%s", hostname, port)
-        Customer.redis = Redis(host=hostname, port=port, password=password)
+        pool = BlockingConnectionPool(host=hostname, port=int(port), password=password,
+                                      **Customer.pool_options)
+        Customer.redis = Redis(connection_pool=pool)
         try:
             Customer.redis.ping()
+            Customer.__warm_pool()
             Customer.logger.info("Connection established")
-        except ConnectionError:
+        except (ConnectionError, TimeoutError):
             Customer.logger.info("Connection Error from: %s:%s", hostname, port)
             Customer.redis = None
         return Customer.redis
 
+    @staticmethod
+    def connect_to_replica(hostname, port, password):
+        """ Connects to a read replica (reads stay on the primary if it is down) """
+        Customer.logger.info("Testing Connection to replica: %s:%s", hostname, port)
+        pool = BlockingConnectionPool(host=hostname, port=int(port), password=password,
+                                      **Customer.pool_options)
+        Customer.router.replica = Redis(connection_pool=pool)
+        try:
+            Customer.router.replica.ping()
+            Customer.logger.info("Replica connection established")
+        except (ConnectionError, TimeoutError):
+            Customer.logger.warning("Replica Connection Error from: %s:%s, "
+                                    "reading from the primary", hostname, port)
+            Customer.router.replica = None
+        return Customer.router.replica
+
+    @staticmethod
+    def connect_to_shard(url):
+        """ Connects to a shard from a redis:// URL (it is required to read its Customers) """
+        pool = BlockingConnectionPool.from_url(url, **Customer.pool_options)
+        shard = Redis(connection_pool=pool)
+        name = Router.node_name(shard)
+        Customer.logger.info("Testing Connection to shard: %s", name)
+        try:
+            shard.ping()
+            Customer.logger.info("Shard connection established")
+        except (ConnectionError, TimeoutError):
+            Customer.logger.fatal('*** FATAL ERROR: Could not connect to the shard %s', name)
+            raise ConnectionError('Could not connect to the Redis shard {}'.format(name))
+        return shard
+
+    @staticmethod
+    def use_shards(nodes):
+        """
+        Spreads the Customers over Redis nodes by consistent hashing of their ids
+
+        The nodes are placed on the ring by host, port and database, so the
+        same Customers map to them whatever order they are listed in, and
+        the primary can be one of them. Customers that are not on their
+        shard yet (e.g. after adding a node) are moved by rebalance().
+
+        Args:
+            nodes (list): the connections to the shards (empty to store all on the primary)
+        """
+        Customer.engine.use_shards(nodes)
+
+    @staticmethod
+    def read_from_primary(primary=True):
+        """
+        Sends the reads of the current thread to the primary instead of the replica
+
+        A client that has just written is routed to the primary for its
+        next reads, so that it sees its own writes before they reach the
+        replica. The routing lasts until it is set again (e.g. by the next
+        request handled by the thread).
+        """
+        Customer.router.read_from_primary(primary)
+
+    @staticmethod
+    def __warm_pool():
+        """ Opens pool_warm connections so the first requests don't have to """
+        pool = Customer.redis.connection_pool
+        connections = []
+        try:
+            for _ in range(min(Customer.pool_warm, pool.max_connections)):
+                connection = pool.get_connection('PING')
+                connections.append(connection)
+                connection.connect()
+        finally:
+            for connection in connections:
+                pool.release(connection)
+
+    @staticmethod
+    def pool_stats():
+        """ Returns how many connections the Redis connection pool has and uses """
+        if Customer.redis is None:
+            return None
+        pool = Customer.redis.connection_pool
+        if isinstance(pool, BlockingConnectionPool):
+            created = len(pool._connections)
+            idle = len([connection for connection in list(pool.pool.queue) if connection])
+        else:
+            created = pool._created_connections
+            idle = len(pool._available_connections)
+        return {
+            'max_connections': pool.max_connections,
+            'created': created,
+            'in_use': created - idle,
+            'idle': idle
+        }
+
+    @staticmethod
+    def configure(batch_size=None, codec=None, bulk_pause=None, cache_size=None, cache_ttl=None,
+                  pool_size=None, pool_timeout=None, socket_timeout=None, connect_timeout=None,
+                  keepalive=None, pool_warm=None, replica_host=None, replica_port=6379,
+                  replica_password=None, shard_urls=None, engine=None):
+        """
+        Applies the settings for the Customer database
+
+        The connection settings apply to the next connect_to_redis() and the
+        storage settings to the next init_db().
+
+        Args:
+            batch_size (int): the number of keys walked or fetched per Redis call
+            codec (string): how new records are stored, 'hash' or 'pickle'
+            bulk_pause (float): the seconds to pause between the batches of a bulk update
+            cache_size (int): the number of Customers cached by find() (0 for no cache)
+            cache_ttl (float): the seconds a Customer stays in the cache
+            pool_size (int): the maximum number of connections to Redis
+            pool_timeout (float): the seconds to wait for a free connection
+            socket_timeout (float): the seconds to wait for a reply from Redis
+            connect_timeout (float): the seconds to wait for a connection to Redis
+            keepalive (bool): whether to use TCP keepalive on the connections
+            pool_warm (int): the number of connections opened when connecting
+            replica_host (string): the host of a read replica (None to read from the primary)
+            replica_port (int): the port of the read replica
+            replica_password (string): the password of the read replica
+            shard_urls (list): the redis:// URLs of the nodes to spread the Customers
+                over (none to store them all on the primary)
+            engine (string): where the Customers are stored, 'redis' or 'memory'
+        """
+        if shard_urls is not None:
+            Customer.shard_urls = list(shard_urls)
+        if replica_host:
+            Customer.replica_endpoint = (replica_host, replica_port, replica_password)
+        settings = {'max_connections': pool_size, 'timeout': pool_timeout,
+                    'socket_timeout': socket_timeout, 'socket_connect_timeout': connect_timeout,
+                    'socket_keepalive': keepalive}
+        Customer.pool_options = dict(Customer.pool_options, **dict(
+            (name, value) for name, value in settings.items() if value is not None))
+        if pool_warm is not None:
+            Customer.pool_warm = int(pool_warm)
+        if cache_size is not None:
+            Customer.cache = LRUCache(int(cache_size), cache_ttl) if cache_size > 0 else None
+        if batch_size:
+            Customer.batch_size = int(batch_size)
+        if bulk_pause is not None:
+            Customer.bulk_pause = float(bulk_pause)
+        if codec:
+            if codec not in RedisEngine.codecs:
+                raise ValueError('Unknown storage codec: {}'.format(codec))
+            Customer.codec = codec
+        if engine:
+            if engine not in Customer.storage_engines:
+                raise ValueError('Unknown storage engine: {}'.format(engine))
+            Customer.storage_engine = engine
+
     @staticmethod
     def init_db(redis=None):
         """
@@ -278,10 +982,22 @@ class Customer(object):
           3) With Redis --link in a Docker container called 'redis'
           4) Passing in your own Redis connection object
 
+        With the 'memory' engine the Customers are kept in the process
+        instead, and they survive until it exits.
+
         Exception:
         ----------
           redis.ConnectionError - if ping() test fails
         """
+        if Customer.storage_engine == 'memory':
+            Customer.logger.info("Using the in process storage engine")
+            if not isinstance(Customer.engine, MemoryEngine):
+                Customer.engine = MemoryEngine(Customer.unique_indexes, Customer.set_indexes,
+                                               Customer.prefix_indexes, Customer.__index_value,
+                                               Customer.__ngrams)
+            Customer.redis = Customer.router.primary = Customer.router.replica = None
+            Customer.router.use_shards([])
+            return
         if redis:
             Customer.logger.info("Using client connection...")
             Customer.redis = redis
@@ -292,6 +1008,7 @@ class Customer(object):
                 Customer.logger.error("Client Connection Error!")
                 Customer.redis = None
                 raise ConnectionError('Could not connect to the Redis Service')
+            Customer.__use_redis()
             return
         # Get the credentials from the Bluemix environment
         if 'VCAP_SERVICES' in os.environ:
@@ -312,3 +1029,59 @@ class Customer(object):
             # if you end up here, redis instance is down.
             Customer.logger.fatal('*** FATAL ERROR: Could not connect to the Redis Service')
             raise ConnectionError('Could not connect to the Redis Service')
+        Customer.__use_redis()
+
+    @staticmethod
+    def __use_redis():
+        """ Stores the Customers in Redis through the primary, the replica and the shards """
+        Customer.router.primary = Customer.redis
+        Customer.engine = RedisEngine(Customer.router, Customer.schema, Customer.unique_indexes,
+                                      Customer.set_indexes, Customer.prefix_indexes,
+                                      Customer.__index_value, Customer.__ngrams,
+                                      codec=Customer.codec, batch_size=Customer.batch_size)
+        Customer.__init_replica()
+        Customer.use_shards([Customer.connect_to_shard(url) for url in Customer.shard_urls])
+
+    @staticmethod
+    def listen_for_changes():
+        """
+        Starts a thread that drops the Customers written by other processes from the cache
+
+        Every write publishes the id and new version of the Customer, so
+        each process evicts the Customers that changed within milliseconds,
+        and the whole cache is cleared whenever events may have been
+        missed. The memory engine has no other processes to listen to, so
+        the thread ends at once.
+        """
+        if Customer.listener is not None and Customer.listener.is_alive():
+            return
+        Customer.listener = threading.Thread(target=Customer.engine.listen,
+                                             args=(Customer.__handle_event,),
+                                             name='customer-events')
+        Customer.listener.daemon = True
+        Customer.listener.start()
+
+    @staticmethod
+    def __handle_event(event):
+        """ Evicts the Customer named by an event ('{id}:{version}', '{id}:' or '*') """
+        if Customer.cache is None:
+            return
+        if event == '*':
+            Customer.cache.clear()
+            return
+        customer_id = event.split(':', 1)[0]
+        if customer_id.isdigit():
+            Customer.cache.invalidate(int(customer_id))
+
+    @staticmethod
+    def __init_replica():
+        """ Connects to the read replica from VCAP_SERVICES or the configured endpoint """
+        Customer.router.replica = None
+        endpoint = Customer.replica_endpoint
+        if 'VCAP_SERVICES' in os.environ:
+            creds = json.loads(os.environ['VCAP_SERVICES'])['rediscloud'][0]['credentials']
+            if creds.get('replica_hostname'):
+                endpoint = (creds['replica_hostname'], creds.get('replica_port', creds['port']),
+                            creds.get('replica_password', creds['password']))
+        if endpoint:
+            Customer.connect_to_replica(*endpoint)
@@ -6,25 +6,39 @@ It demonstraits how a RESTful service should be implemented.
 Paths:
 -----
 GET  / - Display a UI for Selenium testing
+GET  /metrics - Retrieves the counters of the caches and the Redis connection pool
 GET  /customers - Retrieves a list of all Customers from the database
 GET  /customers/{id} - Retrieves a Customer with a given id number
+GET  /customers?fields={field,...} - Retrieves only the given fields of the Customers
+GET  /customers?limit={n}&cursor={cursor} - Retrieves a page of Customers in id order
+GET  /customers/count - Retrieves the number of Customers (accepts the same filters as /customers)
+GET  /customers/search?prefix={prefix} - Retrieves the Customers whose lastname or username starts with prefix
+GET  /customers/search?q={text} - Retrieves the Customers that best match a text, ranked
 GET  /customers?username={username} - Retrieves a Customer with a given username
 GET  /customers?email={email} - Retrieves a Customer with a given email
 GET  /customers?promo={true/false} - Retrieves a list of Customers with given promotion status
 GET  /customers?active={true/false} - Retrieves a list of Customers with given status
+GET  /customers?lastname={lastname}&active={true/false} - Retrieves the Customers matching all filters
 POST /customers - Creates a new Customer record in the datbase
+POST /customers/bulk - Creates a Customer for each item of a JSON array or NDJSON body
+PUT  /customers/bulk - Sets active or promo on every Customer matching a filter or id list
 PUT  /customers/{id} - Updates a Customer record in the database
+PATCH /customers/{id} - Updates some of the fields of a Customer record
 PUT  /customers/{id}/subscribe - Subscribe a Customer with id
 PUT  /customers/{id}/deactivate - Deactivate a Customer with id
 DELETE  /customers/{id} - Removes a Customer from the database
 """
 
 import sys
+import time
 import logging
+import hashlib
 from flask import jsonify, request, json, url_for, make_response, abort
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
 from app.models import Customer
+from app.cache import QueryCache
+from app.custom_exceptions import DataValidationError
 from . import app
 
 # Error handlers require app to be initialized so we must import
@@ -51,6 +65,43 @@ app.config['SWAGGER'] = {
 # Initialize Swagger after configuring it
 Swagger(app)
 
+# Number of Customers on a page when a cursor is given without a limit
+PAGE_SIZE = app.config['PAGE_SIZE']
+# Number of Customers returned by a search (by default and at most)
+SEARCH_LIMIT = app.config['SEARCH_LIMIT']
+MAX_SEARCH_LIMIT = app.config['MAX_SEARCH_LIMIT']
+# Encoded results of GET /customers per write generation (set up by init_db)
+query_cache = None
+# Seconds after a write during which the client reads from the primary, and
+# the header (or cookie) with the time of the client's last write
+READ_YOUR_WRITES_WINDOW = app.config['READ_YOUR_WRITES_WINDOW']
+LAST_WRITE_HEADER = 'X-Last-Write'
+LAST_WRITE_COOKIE = 'last_write'
+
+
+######################################################################
+# ROUTE READS TO THE PRIMARY AFTER A CLIENT'S OWN WRITES
+######################################################################
+@app.before_request
+def route_reads():
+    """ Reads from the primary if the client wrote within the window """
+    last_write = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        recent = 0 <= time.time() - float(last_write) < READ_YOUR_WRITES_WINDOW
+    except (TypeError, ValueError):
+        recent = False
+    Customer.read_from_primary(recent)
+
+
+@app.after_request
+def mark_writes(response):
+    """ Gives the time of a successful write back to the client """
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        last_write = '{:.3f}'.format(time.time())
+        response.headers[LAST_WRITE_HEADER] = last_write
+        response.set_cookie(LAST_WRITE_COOKIE, last_write, max_age=READ_YOUR_WRITES_WINDOW)
+    return response
+
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
@@ -60,6 +111,19 @@ def healthcheck():
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route('/metrics')
+def metrics():
+    """ Return the counters of the caches and of the Redis connection pool """
+    cache = Customer.cache.stats() if Customer.cache is not None else None
+    queries = query_cache.stats() if query_cache is not None else None
+    return make_response(jsonify(customer_cache=cache, query_cache=queries,
+                                 redis_pool=Customer.pool_stats()),
+                         status.HTTP_200_OK)
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -82,6 +146,10 @@ def list_customers():
     """
     Retrieve a list of Customers
     This endpoint will return all Customers unless a query parameter is specificed
+    Query parameters can be combined to return the Customers that match all of them
+    A page filtered by one parameter costs the same however many Customers match.
+    Combined filters also skip the Customers of the rarest one that the others don't
+    match, so a page of a rare combination takes longer.
     ---
     tags:
       - Customers
@@ -117,6 +185,26 @@ def list_customers():
         description: the promotion status of Customer you are looking for
         required: false
         type: string
+      - name: fields
+        in: query
+        description: comma separated list of the fields to return (the id is always returned)
+        required: false
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of Customers to return in one page
+        required: false
+        type: integer
+      - name: cursor
+        in: query
+        description: the cursor of the page to return, taken from the rel="next" Link header
+        required: false
+        type: integer
+      - name: If-None-Match
+        in: header
+        description: the ETag of a copy of the list the client already has
+        required: false
+        type: string
     definitions:
       Customer:
         type: object
@@ -153,64 +241,185 @@ def list_customers():
             description: the promotion status of a customer
     responses:
       200:
-        description: An array of Customers
+        description: An array of Customers (a Link header points to the next page)
         schema:
           type: array
           items:
             schema:
               $ref: '#/definitions/Pet'
+      304:
+        description: No Customer changed since the list with the If-None-Match ETag
     """
 
-    customers = []
-    username = request.args.get('username')
-    email = request.args.get('email')
-    firstname = request.args.get('firstname')
-    lastname = request.args.get('lastname')
-    promos = request.args.get('promo')
-    actives = request.args.get('active')
-
-    if username:
-        customers = Customer.find_by_username(username)
-        if not customers:
-            raise NotFound("Customer with username '{}' was not found.".format(username))
-    elif email:
-        customers = Customer.find_by_email(email)
-        if not customers:
-            raise NotFound("Customer with email '{}' was not found.".format(email))
-    elif firstname:
-        customers = Customer.find_by_firstname(firstname)
-        if not customers:
-            raise NotFound("Customer with firstname '{}' was not found.".format(firstname))
-    elif lastname:
-        customers = Customer.find_by_lastname(lastname)
-        if not customers:
-            raise NotFound("Customer with lastname '{}' was not found.".format(lastname))
-    elif promos:
-        promos = promos.lower()
-        if promos == 'true':
-            promo = True
-        elif promos == 'false':
-            promo = False
-        else:
-            raise ValueError
-        customers = Customer.find_by_promo(promo)
-        if not customers:
-            raise NotFound("Customer with promotion status '{}' was not found.".format(promo))
-    elif actives:
-        actives = actives.lower()
-        if actives == 'true':
-            active = True
-        elif actives == 'false':
-            active = False
-        else:
-            raise ValueError
-        customers = Customer.find_by_active(active)
-        if not customers:
-            raise NotFound("Customer with active status '{}' was not found.".format(active))
+    fields = get_fields()
+    limit = get_int_arg('limit')
+    cursor = get_int_arg('cursor')
+
+    filters = get_filters()
+
+    if cursor is not None and not limit:
+        limit = PAGE_SIZE
+    # any write changes the generation, so the list is unchanged while it is the same
+    query = normalize_query(filters, fields, limit, cursor)
+    generation = Customer.generation()
+    etag = 'g{}-{}'.format(generation, hashlib.md5(query).hexdigest()[:16])
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    cached = query_cache.get(generation, query) if query_cache is not None else None
+    if cached is not None:
+        headers = {'Link': cached['link']} if 'link' in cached else {}
+        response = make_response(cached['body'], status.HTTP_200_OK, headers)
+        response.mimetype = 'application/json'
+        response.set_etag(etag)
+        return response
+    next_cursor = None
+    if filters or limit:
+        customers, next_cursor = Customer.query(filters, fields, limit, cursor)
     else:
-        customers = Customer.all()
+        customers = Customer.all(fields)
+    if filters and not customers and cursor is None:
+        criteria = u' and '.join(u"{} '{}'".format(attribute, value)
+                                 for attribute, value in sorted(filters.items()))
+        raise NotFound(u"Customer with {} was not found.".format(criteria))
+
+    results = [customer.serialize(fields) for customer in customers]
+    headers = {}
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args.update(limit=limit, cursor=next_cursor)
+        next_url = url_for('list_customers', _external=True, **args)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    response = make_response(jsonify(results), status.HTTP_200_OK, headers)
+    response.set_etag(etag)
+    if query_cache is not None:
+        cached = {'body': response.get_data()}
+        if 'Link' in headers:
+            cached['link'] = headers['Link']
+        query_cache.put(generation, query, cached)
+    return response
 
-    results = [customer.serialize() for customer in customers]
+
+######################################################################
+# COUNT CUSTOMERS
+######################################################################
+@app.route('/customers/count', methods=['GET'])
+def count_customers():
+    """
+    Count Customers
+    This endpoint will return the number of Customers that match the query parameters
+    ---
+    tags:
+      - Customers
+    produces:
+      - application/json
+    parameters:
+      - name: username
+        in: query
+        description: the username of Customers to count
+        required: false
+        type: string
+      - name: firstname
+        in: query
+        description: the firstname of Customers to count
+        required: false
+        type: string
+      - name: lastname
+        in: query
+        description: the lastname of Customers to count
+        required: false
+        type: string
+      - name: email
+        in: query
+        description: the email of Customers to count
+        required: false
+        type: string
+      - name: active
+        in: query
+        description: the active status of Customers to count
+        required: false
+        type: string
+      - name: promo
+        in: query
+        description: the promotion status of Customers to count
+        required: false
+        type: string
+    responses:
+      200:
+        description: The number of Customers
+        schema:
+          type: object
+          properties:
+            count:
+              type: integer
+              description: the number of Customers that match
+    """
+    count = Customer.count(get_filters())
+    return make_response(jsonify(count=count), status.HTTP_200_OK)
+
+
+######################################################################
+# SEARCH CUSTOMERS
+######################################################################
+@app.route('/customers/search', methods=['GET'])
+def search_customers():
+    """
+    Search for Customers
+    This endpoint will return the first Customers whose lastname or username starts with a prefix,
+    or the Customers whose firstname, lastname, address or email best match a text (q)
+    ---
+    tags:
+      - Customers
+    produces:
+      - application/json
+    parameters:
+      - name: prefix
+        in: query
+        description: the start of the lastname or username (case insensitive)
+        required: false
+        type: string
+      - name: q
+        in: query
+        description: text contained in the firstname, lastname, address or email (typos allowed)
+        required: false
+        type: string
+      - name: field
+        in: query
+        description: only search this field (lastname or username)
+        required: false
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of Customers to return
+        required: false
+        type: integer
+      - name: fields
+        in: query
+        description: comma separated list of the fields to return (the id is always returned)
+        required: false
+        type: string
+    responses:
+      200:
+        description: An array of Customers (best match first for q)
+        schema:
+          type: array
+          items:
+            schema:
+              $ref: '#/definitions/Customer'
+      400:
+        description: Bad Request (no prefix or q, or an unknown field)
+    """
+    prefix = request.args.get('prefix')
+    text = request.args.get('q')
+    field = request.args.get('field')
+    fields = get_fields()
+    limit = min(get_int_arg('limit') or SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+    if text:
+        customers = Customer.search(text, limit, fields)
+    elif prefix:
+        customers = Customer.search_prefix(prefix, [field] if field else None, limit, fields)
+    else:
+        raise DataValidationError("Query parameter 'prefix' or 'q' is required")
+    results = [customer.serialize(fields) for customer in customers]
     return make_response(jsonify(results), status.HTTP_200_OK)
 
 
@@ -233,19 +442,42 @@ def get_customers(id):
         description: ID of customer to retrieve
         type: integer
         required: true
+      - name: fields
+        in: query
+        description: comma separated list of the fields to return (the id is always returned)
+        required: false
+        type: string
+      - name: If-None-Match
+        in: header
+        description: the ETag of a copy of the Customer the client already has
+        required: false
+        type: string
     responses:
       200:
         description: Customer returned
         schema:
           $ref: '#/definitions/Customer'
+      304:
+        description: The Customer has not changed since the If-None-Match ETag
       404:
         description: Customer not found
     """
-    customer = Customer.find(id)
+    fields = get_fields()
+    # the version is read first so the ETag is never newer than the body
+    version = Customer.version(id)
+    etag = None
+    if version is not None:
+        etag = str(version) + ('-' + ','.join(fields) if fields else '')
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+    customer = Customer.find(id, fields)
     if not customer:
         raise NotFound("Customer with id '{}' was not found.".format(id))
 
-    return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
+    response = make_response(jsonify(customer.serialize(fields)), status.HTTP_200_OK)
+    if etag:
+        response.set_etag(etag)
+    return response
 
 
 ######################################################################
@@ -341,6 +573,94 @@ def create_customers():
                          {'Location': location_url})
 
 
+######################################################################
+# ADD CUSTOMERS IN BULK
+######################################################################
+@app.route('/customers/bulk', methods=['POST'])
+def create_customers_bulk():
+    """
+    Creates Customers in bulk
+    This endpoint will create a Customer for each item of a JSON array or of a
+    newline delimited JSON (application/x-ndjson) body. Each item is validated and
+    saved on its own, so a bad item does not stop the rest of the batch.
+    ---
+    tags:
+      - Customers
+    consumes:
+      - application/json
+      - application/x-ndjson
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              $ref: '#/definitions/Customer'
+    responses:
+      200:
+        description: The result of each item, in the order they were posted
+        schema:
+          type: object
+          properties:
+            created:
+              type: integer
+              description: the number of Customers created
+            failed:
+              type: integer
+              description: the number of items that were rejected
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  index:
+                    type: integer
+                    description: the position of the item in the body
+                  status:
+                    type: integer
+                    description: 201 if the Customer was created, 400 if not
+                  id:
+                    type: integer
+                    description: the id of the new Customer
+                  error:
+                    type: string
+                    description: why the item was rejected
+      400:
+        description: Bad Request (the body is not a JSON array)
+    """
+    items = get_bulk_items()
+    results = [None] * len(items)
+    customers = []
+    positions = []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, DataValidationError):
+                raise item
+            customers.append(Customer().deserialize(item))
+            positions.append(index)
+        except DataValidationError as error:
+            results[index] = {'index': index, 'status': status.HTTP_400_BAD_REQUEST,
+                              'error': str(error)}
+
+    errors = Customer.create_many(customers)
+    for index, customer, error in zip(positions, customers, errors):
+        if error:
+            results[index] = {'index': index, 'status': status.HTTP_400_BAD_REQUEST,
+                              'error': error}
+        else:
+            results[index] = {'index': index, 'status': status.HTTP_201_CREATED,
+                              'id': customer.id}
+
+    created = len([result for result in results if 'id' in result])
+    app.logger.info('Created %d of %d Customers in bulk', created, len(results))
+    return make_response(jsonify(created=created, failed=len(results) - created,
+                                 results=results), status.HTTP_200_OK)
+
+
 ######################################################################
 # UPDATE A CUSTOMER
 ######################################################################
@@ -423,6 +743,70 @@ def update_customers(id):
     return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
 
 
+######################################################################
+# UPDATE SOME FIELDS OF A CUSTOMER
+######################################################################
+@app.route('/customers/<int:id>', methods=['PATCH'])
+def patch_customers(id):
+    """
+    Update some fields of a Customer
+    This endpoint will change only the fields of a Customer that are in the body
+    ---
+    tags:
+      - Customers
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: id
+        in: path
+        description: ID of customer to update
+        type: integer
+        required: true
+      - in: body
+        name: body
+        schema:
+          type: object
+          description: any of the fields of a Customer except the id
+          properties:
+            username:
+              type: string
+            password:
+              type: string
+            firstname:
+              type: string
+            lastname:
+              type: string
+            address:
+              type: string
+            phone:
+              type: string
+            email:
+              type: string
+            active:
+              type: boolean
+            promo:
+              type: boolean
+    responses:
+      200:
+        description: Customer updated
+        schema:
+          $ref: '#/definitions/Customer'
+      400:
+        description: Bad Request (a field is unknown or not valid)
+      404:
+        description: Customer not found
+    """
+    check_content_type('application/json')
+    data = request.get_json()
+    app.logger.info(data)
+    customer = Customer.update_fields(id, data)
+    if not customer:
+        raise NotFound("Customer with id '{}' was not found.".format(id))
+    return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
+
+
 ######################################################################
 # SUBSCRIBE A CUSTOMER
 ######################################################################
@@ -450,12 +834,10 @@ def subscribe_customers(id):
       404:
         description: Pet not found
     """
-    customer = Customer.find(id)
+    customer = Customer.set_flag(id, 'promo', True)
     if not customer:
         abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(id))
 
-    customer.promo = True
-    customer.save()
     return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
 
 
@@ -486,15 +868,90 @@ def deactivate_customers(id):
       404:
         description: Pet not found
     """
-    customer = Customer.find(id)
+    customer = Customer.set_flag(id, 'active', False)
     if not customer:
         abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(id))
 
-    customer.active = False
-    customer.save()
     return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
 
 
+######################################################################
+# UPDATE CUSTOMERS IN BULK
+######################################################################
+@app.route('/customers/bulk', methods=['PUT'])
+def update_customers_bulk():
+    """
+    Updates Customers in bulk
+    This endpoint will set active and/or promo on every Customer that matches
+    the filters or is in the list of ids (or both), e.g. to subscribe all the
+    active Customers with a given lastname.
+    ---
+    tags:
+      - Customers
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          required:
+            - changes
+          properties:
+            changes:
+              type: object
+              description: the new values of active and/or promo, e.g. {"promo": true}
+            filters:
+              type: object
+              description: the attributes to match, e.g. {"active": true, "lastname": "smith"}
+            ids:
+              type: array
+              items:
+                type: integer
+              description: the ids of the Customers to update
+            batch_size:
+              type: integer
+              description: the number of Customers updated per Redis transaction
+    responses:
+      200:
+        description: The number of Customers matched and changed
+        schema:
+          type: object
+          properties:
+            matched:
+              type: integer
+              description: the number of Customers that match
+            updated:
+              type: integer
+              description: the number of Customers that were changed
+      400:
+        description: Bad Request (no changes, no filter or an unsupported field)
+    """
+    check_content_type('application/json')
+    data = request.get_json()
+    if not isinstance(data, dict):
+        raise DataValidationError('Request body must be a JSON object')
+    changes = data.get('changes')
+    filters = data.get('filters')
+    customer_ids = data.get('ids')
+    batch_size = data.get('batch_size')
+    if changes is not None and not isinstance(changes, dict):
+        raise DataValidationError('changes must be an object')
+    if filters is not None and not isinstance(filters, dict):
+        raise DataValidationError('filters must be an object')
+    if customer_ids is not None and (not isinstance(customer_ids, list) or
+                                     not all(isinstance(i, int) for i in customer_ids)):
+        raise DataValidationError('ids must be a list of integers')
+    if batch_size is not None and (not isinstance(batch_size, int) or batch_size < 1):
+        raise DataValidationError('batch_size must be a positive integer')
+
+    matched, updated = Customer.update_where(changes, filters, customer_ids, batch_size)
+    return make_response(jsonify(matched=matched, updated=updated), status.HTTP_200_OK)
+
+
 ######################################################################
 # DELETE A CUSTOMER
 ######################################################################
@@ -517,10 +974,7 @@ def delete_customers(id):
       204:
         description: Customer deleted
     """
-    customer = Customer.find(id)
-    if customer:
-        customer.delete()
-
+    Customer.remove(id)
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 
@@ -538,10 +992,33 @@ def customers_reset():
 #   U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-@app.before_first_request
 def init_db(redis=None):
-    """ Initlaize the model """
+    """ Initlaize the model (called once when the service starts) """
+    global query_cache
+    Customer.configure(batch_size=app.config['REDIS_BATCH_SIZE'],
+                       codec=app.config['STORAGE_CODEC'],
+                       engine=app.config['STORAGE_ENGINE'],
+                       bulk_pause=app.config['BULK_UPDATE_PAUSE'],
+                       cache_size=app.config['CUSTOMER_CACHE_SIZE'],
+                       cache_ttl=app.config['CUSTOMER_CACHE_TTL'],
+                       pool_size=app.config['REDIS_POOL_SIZE'],
+                       pool_timeout=app.config['REDIS_POOL_TIMEOUT'],
+                       socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+                       connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'],
+                       keepalive=app.config['REDIS_KEEPALIVE'],
+                       pool_warm=app.config['REDIS_POOL_WARM'],
+                       replica_host=app.config['REDIS_REPLICA_HOST'],
+                       replica_port=app.config['REDIS_REPLICA_PORT'],
+                       replica_password=app.config['REDIS_REPLICA_PASSWORD'],
+                       shard_urls=app.config['REDIS_SHARDS'])
     Customer.init_db(redis)
+    if Customer.cache is not None:
+        Customer.listen_for_changes()
+    query_cache = None
+    if app.config['QUERY_CACHE_SIZE'] > 0:
+        shared = Customer.redis if app.config['QUERY_CACHE_REDIS'] else None
+        query_cache = QueryCache(app.config['QUERY_CACHE_SIZE'],
+                                 app.config['QUERY_CACHE_TTL'], shared)
 
 
 def data_load(payload):
@@ -564,6 +1041,79 @@ def data_reset():
     Customer.remove_all()
 
 
+def get_bulk_items():
+    """ Returns the items of a JSON array or newline delimited JSON body """
+    content_type = request.headers.get('Content-Type', '').split(';')[0]
+    if content_type == 'application/x-ndjson':
+        items = []
+        for line in request.get_data().splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(DataValidationError('Invalid JSON: {}'.format(line)))
+        return items
+    check_content_type('application/json')
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise DataValidationError('Request body must be a JSON array of customers')
+    return items
+
+
+def get_int_arg(name):
+    """ Returns a positive integer query parameter (None if it is not set) """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise DataValidationError("Query parameter '{}' must be a positive integer".format(name))
+    return int(value)
+
+
+def get_bool_arg(name):
+    """ Returns a true/false query parameter as a boolean """
+    value = request.args.get(name).lower()
+    if value not in ('true', 'false'):
+        raise DataValidationError("Query parameter '{}' must be true or false".format(name))
+    return value == 'true'
+
+
+def get_filters():
+    """ Returns the attribute filters given as query parameters """
+    filters = {}
+    for attribute in ('username', 'email', 'firstname', 'lastname', 'promo', 'active'):
+        value = request.args.get(attribute)
+        if value:
+            if attribute in ('promo', 'active'):
+                value = get_bool_arg(attribute)
+            filters[attribute] = value
+    return filters
+
+
+def normalize_query(filters, fields, limit, cursor):
+    """ Returns a key that is the same for all the requests of the same list """
+    filters = dict((attribute, value.lower() if isinstance(value, basestring) else value)
+                   for attribute, value in filters.items())
+    return json.dumps({'filters': filters, 'fields': sorted(fields or []),
+                       'limit': limit, 'cursor': cursor}, sort_keys=True)
+
+
+def get_fields():
+    """ Returns the fields requested with ?fields= (None for all of them) """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+def not_modified(etag):
+    """ Returns a 304 Not Modified response with an ETag """
+    response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
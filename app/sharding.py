@@ -0,0 +1,202 @@
+"""
+Sharding for Customer Service
+
+HashRing - A consistent hash ring that maps keys to the nodes they are stored
+on, so that adding or removing a node only moves the keys next to its points
+Router - Routes the records to their shard, and the reads to the read replica
+"""
+
+import bisect
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+######################################################################
+# Consistent hash ring
+######################################################################
+
+class HashRing(object):
+    """
+    Maps keys to nodes by consistent hashing
+
+    Each node is placed on the ring at `replicas` points (the hashes of
+    its name and a number) and a key belongs to the node of the first
+    point after the hash of the key. When a node is added it only takes
+    over the keys just before its own points, about 1/N of them, and
+    every other key stays where it was.
+    """
+
+    def __init__(self, nodes=None, replicas=100):
+        """
+        Constructor
+
+        Args:
+            nodes (dict): the nodes to place on the ring by name
+            replicas (int): the number of points of each node on the ring
+        """
+        self.replicas = replicas
+        self.nodes = {}
+        self.__points = []
+        self.__names = []
+        for name, node in (nodes or {}).items():
+            self.add(name, node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @staticmethod
+    def __hash(key):
+        """ Returns the position of a key on the ring """
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, name, node):
+        """ Places a node on the ring under a name """
+        self.remove(name)
+        self.nodes[name] = node
+        for i in range(self.replicas):
+            point = self.__hash('{}#{}'.format(name, i))
+            index = bisect.bisect(self.__points, point)
+            self.__points.insert(index, point)
+            self.__names.insert(index, name)
+
+    def remove(self, name):
+        """ Takes a node off the ring (its keys go to the nodes that follow it) """
+        if self.nodes.pop(name, None) is None:
+            return
+        kept = [(point, owner) for point, owner in zip(self.__points, self.__names)
+                if owner != name]
+        self.__points = [point for point, _ in kept]
+        self.__names = [owner for _, owner in kept]
+
+    def get_name(self, key):
+        """ Returns the name of the node a key belongs to (None if the ring is empty) """
+        if not self.__points:
+            return None
+        index = bisect.bisect(self.__points, self.__hash(str(key)))
+        return self.__names[index % len(self.__names)]
+
+    def get(self, key):
+        """ Returns the node a key belongs to (None if the ring is empty) """
+        name = self.get_name(key)
+        return self.nodes[name] if name is not None else None
+
+
+######################################################################
+# Routing of the reads and writes to the Redis nodes
+######################################################################
+
+class Router(object):
+    """
+    Routes the records to the Redis nodes they are read from and written to
+
+    Records live on the primary, or on the shards when there are any, each
+    on the node the ring maps its id to. Unsharded reads go to the read
+    replica unless the current thread asked for the primary.
+    """
+
+    def __init__(self, primary=None, replica=None):
+        """
+        Constructor
+
+        Args:
+            primary (Redis): the primary connection
+            replica (Redis): the read replica (None to read from the primary)
+        """
+        self.primary = primary
+        self.replica = replica
+        self.shards = []
+        self.ring = None
+        self.__workers = None
+        self.__routing = threading.local()
+
+    @staticmethod
+    def node_name(client):
+        """ Returns the name of a node on the ring: its host, port and database """
+        options = client.connection_pool.connection_kwargs
+        address = options.get('path') or '{}:{}'.format(options.get('host', 'localhost'),
+                                                         options.get('port', 6379))
+        return '{}/{}'.format(address, options.get('db', 0))
+
+    def use_shards(self, nodes):
+        """
+        Spreads the records over Redis nodes by consistent hashing of their ids
+
+        The nodes are placed on the ring by host, port and database, so the
+        same records map to them whatever order they are listed in, and the
+        primary can be one of them.
+
+        Args:
+            nodes (list): the connections to the shards (empty to store all on the primary)
+        """
+        if nodes:
+            primary = Router.node_name(self.primary)
+            nodes = [self.primary if Router.node_name(node) == primary else node
+                     for node in nodes]
+        self.shards = list(nodes)
+        self.ring = HashRing(dict((Router.node_name(node), node)
+                                  for node in nodes)) if nodes else None
+        if self.__workers is not None:
+            self.__workers.terminate()
+        self.__workers = ThreadPool(len(nodes)) if len(nodes) > 1 else None
+
+    def read_from_primary(self, primary=True):
+        """ Sends the reads of the current thread to the primary instead of the replica """
+        self.__routing.primary = primary
+
+    def reader(self):
+        """ Returns the connection the current thread reads from """
+        if self.replica is None or getattr(self.__routing, 'primary', False):
+            return self.primary
+        return self.replica
+
+    def node(self, record_id):
+        """ Returns the node a record belongs on: its shard, or else the primary """
+        if not self.shards:
+            return self.primary
+        return self.ring.get(int(record_id))
+
+    def nodes(self, primary=False):
+        """ Returns the nodes the records are on: the shards, or else the primary (or replica) """
+        if self.shards:
+            return self.shards
+        return [self.primary if primary else self.reader()]
+
+    def all_nodes(self):
+        """ Returns the primary followed by the shards """
+        return [self.primary] + [node for node in self.shards if node is not self.primary]
+
+    def scatter(self, function, nodes):
+        """ Calls a function with each node, in parallel, and returns the results in order """
+        if len(nodes) == 1 or self.__workers is None:
+            return [function(node) for node in nodes]
+        return self.__workers.map(function, nodes)
+
+    def gather(self, find_ids, nodes):
+        """ Merges the ids find_ids returns on each node into sorted (id, node) pairs """
+        located = {}
+        for node, record_ids in zip(nodes, self.scatter(find_ids, nodes)):
+            for record_id in record_ids:
+                record_id = int(record_id)
+                # a record still being moved is read from its own shard
+                if record_id not in located or node is self.node(record_id):
+                    located[record_id] = node
+        return sorted(located.items())
+
+    def locate(self, record_id, fetch, client=None):
+        """
+        Loads a record from its shard, or from the node it has not been moved from yet
+
+        Args:
+            record_id (int): the id of the record
+            fetch (function): returns the data of the record on a node (None if it is not there)
+            client (Redis): the connection to read from when not sharded (the primary by default)
+
+        Returns:
+            a tuple of the node and the data (None if the record does not exist)
+        """
+        owner = self.node(record_id) if self.shards else client or self.primary
+        for node in [owner] + [node for node in self.shards if node is not owner]:
+            data = fetch(node)
+            if data is not None:
+                return node, data
+        return owner, None
@@ -261,6 +261,35 @@ $(function () {
     });
 
 
+    // ****************************************
+    // Suggest usernames and lastnames as you type
+    // ****************************************
+    function suggest(field, input, datalist) {
+        $(input).on("input", function () {
+            var prefix = $(input).val();
+            if (prefix.length == 0) {
+                $(datalist).empty();
+                return;
+            }
+
+            var ajax = $.ajax({
+                type: "GET",
+                url: "/customers/search",
+                data: {prefix: prefix, field: field, fields: field, limit: 10}
+            });
+
+            ajax.done(function(res){
+                $(datalist).empty();
+                for(var i = 0; i < res.length; i++) {
+                    $(datalist).append($("<option>").attr("value", res[i][field]));
+                }
+            });
+        });
+    }
+
+    suggest("username", "#inputUsername", "#usernameSuggestions");
+    suggest("lastname", "#inputLastname", "#lastnameSuggestions");
+
     // ****************************************
     // Clear the form
     // ****************************************
@@ -0,0 +1,1792 @@
+"""
+Storage engines for Customer Service
+
+The Customer model stores its records and indexes through an engine, which
+gets, puts, updates, deletes and scans the records and looks them up
+through the indexes:
+
+RedisEngine - Keeps the Customers in Redis, on the primary or spread over shards,
+with index keys next to them
+MemoryEngine - Keeps the Customers in a dict with hash indexes, for tests, local
+runs and single process deployments that don't need Redis
+"""
+
+import time
+import bisect
+import pickle
+import logging
+import threading
+from collections import Counter
+from redis.exceptions import ConnectionError, TimeoutError, ResponseError
+from app.custom_exceptions import DuplicateValueError, DatabaseNotReadyError
+
+######################################################################
+# In process storage engine
+######################################################################
+
+class MemoryEngine(object):
+    """
+    Stores records in a dict and indexes them with hash tables
+
+    The primary storage maps each id to a copy of its data. Unique
+    attributes map each (normalized) value to an id, set attributes and
+    trigrams map each value to a set of ids, and the ids and the prefix
+    attributes are kept in sorted lists for paging and prefix searches.
+    Every operation holds a lock, so it is atomic like a Redis
+    transaction, and every write bumps the generation and records it as
+    the version of the record.
+    """
+
+    def __init__(self, unique=(), sets=(), prefixes=(), normalize=None, ngrams=None):
+        """
+        Constructor
+
+        Args:
+            unique (tuple): the attributes whose values must be unique
+            sets (tuple): the attributes indexed with a set of ids per value
+            prefixes (tuple): the attributes indexed in order for prefix searches
+            normalize (function): returns the value a value is indexed under
+            ngrams (function): returns the trigrams of the data of a record
+        """
+        self.unique = tuple(unique)
+        self.sets = tuple(sets)
+        self.prefixes = tuple(prefixes)
+        self.normalize = normalize or (lambda value: value)
+        self.ngrams = ngrams or (lambda data: set())
+        self.__lock = threading.RLock()
+        self.__sequence = 0
+        self.__generation = 0
+        self.__reset()
+
+    def __len__(self):
+        return len(self.__records)
+
+    def __reset(self):
+        """ Empties the records and the indexes """
+        self.__records = {}
+        self.__versions = {}
+        self.__ids = []
+        self.__owners = dict((attribute, {}) for attribute in self.unique)
+        self.__members = {}
+        self.__trigrams = {}
+        self.__sorted = dict((attribute, []) for attribute in self.prefixes)
+
+    def next_id(self, count=1):
+        """ Reserves count ids and returns the last one """
+        with self.__lock:
+            self.__sequence += count
+            return self.__sequence
+
+    def get(self, record_ids, fields=None, primary=False):
+        """
+        Returns the data of records
+
+        Args:
+            record_ids (list): the ids of the records
+            fields (list): only return these fields
+            primary (bool): unused, there is no replica to read from
+
+        Returns:
+            a list with the data of each id (None if it does not exist)
+        """
+        with self.__lock:
+            results = []
+            for record_id in record_ids:
+                data = self.__records.get(int(record_id))
+                if data is not None:
+                    data = dict((field, data.get(field)) for field in fields) if fields \
+                        else dict(data)
+                results.append(data)
+            return results
+
+    def put(self, record_id, data):
+        """
+        Writes a whole record and its index entries
+
+        Returns:
+            the data the record had before (None if it is new)
+
+        Raises:
+            DuplicateValueError if a unique value belongs to another record
+        """
+        record_id = int(record_id)
+        with self.__lock:
+            old_data = self.__records.get(record_id)
+            self.__check_unique(record_id, data)
+            self.__write(record_id, old_data, dict(data))
+            return old_data
+
+    def insert_many(self, records):
+        """
+        Writes a batch of new records
+
+        Args:
+            records (list): the (id, data) pairs of the new records
+
+        Returns:
+            a list with None for each record that was written or the
+            DuplicateValueError that refused it
+        """
+        errors = []
+        for record_id, data in records:
+            try:
+                self.put(record_id, data)
+                errors.append(None)
+            except DuplicateValueError as error:
+                errors.append(error)
+        return errors
+
+    def update(self, record_id, changes, force=True):
+        """
+        Changes some fields of a record and their index entries
+
+        Args:
+            record_id (int): the id of the record
+            changes (dict): the fields to change and their new values
+            force (bool): False to leave the record (and its version) alone
+                when the changes don't modify it
+
+        Returns:
+            a tuple of the old and the new data (both None if there is no record)
+        """
+        record_id = int(record_id)
+        with self.__lock:
+            old_data = self.__records.get(record_id)
+            if old_data is None:
+                return None, None
+            self.__check_unique(record_id, changes)
+            new_data = dict(old_data, **changes)
+            if force or new_data != old_data:
+                self.__write(record_id, old_data, new_data)
+            return dict(old_data), dict(new_data)
+
+    def update_many(self, record_ids, changes):
+        """
+        Applies the same changes to a batch of records
+
+        Returns:
+            a tuple of the number of records found and the number changed
+        """
+        matched = updated = 0
+        for record_id in record_ids:
+            old_data, new_data = self.update(record_id, changes, force=False)
+            if old_data is not None:
+                matched += 1
+                updated += int(new_data != old_data)
+        return matched, updated
+
+    def delete(self, record_id):
+        """ Deletes a record and its index entries, returns False if there was none """
+        record_id = int(record_id)
+        with self.__lock:
+            old_data = self.__records.pop(record_id, None)
+            if old_data is None:
+                return False
+            self.__index(record_id, old_data, None)
+            self.__versions.pop(record_id, None)
+            self.__generation += 1
+            return True
+
+    def clear(self):
+        """ Deletes every record and resets the ids (the generation keeps counting) """
+        with self.__lock:
+            self.__reset()
+            self.__sequence = 0
+            self.__generation += 1
+
+    def scan(self, batch_size=None, fields=None):
+        """ Generator that yields the data of every record, one batch at a time """
+        batch_size = batch_size or 500
+        with self.__lock:
+            record_ids = list(self.__ids)
+        for start in range(0, len(record_ids), batch_size):
+            for data in self.get(record_ids[start:start + batch_size], fields):
+                if data is not None:
+                    yield data
+
+    def load_all(self, fields=None):
+        """ Returns the data of every record """
+        return list(self.scan(fields=fields))
+
+    def reindex(self):
+        """ Rebuilds the indexes from the records and returns the number of records """
+        with self.__lock:
+            records = self.__records
+            versions = self.__versions
+            self.__reset()
+            self.__generation += 1
+            for record_id, data in records.items():
+                self.__index(record_id, None, data)
+                self.__records[record_id] = data
+                self.__versions[record_id] = versions.get(record_id, self.__generation)
+            return len(records)
+
+    def match(self, filters, cursor=None, limit=None, primary=False):
+        """
+        Returns the sorted ids of the records that match all of the filters
+
+        Args:
+            filters (dict): the unique or set attributes and the values to match
+                (the other attributes are not indexed and are ignored)
+            cursor (int): only return the ids after this one
+            limit (int): the maximum number of ids to return (all by default)
+            primary (bool): unused, there is no replica to read from
+        """
+        record_ids = [record_id for record_id in self.__match(filters)
+                      if cursor is None or record_id > cursor]
+        return record_ids[:limit] if limit else record_ids
+
+    def __match(self, filters):
+        """ Returns the sorted ids of the records that match all of the filters """
+        with self.__lock:
+            owners = set(self.__owners[attribute].get(self.normalize(value))
+                         for attribute, value in filters.items() if attribute in self.unique)
+            members = [self.__members.get((attribute, self.normalize(value)), set())
+                       for attribute, value in filters.items() if attribute in self.sets]
+            if None in owners or len(owners) > 1:
+                return []
+            if owners:
+                record_id = owners.pop()
+                return [record_id] if all(record_id in ids for ids in members) else []
+            if not members:
+                return list(self.__ids)
+            members.sort(key=len)
+            return sorted(members[0].intersection(*members[1:]))
+
+    def count(self, filters=None):
+        """ Returns the number of records that match all of the filters """
+        if not filters:
+            return len(self.__records)
+        return len(self.__match(filters))
+
+    def ids(self, cursor=None, limit=None, primary=False):
+        """ Returns the ids in order, after the cursor and at most limit of them """
+        with self.__lock:
+            start = bisect.bisect_right(self.__ids, cursor) if cursor is not None else 0
+            return self.__ids[start:start + limit] if limit else self.__ids[start:]
+
+    def prefix(self, attribute, prefix, limit=None):
+        """ Returns the (value, id) pairs of a prefix attribute that start with a prefix, in order """
+        prefix = self.normalize(prefix)
+        with self.__lock:
+            entries = self.__sorted[attribute]
+            matches = []
+            for i in range(bisect.bisect_left(entries, (prefix,)), len(entries)):
+                if not entries[i][0].startswith(prefix) or len(matches) == limit:
+                    break
+                matches.append((entries[i][0], int(entries[i][1])))
+            return matches
+
+    def trigram(self, trigrams):
+        """ Returns the number of the trigrams that each record with any of them has """
+        scores = Counter()
+        with self.__lock:
+            for trigram in trigrams:
+                scores.update(self.__trigrams.get(trigram, ()))
+        return dict(scores)
+
+    def version(self, record_id, primary=False):
+        """ Returns the generation of the last write to a record (None if it has none) """
+        return self.__versions.get(int(record_id))
+
+    def generation(self):
+        """ Returns the number of writes made to the records """
+        return self.__generation
+
+    def check_indexes(self, record_id=None, data=None):
+        """ Does nothing, the indexes are always built """
+        pass
+
+    def migrate_keys(self, batch_size=None):
+        """ Does nothing and returns 0, only Redis databases have a legacy key layout """
+        return 0
+
+    def rebalance(self, batch_size=None):
+        """ Does nothing and returns 0, the records are never sharded """
+        return 0
+
+    def use_shards(self, nodes):
+        """ Refuses to spread the records over shards """
+        if nodes:
+            raise ValueError('The memory engine can not be sharded')
+
+    def listen(self, handle):
+        """ Returns at once, there are no other processes to hear about writes from """
+        return
+
+    def __check_unique(self, record_id, data):
+        """ Raises a DuplicateValueError if a unique value belongs to another record """
+        for attribute in self.unique:
+            if attribute not in data:
+                continue
+            owner = self.__owners[attribute].get(self.normalize(data[attribute]))
+            if owner is not None and owner != record_id:
+                raise DuplicateValueError([(record_id, attribute, data[attribute], owner)])
+
+    def __write(self, record_id, old_data, new_data):
+        """ Stores a record, updates its index entries and bumps its version """
+        self.__index(record_id, old_data, new_data)
+        self.__records[record_id] = new_data
+        self.__generation += 1
+        self.__versions[record_id] = self.__generation
+
+    def __index(self, record_id, old_data, new_data):
+        """ Moves the index entries of a record from its old data to its new data """
+        for attribute in set(self.unique + self.sets + self.prefixes):
+            old_value = self.normalize(old_data[attribute]) if old_data else None
+            new_value = self.normalize(new_data[attribute]) if new_data else None
+            if old_value == new_value:
+                continue
+            if attribute in self.unique:
+                owners = self.__owners[attribute]
+                if old_value is not None and owners.get(old_value) == record_id:
+                    del owners[old_value]
+                if new_value is not None:
+                    owners[new_value] = record_id
+            if attribute in self.sets:
+                if old_value is not None:
+                    self.__discard(self.__members, (attribute, old_value), record_id)
+                if new_value is not None:
+                    self.__members.setdefault((attribute, new_value), set()).add(record_id)
+            if attribute in self.prefixes:
+                entries = self.__sorted[attribute]
+                if old_value is not None:
+                    entry = (old_value, str(record_id))
+                    i = bisect.bisect_left(entries, entry)
+                    if i < len(entries) and entries[i] == entry:
+                        del entries[i]
+                if new_value is not None:
+                    bisect.insort(entries, (new_value, str(record_id)))
+        old_trigrams = self.ngrams(old_data)
+        new_trigrams = self.ngrams(new_data)
+        for trigram in old_trigrams - new_trigrams:
+            self.__discard(self.__trigrams, trigram, record_id)
+        for trigram in new_trigrams - old_trigrams:
+            self.__trigrams.setdefault(trigram, set()).add(record_id)
+        if new_data and not old_data:
+            bisect.insort(self.__ids, record_id)
+        elif old_data and not new_data:
+            del self.__ids[bisect.bisect_left(self.__ids, record_id)]
+
+    @staticmethod
+    def __discard(index, key, record_id):
+        """ Removes an id from the set of a key, and the key once its set is empty """
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(record_id)
+            if not ids:
+                del index[key]
+
+
+######################################################################
+# Redis storage engine
+######################################################################
+
+class RedisEngine(object):
+    """
+    Stores records in Redis, as hashes or pickled strings, with index keys
+
+    Each record is stored under '{prefix}:{id}' on the node the router
+    maps its id to, next to its index entries: a sorted id set per value
+    of the set attributes, a lexicographical sorted set per prefix
+    attribute and an id set per trigram. The unique attributes are hashes
+    of value to id on the primary. Every write bumps the generation of its
+    node, records it as the version of the record and publishes the id on
+    events_channel.
+    """
+
+    logger = logging.getLogger(__name__)
+    codecs = ('hash', 'pickle')
+    # the counter of the ids before the keys were moved under the prefix
+    legacy_sequence_key = 'index'
+    # bumped when the indexes change so that reindex has to build them again
+    index_layout = 1
+    layout_check_interval = 30
+
+    # Reserves ARGV[1] ids and returns the last one, using the legacy
+    # counter KEYS[1] until the migration renames it
+    next_id_script = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('INCRBY', KEYS[1], ARGV[1])
+        end
+        return redis.call('INCRBY', KEYS[2], ARGV[1])
+    """
+
+    # Bumps the generation KEYS[2], records it as the version of the
+    # record ARGV[1] in the hash KEYS[1] and publishes it on ARGV[2]
+    bump_version_script = """
+        local generation = redis.call('INCR', KEYS[2])
+        redis.call('HSET', KEYS[1], ARGV[1], generation)
+        redis.call('PUBLISH', ARGV[2], ARGV[1] .. ':' .. generation)
+        return generation
+    """
+
+    # Sets the boolean field ARGV[1] of the hash record KEYS[1] to ARGV[2],
+    # moves the id ARGV[3] from the sorted id set KEYS[3] to KEYS[2], bumps its
+    # version (KEYS[4] and KEYS[5]), publishes it on ARGV[4] and returns
+    # whether it changed and the updated record (0 if there is no record,
+    # -1 if it is not a hash)
+    set_flag_script = """
+        local kind = redis.call('TYPE', KEYS[1]).ok
+        if kind == 'none' then
+            return 0
+        elseif kind ~= 'hash' then
+            return -1
+        end
+        local changed = 0
+        if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+            redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+            redis.call('ZREM', KEYS[3], ARGV[3])
+            redis.call('ZADD', KEYS[2], ARGV[3], ARGV[3])
+            local generation = redis.call('INCR', KEYS[5])
+            redis.call('HSET', KEYS[4], ARGV[3], generation)
+            redis.call('PUBLISH', ARGV[4], ARGV[3] .. ':' .. generation)
+            changed = 1
+        end
+        return {changed, redis.call('HGETALL', KEYS[1])}
+    """
+
+    # Deletes the hash record KEYS[1] if the ARGV[1] fields that follow it
+    # still have the given values, then runs a command (ARGV) with a count
+    # of arguments (ARGV) and those arguments on each other key (KEYS[2..]).
+    # Returns 1 once deleted, 0 if the record changed and -1 if it is
+    # missing or not a hash
+    delete_script = """
+        if redis.call('TYPE', KEYS[1]).ok ~= 'hash' then
+            return -1
+        end
+        local count = tonumber(ARGV[1])
+        for i = 1, count do
+            local value = redis.call('HGET', KEYS[1], ARGV[2 * i]) or ''
+            if value ~= ARGV[2 * i + 1] then
+                return 0
+            end
+        end
+        redis.call('DEL', KEYS[1])
+        local arg = 2 * count + 2
+        for i = 2, #KEYS do
+            local argc = tonumber(ARGV[arg + 1])
+            redis.call(ARGV[arg], KEYS[i], unpack(ARGV, arg + 2, arg + 1 + argc))
+            arg = arg + 2 + argc
+        end
+        return 1
+    """
+
+    # Deletes the field ARGV[1] of the unique index KEYS[1] if it still
+    # belongs to the record ARGV[2]
+    release_script = """
+        if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+            return redis.call('HDEL', KEYS[1], ARGV[1])
+        end
+        return 0
+    """
+
+    def __init__(self, router, schema, unique=(), sets=(), prefixes=(), normalize=None,
+                 ngrams=None, key_prefix='customer', codec='hash', batch_size=500):
+        """
+        Constructor
+
+        Loads the Lua scripts into the primary and checks the key layout.
+
+        Args:
+            router (Router): routes the records to their node, its primary must be connected
+            schema (dict): the Cerberus schema of the records, to decode the hash fields
+            unique (tuple): the attributes whose values must be unique
+            sets (tuple): the attributes indexed with a sorted id set per value
+            prefixes (tuple): the attributes indexed in order for prefix searches
+            normalize (function): returns the (UTF-8 encoded) value a value is indexed under
+            ngrams (function): returns the (UTF-8 encoded) trigrams of the data of a record
+            key_prefix (string): the prefix of the Redis keys
+            codec (string): how new records are stored, 'hash' or 'pickle'
+            batch_size (int): the number of keys walked or fetched per Redis call
+        """
+        if codec not in RedisEngine.codecs:
+            raise ValueError('Unknown storage codec: {}'.format(codec))
+        self.router = router
+        self.schema = schema
+        self.unique = tuple(unique)
+        self.sets = tuple(sets)
+        self.prefixes = tuple(prefixes)
+        self.normalize = normalize or (lambda value: value)
+        self.ngrams = ngrams or (lambda data: set())
+        self.key_prefix = key_prefix
+        self.codec = codec
+        self.batch_size = batch_size
+        self.ids_key = key_prefix + ':ids'
+        self.sequence_key = key_prefix + ':seq'
+        self.generation_key = key_prefix + ':generation'
+        self.versions_key = key_prefix + ':versions'
+        self.indexed_key = key_prefix + ':indexed'
+        self.migration_key = key_prefix + ':migration'
+        self.events_channel = key_prefix + ':events'
+        # True until the records under bare integer keys have been migrated
+        self.legacy_keys = False
+        # False until reindex has built the indexes that unique writes need
+        self.indexes_built = True
+        self.__layout_checked = 0
+        self.scripts = {}
+        for name in ('next_id', 'bump_version', 'set_flag', 'delete', 'release'):
+            source = getattr(RedisEngine, name + '_script')
+            self.redis.script_load(source)
+            self.scripts[name] = self.redis.register_script(source)
+        self.__check_key_layout()
+
+    @property
+    def redis(self):
+        """ The primary connection """
+        return self.router.primary
+
+    def next_id(self, count=1):
+        """ Reserves count ids and returns the last one """
+        return self.scripts['next_id'](keys=[RedisEngine.legacy_sequence_key, self.sequence_key],
+                                       args=[count])
+
+    def get(self, record_ids, fields=None, primary=False):
+        """
+        Returns the data of records
+
+        When sharded the records are read from their shards in parallel.
+
+        Args:
+            record_ids (list): the ids of the records
+            fields (list): only return these fields
+            primary (bool): True to read from the primary rather than the replica
+
+        Returns:
+            a list with the data of each id (None if it does not exist)
+        """
+        if not self.router.shards:
+            return self.__fetch(record_ids, fields, self.redis if primary else self.router.reader())
+        by_node = {}
+        for record_id in record_ids:
+            by_node.setdefault(self.router.node(record_id), []).append(record_id)
+        nodes = list(by_node)
+        found = {}
+        for node, stored in zip(nodes, self.router.scatter(
+                lambda node: self.__fetch(by_node[node], fields, node), nodes)):
+            found.update(zip(by_node[node], stored))
+        # a record that a rebalance has not moved yet is on another node
+        return [found[record_id] if found[record_id] is not None
+                else self.__locate(record_id, fields)[1] for record_id in record_ids]
+
+    def put(self, record_id, data):
+        """
+        Writes a whole record and its index entries
+
+        Returns:
+            the data the record had before (None if it is new)
+
+        Raises:
+            DuplicateValueError if a unique value belongs to another record
+        """
+        self.check_indexes(record_id, data)
+        return self.__write(record_id, data)[0]
+
+    def update(self, record_id, changes, force=True):
+        """
+        Changes some fields of a record and their index entries
+
+        Only the given fields are written (HSET on a hash record) and only
+        the indexes of the fields whose values change are touched. A single
+        boolean set attribute of a hash record is set by a Lua script in one
+        round trip. Pickled records and records still under a bare integer
+        key are rewritten whole with the configured codec.
+
+        Args:
+            record_id (int): the id of the record
+            changes (dict): the fields to change and their new values
+            force (bool): False to leave the record (and its version) alone
+                when the changes don't modify it
+
+        Returns:
+            a tuple of the old and the new data (both None if there is no record)
+        """
+        self.check_indexes(record_id, changes)
+        if force or len(changes) != 1:
+            return self.__write(record_id, changes, replace=False, force=force)
+        (attribute, value), = changes.items()
+        if attribute not in self.sets or self.schema[attribute]['type'] != 'boolean':
+            return self.__write(record_id, changes, replace=False, force=force)
+        reply = self.scripts['set_flag'](
+            keys=[self.__key(record_id), self.__set_key(attribute, value),
+                  self.__set_key(attribute, not value), self.versions_key, self.generation_key],
+            args=[attribute, 'true' if value else 'false', record_id, self.events_channel],
+            client=self.router.node(record_id))
+        if isinstance(reply, list):
+            changed, fields = reply
+            new_data = self.__decode_hash(dict(zip(fields[::2], fields[1::2])))
+            old_data = dict(new_data, **{attribute: not value}) if changed else dict(new_data)
+            return old_data, new_data
+        if reply == 0 and not self.legacy_keys and not self.router.shards:
+            return None, None
+        # a pickled record, or one that may be under another key or node
+        return self.__write(record_id, changes, replace=False, force=force)
+
+    def insert_many(self, records):
+        """
+        Writes a batch of new records with pipelined writes
+
+        The unique values are claimed with HSETNX so a record that collides
+        with an existing one (or an earlier one in the batch) fails on its
+        own, then the records and their index entries are written in one
+        transaction per node and chunk of batch_size records.
+
+        Args:
+            records (list): the (id, data) pairs of the new records
+
+        Returns:
+            a list with None for each record that was written or the
+            DuplicateValueError that refused it
+        """
+        self.__require_indexes()
+        errors = [None] * len(records)
+        for start in range(0, len(records), self.batch_size):
+            chunk = range(start, min(start + self.batch_size, len(records)))
+            pipe = self.redis.pipeline(transaction=False)
+            for i in chunk:
+                record_id, data = records[i]
+                for attribute in self.unique:
+                    pipe.hsetnx(self.__index_key(attribute), self.normalize(data[attribute]),
+                                record_id)
+                    pipe.hget(self.__index_key(attribute), self.normalize(data[attribute]))
+            replies = iter(pipe.execute())
+
+            # one transaction per node, the primary's also gives back the claims
+            pipes = {self.redis: self.redis.pipeline()}
+            for i in chunk:
+                record_id, data = records[i]
+                claims = [(attribute, next(replies), next(replies)) for attribute in self.unique]
+                if all(claimed for _, claimed, _ in claims):
+                    node = self.router.node(record_id)
+                    if node not in pipes:
+                        pipes[node] = node.pipeline()
+                    self.__store(pipes[node], record_id, data)
+                    self.__update_indexes(pipes[node], record_id, None, data,
+                                          unique=not self.router.shards)
+                    continue
+                # give back the values this record did manage to claim
+                for attribute, claimed, _ in claims:
+                    if claimed:
+                        pipes[self.redis].hdel(self.__index_key(attribute),
+                                               self.normalize(data[attribute]))
+                errors[i] = DuplicateValueError([
+                    (record_id, attribute, data[attribute], int(owner))
+                    for attribute, claimed, owner in claims if not claimed])
+            for pipe in pipes.values():
+                pipe.execute()
+        return errors
+
+    def update_many(self, record_ids, changes):
+        """
+        Applies the same changes to a batch of records
+
+        The records of each node are read with one pipeline and rewritten,
+        together with their index entries, in one transaction that WATCHes
+        them, so a concurrent write is never overwritten.
+
+        Returns:
+            a tuple of the number of records found and the number changed
+        """
+        shards = {}
+        for record_id in record_ids:
+            shards.setdefault(self.router.node(record_id), []).append(record_id)
+        matched = updated = 0
+        for node, node_ids in shards.items():
+            tally = {}
+
+            def write(pipe):
+                """ Rewrites the records that the changes modify """
+                tally.update(matched=0, updated=0)  # reset when the WATCH fires
+                stored = self.__fetch(node_ids, client=node)
+                pipe.multi()
+                for record_id, old_data in zip(node_ids, stored):
+                    if not old_data:
+                        continue
+                    tally['matched'] += 1
+                    new_data = dict(old_data, **changes)
+                    if new_data == old_data:
+                        continue
+                    tally['updated'] += 1
+                    self.__store(pipe, record_id, new_data)
+                    if self.legacy_keys:
+                        pipe.delete(record_id)
+                    self.__update_indexes(pipe, record_id, old_data, new_data)
+
+            node.transaction(write, *self.__batch_keys(node_ids))
+            matched += tally['matched']
+            updated += tally['updated']
+        return matched, updated
+
+    def delete(self, record_id):
+        """
+        Deletes a record and its index entries, returns False if there was none
+
+        The record is read once to work out its index entries, then a Lua
+        script deletes it along with them, provided that its fields have
+        not changed in the meantime (otherwise it starts over). Pickled
+        records and records that may still be under a bare integer key are
+        deleted in a WATCH/MULTI transaction instead. When sharded, the
+        unique values are released on the primary afterwards.
+        """
+        while not self.legacy_keys:
+            node, old_data = self.__locate(record_id)
+            if old_data is None:
+                return False
+            recorder = _IndexRecorder()
+            self.__update_indexes(recorder, record_id, old_data, None,
+                                  unique=not self.router.shards)
+            stored = self.__encode_hash(old_data)
+            args = [len(self.schema)]
+            for attribute in sorted(self.schema):
+                args += [attribute, stored.get(attribute, '')]
+            keys = [self.__key(record_id)]
+            for command, key, command_args in recorder.commands:
+                keys.append(key)
+                args += [command, len(command_args)] + list(command_args)
+            reply = self.scripts['delete'](keys=keys, args=args, client=node)
+            if reply == 1:
+                if self.router.shards:
+                    self.__release_unique(record_id, self.__changed_unique(old_data, None))
+                return True
+            if reply == -1:
+                break  # a pickled record
+
+        node = self.__locate(record_id)[0]
+
+        def remove(pipe):
+            """ Removes the record and its index entries atomically """
+            old_data = self.__fetch([record_id], client=node)[0]
+            pipe.multi()
+            pipe.delete(self.__key(record_id))
+            if self.legacy_keys:
+                pipe.delete(record_id)
+            self.__update_indexes(pipe, record_id, old_data, None,
+                                  unique=not self.router.shards)
+            return old_data
+
+        old_data = node.transaction(remove, *self.__record_keys(record_id),
+                                    value_from_callable=True)
+        if self.router.shards:
+            self.__release_unique(record_id, self.__changed_unique(old_data, None))
+        return old_data is not None
+
+    def clear(self):
+        """ Deletes every record and resets the ids (the generation keeps counting) """
+        prefix = self.key_prefix + ':'
+        for client in self.router.all_nodes():
+            keys = [key for key in client.scan_iter(count=self.batch_size)
+                    if (key.startswith(prefix) or key.isdigit() or
+                        key == RedisEngine.legacy_sequence_key) and key != self.generation_key]
+            for start in range(0, len(keys), self.batch_size):
+                client.delete(*keys[start:start + self.batch_size])
+            client.incr(self.generation_key)
+        # there is nothing left to index
+        self.redis.set(self.indexed_key, RedisEngine.index_layout)
+        self.indexes_built = True
+        self.redis.publish(self.events_channel, '*')
+
+    def scan(self, batch_size=None, fields=None):
+        """
+        Generator that yields the data of every record
+
+        The keyspace is walked incrementally with SCAN instead of KEYS and
+        the records are fetched one batch at a time, so Redis is never
+        blocked for long and memory does not grow with the database. The
+        shards are walked one after the other.
+
+        Args:
+            batch_size (int): the number of keys to ask SCAN for per call
+            fields (list): only load these fields of the records
+        """
+        for client in self.router.shards or [self.router.reader()]:
+            for data in self.__scan_node(client, batch_size, fields):
+                yield data
+
+    def load_all(self, fields=None):
+        """ Returns the data of every record, walking the shards in parallel """
+        nodes = self.router.shards or [self.router.reader()]
+        return [data for found in self.router.scatter(
+            lambda client: list(self.__scan_node(client, fields=fields)), nodes) for data in found]
+
+    def match(self, filters, cursor=None, limit=None, primary=False):
+        """
+        Returns the sorted ids of the records that match all of the filters
+
+        The ids come from the indexes alone (see __ids_matching). When
+        sharded, each shard returns its first ids in parallel and they are
+        merged.
+
+        Args:
+            filters (dict): the unique or set attributes and the values to match
+                (the other attributes are not indexed and are ignored)
+            cursor (int): only return the ids after this one
+            limit (int): the maximum number of ids to return (all by default)
+            primary (bool): True to read from the primary rather than the replica
+        """
+        self.__require_indexes()
+        matches = self.router.gather(
+            lambda client: self.__ids_matching(filters, client, cursor, limit),
+            self.router.nodes(primary))
+        record_ids = [record_id for record_id, _ in matches]
+        return record_ids[:limit] if limit else record_ids
+
+    def count(self, filters=None):
+        """
+        Returns the number of records that match all of the filters
+
+        The count comes from the indexes without loading any record: the
+        cardinality of the id index or of a single id set, and the number
+        of matching ids when several filters are combined. When sharded,
+        the counts of the shards are added up.
+        """
+        self.__require_indexes()
+
+        def count_on(client):
+            """ Counts the matching records on a node """
+            if not filters:
+                return client.zcard(self.ids_key)
+            if len(filters) == 1:
+                (attribute, value), = filters.items()
+                # a unique index on the primary would be counted once per shard
+                if attribute in self.sets:
+                    return client.zcard(self.__set_key(attribute, value))
+                if attribute in self.unique and not self.router.shards:
+                    return int(client.hexists(self.__index_key(attribute), self.normalize(value)))
+            return len(self.__ids_matching(filters, client))
+
+        return sum(self.router.scatter(count_on, self.router.nodes()))
+
+    def ids(self, cursor=None, limit=None, primary=False):
+        """ Returns the ids in order, after the cursor and at most limit of them """
+        self.__require_indexes()
+        low = '({}'.format(cursor) if cursor is not None else '-inf'
+        matches = self.router.gather(
+            lambda client: client.zrangebyscore(self.ids_key, low, '+inf',
+                                                start=0 if limit else None, num=limit),
+            self.router.nodes(primary))
+        record_ids = [record_id for record_id, _ in matches]
+        return record_ids[:limit] if limit else record_ids
+
+    def prefix(self, attribute, prefix, limit=None):
+        """
+        Returns the (value, id) pairs of a prefix attribute that start with a prefix, in order
+
+        The lexicographical index is read with ZRANGEBYLEX, so the cost
+        depends on the number of results and not the number of records.
+        """
+        self.__require_indexes()
+        low = '[' + self.normalize(prefix)
+        # no UTF-8 encoded character contains the byte 0xff
+        high = low + '\xff'
+        replies = self.router.scatter(
+            lambda client: client.zrangebylex(self.__lex_key(attribute), low, high,
+                                              start=0 if limit else None, num=limit),
+            self.router.nodes())
+        matches = []
+        for member in sorted(set(member for reply in replies for member in reply)):
+            value, record_id = member.rsplit('\x00', 1)
+            matches.append((value, int(record_id)))
+        return matches[:limit] if limit else matches
+
+    def trigram(self, trigrams):
+        """ Returns the number of the trigrams that each record with any of them has """
+        self.__require_indexes()
+
+        def scores_on(client):
+            """ Counts the trigrams each record on a node has """
+            pipe = client.pipeline(transaction=False)
+            for trigram in trigrams:
+                pipe.smembers(self.__ngram_key(trigram))
+            scores = Counter()
+            for record_ids in pipe.execute():
+                scores.update(int(record_id) for record_id in record_ids)
+            return scores
+
+        scores = {}
+        for node_scores in self.router.scatter(scores_on, self.router.nodes()):
+            for record_id, score in node_scores.items():
+                scores[record_id] = max(score, scores.get(record_id, 0))
+        return scores
+
+    def version(self, record_id, primary=False):
+        """ Returns the generation of the last write to a record (None if it has none) """
+        if self.router.shards:
+            client = self.router.node(record_id)
+        else:
+            client = self.redis if primary else self.router.reader()
+        version = client.hget(self.versions_key, record_id)
+        return int(version) if version is not None else None
+
+    def generation(self):
+        """ Returns the number of writes made to the records, which changes with any of them """
+        # each shard counts its own writes, so their sum changes with any of them
+        return sum(int(generation or 0) for generation in self.router.scatter(
+            lambda client: client.get(self.generation_key), self.router.nodes()))
+
+    def check_indexes(self, record_id=None, data=None):
+        """
+        Raises a DatabaseNotReadyError if a write needs the indexes before they are built
+
+        Args:
+            record_id (int): the id of the record written (None for a new one)
+            data (dict): the data written, only a change of a unique value
+                needs the indexes (None to always require them)
+        """
+        if self.__indexes_ready():
+            return
+        if data is None:
+            self.__require_indexes()
+            return
+        stored = self.__locate(record_id)[1] if record_id else None
+        changed = [attribute for attribute in self.unique if attribute in data and
+                   (stored is None or
+                    self.normalize(stored[attribute]) != self.normalize(data[attribute]))]
+        if changed:
+            self.__require_indexes()
+
+    def reindex(self):
+        """
+        Rebuilds all of the indexes from the stored records
+
+        It can run while the service is up: the indexes are repaired in
+        place rather than dropped, so the unique values stay unique and the
+        queries keep their results. The entries that their record no longer
+        matches are removed, and the records are indexed a batch at a time
+        in a transaction that WATCHes them and re-reads them, so a record
+        written or deleted meanwhile is indexed as it is stored. The indexes
+        are then marked as built, which lets every process take new unique
+        values.
+
+        Returns:
+            the number of records indexed
+
+        Raises:
+            DuplicateValueError listing the unique values that several
+            records have (the index keeps the first one that claimed it)
+        """
+        # the records with a later id may not be written yet
+        last_id = int(self.redis.get(self.sequence_key) or
+                      self.redis.get(RedisEngine.legacy_sequence_key) or 0)
+        count = 0
+        conflicts = []
+        for client in self.router.nodes(primary=True):
+            self.__prune_node(client)
+            # records written before versions existed get the current generation
+            generation = client.incr(self.generation_key)
+            for record_ids in self.__scan_ids(client):
+                indexed = self.__index_batch(client, record_ids, generation)
+                count += len(indexed)
+                refused = self.__claim_indexed(client, indexed)
+                if refused:
+                    conflicts.append((client, sorted(set(record_id for record_id, _, _, _
+                                                         in refused))))
+        # a value held by a stale entry is given to its record once it is pruned
+        self.__prune_unique(last_id)
+        duplicates = []
+        for client, record_ids in conflicts:
+            stored = zip(record_ids, self.__fetch(record_ids, client=client))
+            duplicates += self.__claim_indexed(
+                client, [(record_id, data) for record_id, data in stored if data])
+        self.redis.set(self.indexed_key, RedisEngine.index_layout)
+        self.indexes_built = True
+        if duplicates:
+            raise DuplicateValueError(duplicates)
+        return count
+
+    def migrate_keys(self, batch_size=None):
+        """
+        Moves the records stored under bare integer keys to '{prefix}:{id}'
+
+        The migration runs online: each batch of keys is moved with RENAMENX
+        so a record is always readable under one of its two keys, and the
+        SCAN cursor is saved after every batch so an interrupted migration
+        resumes where it stopped. The legacy counter is renamed once every
+        record has been moved.
+
+        Args:
+            batch_size (int): the number of keys to ask SCAN for per call
+
+        Returns:
+            the number of records moved
+        """
+        batch_size = batch_size or self.batch_size
+        cursor = int(self.redis.get(self.migration_key) or 0)
+        self.logger.info('Migrating the %s keys from cursor %d', self.key_prefix, cursor)
+        count = 0
+        while True:
+            cursor, keys = self.redis.scan(cursor, count=batch_size)
+            legacy = [key for key in keys if key.isdigit()]
+            if legacy:
+                pipe = self.redis.pipeline(transaction=False)
+                for key in legacy:
+                    pipe.renamenx(key, self.__key(key))
+                moved = pipe.execute(raise_on_error=False)
+                # a newer record was already written under the new key
+                stale = [key for key, result in zip(legacy, moved) if result is False]
+                if stale:
+                    self.redis.delete(*stale)
+                count += sum(1 for result in moved if result is True)
+            if cursor == 0:
+                break
+            self.redis.set(self.migration_key, cursor)
+
+        pipe = self.redis.pipeline()
+        if self.redis.exists(RedisEngine.legacy_sequence_key):
+            pipe.rename(RedisEngine.legacy_sequence_key, self.sequence_key)
+        pipe.delete(self.migration_key)
+        pipe.execute()
+        # the other processes notice within layout_check_interval seconds
+        self.legacy_keys = False
+        return count
+
+    def rebalance(self, batch_size=None):
+        """
+        Moves the records that are not on the shard the ring maps them to
+
+        Consistent hashing only maps the ids next to the points of a new
+        node to it, so about 1/N of the records move. Each one is copied
+        with its index entries to its shard (unless a newer write already
+        put it there) and then deleted with them from the node it was on,
+        so it can be read throughout. The generations are first raised to
+        the highest one, so a moved record never gets back a version it
+        had before.
+
+        Args:
+            batch_size (int): the number of keys to ask SCAN for per call
+
+        Returns:
+            the number of records moved
+        """
+        if not self.router.shards:
+            return 0
+        nodes = self.router.all_nodes()
+        generations = [int(generation or 0) for generation in self.router.scatter(
+            lambda client: client.get(self.generation_key), nodes)]
+        for client, generation in zip(nodes, generations):
+            if generation < max(generations):
+                client.incrby(self.generation_key, max(generations) - generation)
+        count = 0
+        for client in nodes:
+            for record_ids in self.__scan_ids(client, batch_size):
+                for record_id, data in zip(record_ids, self.__fetch(record_ids, client=client)):
+                    if data is not None and self.router.node(record_id) is not client:
+                        self.__move(record_id, data, client)
+                        count += 1
+        return count
+
+    def use_shards(self, nodes):
+        """
+        Spreads the records over Redis nodes by consistent hashing of their ids
+
+        Args:
+            nodes (list): the connections to the shards (empty to store all on the primary)
+        """
+        if nodes and self.legacy_keys:
+            raise ValueError('Records under bare integer keys must be migrated before sharding')
+        self.router.use_shards(nodes)
+
+    def listen(self, handle):
+        """
+        Calls handle with every event published on events_channel, forever
+
+        Every write publishes '{id}:{version}' ('{id}:' for a delete and
+        '*' when every record is deleted). Events sent while disconnected
+        are lost, so handle is called with '*' every time it subscribes.
+        When sharded, the channel is listened to on every node.
+        """
+        while True:
+            try:
+                pubsubs = []
+                for client in self.router.all_nodes():
+                    pubsub = client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.events_channel)
+                    pubsubs.append(pubsub)
+                handle('*')
+                while True:
+                    for pubsub in pubsubs:
+                        # polled so that a quiet channel does not hit the socket timeout
+                        message = pubsub.get_message(timeout=1.0 / len(pubsubs))
+                        if message is not None:
+                            handle(message['data'])
+            except (ConnectionError, TimeoutError):
+                self.logger.warning('Lost the connection to %s, resubscribing',
+                                    self.events_channel)
+                time.sleep(1)
+
+    def __fetch(self, record_ids, fields=None, client=None):
+        """
+        Loads the stored data for a list of ids in one round trip
+
+        Pickled records are strings and hash records are hashes, so every
+        key is read with both GET and HGETALL in the same pipeline and the
+        type of the key tells which codec it was written with. The command
+        that does not match the type returns a WRONGTYPE error that is
+        ignored, any other error is raised.
+        When fields are given, hash records only return those (HMGET).
+
+        Args:
+            record_ids (list): the ids of the records
+            fields (list): only load these fields, including the id
+            client (Redis): the connection to read from (the primary by default)
+
+        Returns:
+            a list with the data of each id (None if it does not exist)
+        """
+        self.__refresh_layout()
+        pipe = (client or self.redis).pipeline(transaction=False)
+        for record_id in record_ids:
+            key = self.__key(record_id)
+            pipe.get(key)
+            if fields:
+                pipe.hmget(key, ['_codec'] + fields)
+            else:
+                pipe.hgetall(key)
+            if self.legacy_keys:
+                pipe.get(record_id)
+        replies = pipe.execute(raise_on_error=False)
+        for reply in replies:
+            if isinstance(reply, ResponseError) and not str(reply).startswith('WRONGTYPE'):
+                raise reply
+        step = 3 if self.legacy_keys else 2
+        results = []
+        for i in range(0, len(replies), step):
+            data = self.__load(replies[i], replies[i + 1], fields)
+            if data is None and self.legacy_keys:
+                data = self.__load(replies[i + 2], None, fields)
+            results.append(data)
+        return results
+
+    def __load(self, pickled, stored, fields=None):
+        """
+        Decodes a record read as both a string and a hash (None if missing)
+
+        Args:
+            pickled (string): the reply to GET
+            stored (dict or list): the reply to HGETALL, or to HMGET of the
+                codec marker followed by the requested fields
+            fields (list): the fields requested with HMGET
+        """
+        if isinstance(stored, list):
+            if stored[0] is None:
+                return None  # no codec marker, so not a hash record
+            return self.__decode_hash(dict(zip(fields, stored[1:])))
+        if isinstance(stored, dict) and stored:
+            return self.__decode_hash(stored)
+        if isinstance(pickled, str):
+            data = pickle.loads(pickled)
+            if fields:
+                data = {field: data[field] for field in fields}
+            return data
+        return None
+
+    def __decode_hash(self, fields):
+        """ Decodes the fields of a Redis hash into record data """
+        data = dict.fromkeys(self.schema)
+        for attribute, value in fields.items():
+            if attribute not in self.schema or value is None:
+                continue  # codec marker or a field that is not set
+            value_type = self.schema[attribute]['type']
+            if value_type == 'integer':
+                value = int(value)
+            elif value_type == 'boolean':
+                value = value == 'true'
+            else:
+                value = value.decode('utf-8')
+            data[attribute] = value
+        return data
+
+    @staticmethod
+    def __encode_hash(data):
+        """ Encodes record data as the fields of a Redis hash """
+        fields = {'_codec': 'hash'}
+        for attribute, value in data.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            fields[attribute] = value
+        return fields
+
+    def __store(self, pipe, record_id, data):
+        """ Queues the write of a record with the configured codec """
+        key = self.__key(record_id)
+        if self.codec == 'pickle':
+            pipe.set(key, pickle.dumps(data))
+            return
+        # a hash can't overwrite a pickled string, and DEL drops unset fields
+        pipe.delete(key)
+        pipe.hmset(key, self.__encode_hash(data))
+
+    def __write(self, record_id, changes, replace=True, force=True):
+        """ Writes a record or some of its fields, returning its old and new data (None if gone) """
+        node = self.router.node(record_id)
+        claimed = self.__claim_unique(record_id, changes)
+
+        def write(pipe):
+            """ Writes the record and its index entries on its node """
+            old_data = indexed = self.__fetch([record_id], client=node)[0]
+            if old_data is None and not replace:
+                # a record that a rebalance has not moved yet is written to its shard
+                old_data = self.__locate(record_id)[1]
+                if old_data is None:
+                    return None, None
+            new_data = changes if replace else dict(old_data, **changes)
+            if not force and new_data == old_data:
+                return old_data, new_data
+            is_hash = indexed is not None and not replace and \
+                pipe.type(self.__key(record_id)) == 'hash'
+            pipe.multi()
+            if is_hash:
+                pipe.hmset(self.__key(record_id), self.__encode_hash(changes))
+            else:
+                self.__store(pipe, record_id, new_data)
+                if self.legacy_keys:
+                    pipe.delete(record_id)
+            self.__update_indexes(pipe, record_id, indexed, new_data, unique=False)
+            return old_data, new_data
+
+        try:
+            old_data, new_data = node.transaction(write, *self.__record_keys(record_id),
+                                                  value_from_callable=True)
+        except Exception:
+            self.__release_unique(record_id, claimed)
+            raise
+        if new_data is None:
+            self.__release_unique(record_id, claimed)
+            return None, None
+        self.__release_unique(record_id, self.__changed_unique(old_data, new_data))
+        return old_data, new_data
+
+    def __claim_unique(self, record_id, data):
+        """
+        Claims the unique values of a record in the indexes on the primary
+
+        Args:
+            record_id (int): the id of the record
+            data (dict): the record data (only its unique attributes are claimed)
+
+        Returns:
+            the (attribute, value) pairs that this call claimed
+
+        Raises:
+            DuplicateValueError if another record has one of the values
+        """
+        attributes = [attribute for attribute in self.unique if attribute in data]
+        pipe = self.redis.pipeline()
+        for attribute in attributes:
+            pipe.hsetnx(self.__index_key(attribute), self.normalize(data[attribute]), record_id)
+        for attribute in attributes:
+            pipe.hget(self.__index_key(attribute), self.normalize(data[attribute]))
+        replies = pipe.execute()
+        claimed = [(attribute, self.normalize(data[attribute]))
+                   for attribute, added in zip(attributes, replies) if added]
+        for attribute, owner in zip(attributes, replies[len(attributes):]):
+            if int(owner) != int(record_id):
+                self.__release_unique(record_id, claimed)
+                raise DuplicateValueError([(record_id, attribute, data[attribute], int(owner))])
+        return claimed
+
+    def __release_unique(self, record_id, values):
+        """ Removes (attribute, value) pairs from the unique indexes that still belong to a record """
+        if not values:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for attribute, value in values:
+            self.scripts['release'](keys=[self.__index_key(attribute)],
+                                    args=[value, record_id], client=pipe)
+        pipe.execute()
+
+    def __changed_unique(self, old_data, new_data):
+        """ Returns the (attribute, value) pairs a write takes from a record """
+        if not old_data:
+            return []
+        values = [(attribute, self.normalize(old_data[attribute])) for attribute in self.unique]
+        if new_data:
+            values = [(attribute, value) for attribute, value in values
+                      if value != self.normalize(new_data[attribute])]
+        return values
+
+    def __update_indexes(self, pipe, record_id, old_data, new_data, unique=True):
+        """
+        Queues the index changes for a record on a pipeline
+
+        Args:
+            pipe (Pipeline): the pipeline to queue the commands on
+            record_id (int): the id of the record
+            old_data (dict): the stored record data or None if it is new
+            new_data (dict): the record data to store or None if it is deleted
+            unique (bool): False to leave out the unique indexes (claimed
+                separately, and kept on the primary when sharded)
+        """
+        for attribute in (self.unique if unique else ()) + self.sets:
+            old_value = self.normalize(old_data[attribute]) if old_data else None
+            new_value = self.normalize(new_data[attribute]) if new_data else None
+            if old_value == new_value:
+                continue
+            if attribute in self.unique:
+                if old_value is not None:
+                    pipe.hdel(self.__index_key(attribute), old_value)
+                if new_value is not None:
+                    pipe.hset(self.__index_key(attribute), new_value, record_id)
+            else:
+                if old_value is not None:
+                    pipe.zrem(self.__set_key(attribute, old_value), record_id)
+                if new_value is not None:
+                    pipe.zadd(self.__set_key(attribute, new_value), {record_id: record_id})
+        for attribute in self.prefixes:
+            old_member = self.__lex_member(old_data[attribute], record_id) if old_data else None
+            new_member = self.__lex_member(new_data[attribute], record_id) if new_data else None
+            if old_member == new_member:
+                continue
+            if old_member is not None:
+                pipe.zrem(self.__lex_key(attribute), old_member)
+            if new_member is not None:
+                pipe.zadd(self.__lex_key(attribute), {new_member: 0})
+        old_ngrams = self.ngrams(old_data)
+        new_ngrams = self.ngrams(new_data)
+        for ngram in old_ngrams - new_ngrams:
+            pipe.srem(self.__ngram_key(ngram), record_id)
+        for ngram in new_ngrams - old_ngrams:
+            pipe.sadd(self.__ngram_key(ngram), record_id)
+        if new_data:
+            pipe.zadd(self.ids_key, {record_id: record_id})
+            self.scripts['bump_version'](keys=[self.versions_key, self.generation_key],
+                                         args=[record_id, self.events_channel], client=pipe)
+        elif old_data:
+            pipe.zrem(self.ids_key, record_id)
+            pipe.hdel(self.versions_key, record_id)
+            pipe.incr(self.generation_key)
+            pipe.publish(self.events_channel, '{}:'.format(record_id))
+
+    def __key(self, record_id):
+        """ Returns the Redis key of a record """
+        return '{}:{}'.format(self.key_prefix, record_id)
+
+    def __key_to_id(self, key):
+        """ Returns the id of the record stored under a Redis key (None if not a record) """
+        start = len(self.key_prefix) + 1
+        if key.startswith(self.key_prefix + ':') and key[start:].isdigit():
+            return int(key[start:])
+        if self.legacy_keys and key.isdigit():
+            return int(key)
+        return None
+
+    def __record_keys(self, record_id):
+        """ Returns the keys a write to a record must WATCH """
+        return self.__batch_keys([record_id])
+
+    def __batch_keys(self, record_ids):
+        """ Returns the keys a write to a batch of records must WATCH """
+        keys = [self.__key(record_id) for record_id in record_ids]
+        if self.legacy_keys:
+            keys += [str(record_id) for record_id in record_ids]
+        return keys
+
+    def __index_key(self, attribute):
+        """ Returns the Redis key of the unique index for an attribute """
+        return '{}:{}'.format(self.key_prefix, attribute)
+
+    def __set_key(self, attribute, value):
+        """ Returns the Redis key of the sorted id set for an attribute value """
+        return '{}:{}:{}'.format(self.key_prefix, attribute, self.normalize(value))
+
+    def __lex_key(self, attribute):
+        """ Returns the Redis key of the lexicographical index for an attribute """
+        return '{}:lex:{}'.format(self.key_prefix, attribute)
+
+    def __lex_member(self, value, record_id):
+        """ Returns the member of the lexicographical index for a record """
+        return '{}\x00{}'.format(self.normalize(value), record_id)
+
+    def __ngram_key(self, ngram):
+        """ Returns the Redis key of the id set for a trigram """
+        return '{}:ngram:{}'.format(self.key_prefix, ngram)
+
+    def __locate(self, record_id, fields=None, client=None):
+        """ Loads a record from the node it is on, returning the node and its data (or None) """
+        return self.router.locate(
+            record_id, lambda node: self.__fetch([record_id], fields, node)[0], client)
+
+    def __is_stray(self, record_id, client):
+        """ Returns True for a copy of a record left on another node than its shard """
+        owner = self.router.node(record_id)
+        return owner is not client and bool(owner.exists(self.__key(record_id)))
+
+    def __scan_node(self, client, batch_size=None, fields=None):
+        """ Generator that yields the data of the records stored on a node """
+        for record_ids in self.__scan_ids(client, batch_size):
+            for record_id, data in zip(record_ids, self.__fetch(record_ids, fields, client)):
+                if data is not None and \
+                        not (self.router.shards and self.__is_stray(record_id, client)):
+                    yield data
+
+    def __scan_ids(self, client, batch_size=None):
+        """ Generator that yields the ids of the records stored on a node, a SCAN call at a time """
+        self.__refresh_layout()
+        # bare integer keys can only be found by walking the whole keyspace
+        match = None if self.legacy_keys else self.key_prefix + ':[0-9]*'
+        seen = set()
+        cursor = 0
+        while True:
+            cursor, keys = client.scan(cursor, match=match, count=batch_size or self.batch_size)
+            record_ids = [self.__key_to_id(key) for key in keys]
+            record_ids = [record_id for record_id in record_ids
+                          if record_id is not None and record_id not in seen]
+            if self.legacy_keys:
+                # a record moved by the migration can be returned twice
+                seen.update(record_ids)
+            if record_ids:
+                yield record_ids
+            if cursor == 0:
+                break
+
+    def __ids_matching(self, filters, client, cursor=None, limit=None):
+        """
+        Returns the sorted ids of the records on a node that match all of the filters
+
+        The ids come from the indexes alone: the unique indexes narrow the
+        result to a single id which is checked against the id sets with
+        ZSCORE, otherwise the smallest id set is walked from the cursor by
+        __walk_ids. When sharded, the unique indexes are read from the
+        primary and the id sets from the shard, which must also hold the record.
+
+        Args:
+            filters (dict): the indexed attributes and the values to match
+            client (Redis): the connection to read from
+            cursor (int): only return the ids after this one
+            limit (int): the maximum number of ids to return (all by default)
+        """
+        unique = [(attribute, value) for attribute, value in filters.items()
+                  if attribute in self.unique]
+        set_keys = [self.__set_key(attribute, value) for attribute, value in filters.items()
+                    if attribute in self.sets]
+        if not unique and not set_keys:
+            low = '({}'.format(cursor) if cursor is not None else '-inf'
+            return client.zrangebyscore(self.ids_key, low, '+inf',
+                                        start=0 if limit else None, num=limit)
+
+        pipe = client.pipeline(transaction=False)
+        # the unique indexes are on the primary when the records are sharded
+        lookup = self.redis.pipeline(transaction=False) if self.router.shards else pipe
+        for attribute, value in unique:
+            lookup.hget(self.__index_key(attribute), self.normalize(value))
+        for key in set_keys:
+            pipe.zcard(key)
+        replies = pipe.execute()
+        if lookup is not pipe:
+            replies = lookup.execute() + replies
+        owners = set(replies[:len(unique)])
+        sizes = replies[len(unique):]
+        if None in owners or len(owners) > 1 or 0 in sizes:
+            return []
+
+        if owners:
+            record_id = int(owners.pop())
+            if cursor is not None and record_id <= cursor:
+                return []
+            pipe = client.pipeline(transaction=False)
+            for key in set_keys:
+                pipe.zscore(key, record_id)
+            if self.router.shards:
+                pipe.exists(self.__key(record_id))
+            replies = pipe.execute()
+            scores, stored = replies[:len(set_keys)], replies[len(set_keys):]
+            return [record_id] if None not in scores and all(stored) else []
+        set_keys = [key for _, key in sorted(zip(sizes, set_keys))]
+        return self.__walk_ids(client, set_keys, cursor, limit)
+
+    def __walk_ids(self, client, keys, cursor=None, limit=None):
+        """
+        Returns the ids of the first sorted id set that are in all of the others
+
+        The first set is read from the cursor with ZRANGEBYSCORE a chunk at
+        a time and each chunk is checked against the other sets with ZSCORE,
+        so a page costs O(log N + limit) plus the ids the other sets reject.
+
+        Args:
+            client (Redis): the node the sorted id sets are on
+            keys (list): the keys of the sorted id sets, the smallest first
+            cursor (int): only return the ids after this one
+            limit (int): the maximum number of ids to return (all by default)
+        """
+        found = []
+        low = '({}'.format(cursor) if cursor is not None else '-inf'
+        while limit is None or len(found) < limit:
+            num = min(limit - len(found), self.batch_size) if limit else self.batch_size
+            chunk = client.zrangebyscore(keys[0], low, '+inf', start=0, num=num)
+            matching = chunk
+            if len(keys) > 1 and chunk:
+                pipe = client.pipeline(transaction=False)
+                for record_id in chunk:
+                    for key in keys[1:]:
+                        pipe.zscore(key, record_id)
+                scores = pipe.execute()
+                step = len(keys) - 1
+                matching = [record_id for i, record_id in enumerate(chunk)
+                            if None not in scores[i * step:(i + 1) * step]]
+            found += [int(record_id) for record_id in matching]
+            if len(chunk) < num:
+                break
+            low = '({}'.format(chunk[-1])
+        return found
+
+    def __index_batch(self, client, record_ids, generation):
+        """
+        Adds the index entries of a batch of records on the node that stores them
+
+        The records are WATCHed and re-read, so the entries are those of the
+        stored records even if one was written or deleted since the SCAN.
+        The unique values are claimed by __claim_indexed afterwards.
+
+        Args:
+            client (Redis): the node the records are stored on
+            record_ids (list): the ids of the records
+            generation (int): the version of the records that have none
+
+        Returns:
+            the (id, data) pairs of the records that were indexed
+        """
+        indexed = []
+
+        def index(pipe):
+            """ Re-reads the records and queues their index entries """
+            del indexed[:]  # reset when the WATCH fires
+            stored = self.__fetch(record_ids, client=client)
+            pipe.multi()
+            for record_id, data in zip(record_ids, stored):
+                if data is None:
+                    continue  # deleted since the SCAN
+                indexed.append((record_id, data))
+                for attribute in self.sets:
+                    pipe.zadd(self.__set_key(attribute, data[attribute]), {record_id: record_id})
+                for attribute in self.prefixes:
+                    pipe.zadd(self.__lex_key(attribute),
+                              {self.__lex_member(data[attribute], record_id): 0})
+                for ngram in self.ngrams(data):
+                    pipe.sadd(self.__ngram_key(ngram), record_id)
+                pipe.zadd(self.ids_key, {record_id: record_id})
+                pipe.hsetnx(self.versions_key, record_id, generation)
+
+        client.transaction(index, *self.__batch_keys(record_ids))
+        return indexed
+
+    def __claim_indexed(self, client, indexed):
+        """
+        Claims the unique values of indexed records on the primary
+
+        A value is only added if no record has it, and the values added for
+        a record that has changed since it was read are given back, so no
+        entry outlives a concurrent write.
+
+        Args:
+            client (Redis): the node the records were read from
+            indexed (list): the (id, data) pairs of the records
+
+        Returns:
+            the (id, attribute, value, owner) of the values another record has
+        """
+        if not indexed:
+            return []
+        pipe = self.redis.pipeline()
+        for record_id, data in indexed:
+            for attribute in self.unique:
+                value = self.normalize(data[attribute])
+                pipe.hsetnx(self.__index_key(attribute), value, record_id)
+                pipe.hget(self.__index_key(attribute), value)
+        replies = iter(pipe.execute())
+        added = {}
+        refused = []
+        for record_id, data in indexed:
+            for attribute in self.unique:
+                claimed, owner = next(replies), next(replies)
+                if claimed:
+                    added.setdefault(record_id, []).append(
+                        (attribute, self.normalize(data[attribute])))
+                elif int(owner) != record_id:
+                    refused.append((record_id, attribute, data[attribute], int(owner)))
+        record_ids = sorted(added)
+        for record_id, data in zip(record_ids, self.__fetch(record_ids, client=client)):
+            if data is None:
+                data = self.__locate(record_id)[1]  # moved by a rebalance
+            self.__release_unique(record_id, [
+                (attribute, indexed_value) for attribute, indexed_value in added[record_id]
+                if data is None or self.normalize(data[attribute]) != indexed_value])
+        return refused
+
+    def __prune_node(self, client):
+        """ Removes the index entries on a node that their record no longer matches """
+        batch_size = self.batch_size
+        stored = lambda member, data: data is not None
+        self.__prune(client, self.ids_key,
+                     ((member, int(member)) for member, _
+                      in client.zscan_iter(self.ids_key, count=batch_size)),
+                     stored, 'zrem')
+        self.__prune(client, self.versions_key,
+                     ((field, int(field)) for field, _
+                      in client.hscan_iter(self.versions_key, count=batch_size)),
+                     stored, 'hdel')
+        for attribute in self.sets:
+            prefix = '{}:{}:'.format(self.key_prefix, attribute)
+            for key in client.scan_iter(prefix + '*', count=batch_size):
+                self.__prune(client, key,
+                             ((member, int(member)) for member, _
+                              in client.zscan_iter(key, count=batch_size)),
+                             lambda member, data, attribute=attribute, value=key[len(prefix):]:
+                             data is not None and self.normalize(data[attribute]) == value,
+                             'zrem')
+        for attribute in self.prefixes:
+            key = self.__lex_key(attribute)
+            self.__prune(client, key,
+                         ((member, int(member.rsplit('\x00', 1)[1])) for member, _
+                          in client.zscan_iter(key, count=batch_size)),
+                         lambda member, data, attribute=attribute: data is not None and
+                         self.normalize(data[attribute]) == member.rsplit('\x00', 1)[0],
+                         'zrem')
+        prefix = self.__ngram_key('')
+        for key in client.scan_iter(prefix + '*', count=batch_size):
+            self.__prune(client, key,
+                         ((member, int(member)) for member
+                          in client.sscan_iter(key, count=batch_size)),
+                         lambda member, data, ngram=key[len(prefix):]: ngram in self.ngrams(data),
+                         'srem')
+
+    def __prune_unique(self, last_id):
+        """ Removes the unique values that the records up to last_id no longer have """
+        for attribute in self.unique:
+            key = self.__index_key(attribute)
+            entries = ((value, int(owner)) for value, owner
+                       in self.redis.hscan_iter(key, count=self.batch_size)
+                       if int(owner) <= last_id)
+            valid = lambda value, data, attribute=attribute: data is not None and \
+                self.normalize(data[attribute]) == value
+            if not self.router.shards:
+                self.__prune(self.redis, key, entries, valid, 'hdel', owned=True)
+                continue
+            for value, record_id in entries:
+                if valid(value, self.__locate(record_id)[1]):
+                    continue
+                self.__release_unique(record_id, [(attribute, value)])
+                if valid(value, self.__locate(record_id)[1]):
+                    self.redis.hsetnx(key, value, record_id)
+
+    def __prune(self, client, key, entries, valid, command, owned=False):
+        """ Removes the (member, id) entries of an index whose record is not valid() for them """
+        def drop(batch):
+            """ Removes the members of a batch that their record does not match """
+            stored = self.__fetch([record_id for _, record_id in batch], client=client)
+            stale = [(member, record_id) for (member, record_id), data in zip(batch, stored)
+                     if not valid(member, data)]
+            if not stale:
+                return
+
+            def remove(pipe):
+                """ Re-reads the records and removes the members they still don't match """
+                current = stale
+                if owned:
+                    # a value that has gone to another record is not stale
+                    owners = pipe.hmget(key, [member for member, _ in stale])
+                    current = [(member, record_id) for (member, record_id), owner
+                               in zip(stale, owners) if owner == str(record_id)]
+                stored = self.__fetch([record_id for _, record_id in current], client=client)
+                members = [member for (member, _), data in zip(current, stored)
+                           if not valid(member, data)]
+                pipe.multi()
+                if members:
+                    getattr(pipe, command)(key, *members)
+
+            keys = self.__batch_keys([record_id for _, record_id in stale])
+            client.transaction(remove, *(keys + [key] if owned else keys))
+
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == self.batch_size:
+                drop(batch)
+                batch = []
+        if batch:
+            drop(batch)
+
+    def __move(self, record_id, data, source):
+        """ Copies a record to its shard, then deletes it from the node it was on """
+        key = self.__key(record_id)
+
+        def copy(pipe):
+            """ Writes the record unless its shard already has a newer copy """
+            exists = pipe.exists(key)
+            pipe.multi()
+            if not exists:
+                self.__store(pipe, record_id, data)
+                self.__update_indexes(pipe, record_id, None, data, unique=False)
+
+        def drop(pipe):
+            """ Deletes the record and its index entries from the node it was on """
+            old_data = self.__fetch([record_id], client=source)[0]
+            pipe.multi()
+            pipe.delete(key)
+            self.__update_indexes(pipe, record_id, old_data, None, unique=False)
+
+        self.router.node(record_id).transaction(copy, key)
+        source.transaction(drop, key)
+
+    def __check_key_layout(self):
+        """ Falls back to the bare integer keys until they have been migrated and checks the indexes """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(RedisEngine.legacy_sequence_key)
+        pipe.exists(self.sequence_key)
+        pipe.get(self.indexed_key)
+        legacy, numbered, indexed = pipe.execute()
+        if not legacy and not numbered and indexed is None:
+            # a new database has no records to index
+            self.redis.setnx(self.indexed_key, RedisEngine.index_layout)
+            indexed = self.redis.get(self.indexed_key)
+        self.legacy_keys = bool(legacy)
+        self.indexes_built = indexed == str(RedisEngine.index_layout)
+        self.__layout_checked = time.time()
+        if self.legacy_keys:
+            self.logger.warning('The %s records are stored under bare integer keys, '
+                                'run "python manage.py migrate" to move them', self.key_prefix)
+        if not self.indexes_built:
+            self.logger.warning('The %s indexes are not built, '
+                                'run "python manage.py reindex"', self.key_prefix)
+
+    def __refresh_layout(self):
+        """ Notices a key migration or a reindex that has finished in any process """
+        if self.indexes_built and not self.legacy_keys or \
+                time.time() < self.__layout_checked + self.layout_check_interval:
+            return
+        self.__layout_checked = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(RedisEngine.legacy_sequence_key)
+        pipe.get(self.indexed_key)
+        legacy, indexed = pipe.execute()
+        # the migration renames the legacy counter last, and the layout never goes back
+        if self.legacy_keys and not legacy:
+            self.legacy_keys = False
+            self.logger.info('The %s keys have been migrated', self.key_prefix)
+        if not self.indexes_built and indexed == str(RedisEngine.index_layout):
+            self.indexes_built = True
+            self.logger.info('The %s indexes have been built', self.key_prefix)
+
+    def __indexes_ready(self):
+        """ Returns True once the indexes have been built """
+        self.__refresh_layout()
+        return self.indexes_built
+
+    def __require_indexes(self):
+        """ Raises a DatabaseNotReadyError until the indexes have been built """
+        if not self.__indexes_ready():
+            raise DatabaseNotReadyError('The indexes are being built, '
+                                        'try again once "python manage.py reindex" has run')
+
+
+class _IndexRecorder(object):
+    """ Stands in for a pipeline to collect the index commands of a record """
+
+    def __init__(self):
+        self.commands = []
+
+    def __getattr__(self, command):
+        def record(key, *args):
+            """ Records a command on a key """
+            self.commands.append((command, key, args))
+        return record
@@ -1,3 +1,58 @@
+import os
 import logging
 SECRET_KEY = 'secret-for-dev'
 LOGGING_LEVEL = logging.INFO
+
+# Number of Customers fetched from Redis per pipeline / SCAN call
+REDIS_BATCH_SIZE = int(os.getenv('REDIS_BATCH_SIZE', '500'))
+
+# Where the Customers are stored: 'redis', or 'memory' to keep them in the
+# process (for tests and single process deployments without Redis)
+STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', 'redis')
+
+# How Customers are written to Redis: 'hash' or 'pickle' (both can be read)
+STORAGE_CODEC = os.getenv('STORAGE_CODEC', 'hash')
+
+# Number of Customers on a page of GET /customers when no limit is given
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '100'))
+
+# Number of Customers returned by GET /customers/search by default and at most
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', '10'))
+MAX_SEARCH_LIMIT = int(os.getenv('MAX_SEARCH_LIMIT', '100'))
+
+# Seconds to pause between the batches of a bulk update (throttles PUT /customers/bulk)
+BULK_UPDATE_PAUSE = float(os.getenv('BULK_UPDATE_PAUSE', '0'))
+
+# Number of Customers cached in each process by GET /customers/{id} (0 disables
+# the cache) and the seconds a cached Customer stays valid
+CUSTOMER_CACHE_SIZE = int(os.getenv('CUSTOMER_CACHE_SIZE', '0'))
+CUSTOMER_CACHE_TTL = float(os.getenv('CUSTOMER_CACHE_TTL', '30'))
+
+# Number of GET /customers results cached in each process (0 disables the cache),
+# the seconds a result stays valid and whether results are also shared in Redis
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '0'))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '60'))
+QUERY_CACHE_REDIS = os.getenv('QUERY_CACHE_REDIS', 'false').lower() == 'true'
+
+# Redis connection pool: the maximum number of connections, the seconds to wait
+# for a free one, the socket timeouts in seconds, TCP keepalive and the number
+# of connections opened when the service starts
+REDIS_POOL_SIZE = int(os.getenv('REDIS_POOL_SIZE', '50'))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', '2'))
+REDIS_KEEPALIVE = os.getenv('REDIS_KEEPALIVE', 'true').lower() == 'true'
+REDIS_POOL_WARM = int(os.getenv('REDIS_POOL_WARM', '2'))
+
+# Read replica for the queries (none by default) and the seconds after a write
+# during which the client that wrote reads from the primary instead
+REDIS_REPLICA_HOST = os.getenv('REDIS_REPLICA_HOST')
+REDIS_REPLICA_PORT = int(os.getenv('REDIS_REPLICA_PORT', '6379'))
+REDIS_REPLICA_PASSWORD = os.getenv('REDIS_REPLICA_PASSWORD')
+READ_YOUR_WRITES_WINDOW = int(os.getenv('READ_YOUR_WRITES_WINDOW', '5'))
+
+# Comma separated redis:// URLs of the nodes the Customers are spread over by
+# consistent hashing of their ids (none to store them all on the primary, which
+# always keeps the id counter and the unique indexes). Run
+# "python manage.py rebalance" after adding a node.
+REDIS_SHARDS = [url.strip() for url in os.getenv('REDIS_SHARDS', '').split(',') if url.strip()]
@@ -0,0 +1,62 @@
+"""
+Customer Service Management Commands
+
+Maintenance tasks that run against the Customer database
+
+Usage:
+  python manage.py migrate
+  python manage.py reindex
+  python manage.py rebalance
+"""
+
+import sys
+import argparse
+from app import server
+from app.models import Customer
+from app.custom_exceptions import DataValidationError
+
+
+######################################################################
+#   C O M M A N D S
+######################################################################
+def reindex(args):
+    """ Rebuilds all of the Customer indexes, failing if usernames or emails are shared """
+    try:
+        count = Customer.reindex()
+    except DataValidationError as error:
+        print 'Reindexed the customers, but {}'.format(error)
+        sys.exit(1)
+    print 'Reindexed {} customers'.format(count)
+
+
+def migrate(args):
+    """ Moves Customers from bare integer keys to the customer namespace """
+    count = Customer.migrate_keys(args.batch_size)
+    print 'Migrated {} customers'.format(count)
+
+
+def rebalance(args):
+    """ Moves Customers to the shards they belong on after adding a node """
+    count = Customer.rebalance(args.batch_size)
+    print 'Moved {} customers'.format(count)
+
+
+COMMANDS = {
+    'migrate': migrate,
+    'rebalance': rebalance,
+    'reindex': reindex
+}
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Customer Service management commands')
+    parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='number of keys to process per Redis call')
+    args = parser.parse_args()
+    server.initialize_logging()
+    server.init_db()
+    COMMANDS[args.command](args)
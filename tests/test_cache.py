@@ -0,0 +1,135 @@
+"""
+Test cases for the Customer caches
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from mock import patch
+from redis import Redis
+from app.cache import LRUCache, QueryCache
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the LRU Cache """
+
+    def test_get_and_put(self):
+        """ Cache a value and read it back """
+        cache = LRUCache(2)
+        self.assertEqual(cache.get(1), None)
+        cache.put(1, {'username': 'jf'})
+        self.assertEqual(cache.get(1), {'username': 'jf'})
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_peek(self):
+        """ Peek at a value without counting it or making it recently used """
+        cache = LRUCache(2)
+        self.assertEqual(cache.peek(1), None)
+        cache.put(1, 'one')
+        cache.put(2, 'two')
+        self.assertEqual(cache.peek(1), 'one')
+        cache.put(3, 'three')
+        self.assertEqual(cache.peek(1), None)
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the entry that was used least recently """
+        cache = LRUCache(2)
+        cache.put(1, 'one')
+        cache.put(2, 'two')
+        cache.get(1)
+        cache.put(3, 'three')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 'one')
+        self.assertEqual(cache.get(3), 'three')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expires_entries(self):
+        """ Expire an entry after its time to live """
+        cache = LRUCache(2, ttl=10)
+        with patch('app.cache.time.time', return_value=100):
+            cache.put(1, 'one')
+        with patch('app.cache.time.time', return_value=109):
+            self.assertEqual(cache.get(1), 'one')
+        with patch('app.cache.time.time', return_value=110):
+            self.assertEqual(cache.get(1), None)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_clear(self):
+        """ Remove entries from the cache """
+        cache = LRUCache(3)
+        cache.put(1, 'one')
+        cache.put(2, 'two')
+        cache.invalidate(1)
+        cache.invalidate(4)
+        self.assertEqual(cache.get(1), None)
+        cache.clear()
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_put_skips_values_read_before_an_invalidation(self):
+        """ Drop a value whose key was invalidated after it was read """
+        cache = LRUCache(2)
+        epoch = cache.epoch()
+        cache.invalidate(1)
+        self.assertFalse(cache.put(1, 'stale', epoch))
+        self.assertTrue(cache.put(2, 'two', epoch))
+        self.assertEqual(cache.get(1), None)
+        self.assertTrue(cache.put(1, 'one', cache.epoch()))
+        # once the invalidation of a key is forgotten, every older read is dropped
+        epoch = cache.epoch()
+        for key in (3, 4, 5):
+            cache.invalidate(key)
+        self.assertFalse(cache.put(2, 'two', epoch))
+        self.assertTrue(cache.put(2, 'two'))
+        epoch = cache.epoch()
+        cache.clear()
+        self.assertFalse(cache.put(6, 'six', epoch))
+
+
+class TestQueryCache(unittest.TestCase):
+    """ Test Cases for the Query Cache """
+
+    def setUp(self):
+        self.redis = Redis(host='127.0.0.1', port=6379)
+        for key in self.redis.scan_iter('test:query:*'):
+            self.redis.delete(key)
+
+    def test_results_are_kept_per_generation(self):
+        """ Cache the result of a query for a generation """
+        cache = QueryCache(10)
+        cache.put(1, 'active=true', {'body': '[]'})
+        self.assertEqual(cache.get(1, 'active=true'), {'body': '[]'})
+        self.assertEqual(cache.get(2, 'active=true'), None)
+        self.assertEqual(cache.get(1, 'active=false'), None)
+
+    def test_results_are_shared_in_redis(self):
+        """ Read the results cached by another process from Redis """
+        QueryCache(10, 60, self.redis, 'test:query:').put(1, 'q', {'body': '[]', 'link': '<next>'})
+        cache = QueryCache(10, 60, self.redis, 'test:query:')
+        self.assertEqual(cache.get(1, 'q'), {'body': '[]', 'link': '<next>'})
+        self.assertEqual(cache.get(1, 'q'), {'body': '[]', 'link': '<next>'})
+        self.assertEqual(cache.get(2, 'q'), None)
+        self.assertEqual(cache.stats()['redis_hits'], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        key, = self.redis.keys('test:query:1:*')
+        self.assertTrue(0 < self.redis.ttl(key) <= 60)
+
+    def test_shared_results_need_a_ttl(self):
+        """ Refuse to share results in Redis without a time to live """
+        self.assertRaises(ValueError, QueryCache, 10, None, self.redis)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
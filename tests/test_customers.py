@@ -7,13 +7,17 @@ Test cases can be run with:
 """
 
 import unittest
+import time
 import os
 import json
-from mock import patch
-from redis import Redis, ConnectionError
+import pickle
+from mock import patch, MagicMock
+from redis import Redis, ConnectionError, ResponseError
+from redis.client import Pipeline
 from werkzeug.exceptions import NotFound
 from app.models import Customer
-from app.custom_exceptions import DataValidationError
+from app.cache import LRUCache
+from app.custom_exceptions import DataValidationError, DatabaseNotReadyError
 from app import server
 
 VCAP_SERVICES = os.getenv('VCAP_SERVICES', None)
@@ -21,6 +25,15 @@ if not VCAP_SERVICES:
      VCAP_SERVICES = '{"rediscloud": [{"credentials": {' \
                      '"password": "", "hostname": "127.0.0.1", "port": "6379"}}]}'
 
+# the storage engine the Customers are tested on ('redis' or 'memory')
+ENGINE = os.getenv('STORAGE_ENGINE', 'redis')
+REDIS_ONLY = unittest.skipIf(ENGINE != 'redis', 'tests the Redis storage engine')
+
+
+def pickle_codec():
+    """ Stores the new Customers with the pickle codec """
+    return patch.object(Customer.engine, 'codec', 'pickle', create=ENGINE != 'redis')
+
 
 ######################################################################
 #  T E S T   C A S E S
@@ -30,6 +43,7 @@ class TestCustomers(unittest.TestCase):
 
     def setUp(self):
         """ Initialize the Redis database """
+        Customer.configure(engine=ENGINE)
         Customer.init_db()
         Customer.remove_all()
         # Customer.init_db(Redis(host='127.0.0.1', port=6379))
@@ -194,6 +208,42 @@ class TestCustomers(unittest.TestCase):
         self.assertEqual(customer.active, True)
         self.assertEqual(customer.promo, True)
 
+    def test_iterate_all_customers(self):
+        """ Iterate over all Customers a small batch at a time """
+        for i in range(7):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=True, promo=False).save()
+
+        customers = Customer.iter_all(batch_size=2)
+        self.assertFalse(isinstance(customers, list))
+        usernames = sorted(customer.username for customer in customers)
+        self.assertEqual(usernames, ['user%d' % i for i in range(7)])
+
+    @REDIS_ONLY
+    @patch.object(Customer, 'batch_size', 2)
+    def test_find_by_lastname_in_batches(self):
+        """ Fetch more Customers than fit in one batch """
+        for i in range(5):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=True, promo=False).save()
+
+        with patch.object(Customer.redis, 'pipeline', wraps=Customer.redis.pipeline) as pipeline:
+            customers = Customer.find_by_lastname('yang')
+        self.assertEqual(len(customers), 5)
+        # one for the index lookup and one per batch of 2
+        self.assertEqual(pipeline.call_count, 4)
+
+    def test_configure_batch_size(self):
+        """ Configure the bulk read batch size """
+        batch_size = Customer.batch_size
+        Customer.configure(batch_size='50')
+        self.assertEqual(Customer.batch_size, 50)
+        Customer.configure(batch_size=batch_size)
+
     def test_find_customer(self):
         """ Find a Customer by ID """
         customer1 = Customer(username='jf',
@@ -377,6 +427,931 @@ class TestCustomers(unittest.TestCase):
         self.assertEqual(customers[0].active, False)
         self.assertEqual(customers[0].promo, True)
 
+    def test_find_by_username_is_case_insensitive(self):
+        """ Find a Customer by username ignoring case """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+
+        customers = Customer.find_by_username("JF")
+        self.assertEqual(len(customers), 1)
+        self.assertEqual(customers[0].username, "jf")
+        self.assertEqual(Customer.find_by_username("ms"), [])
+
+    def test_save_duplicate_username(self):
+        """ Save a Customer with a username that is already taken """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        customer = Customer(username='JF', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=True, promo=True)
+        self.assertRaises(DataValidationError, customer.save)
+        self.assertEqual(customer.id, 0)
+        self.assertEqual(len(Customer.all()), 1)
+
+    def test_save_duplicate_email(self):
+        """ Save a Customer with an email that is already taken """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='JY2296@nyu.edu', active=True, promo=True)
+        self.assertRaises(DataValidationError, customer.save)
+        self.assertEqual(Customer.find_by_username('ms'), [])
+
+    @REDIS_ONLY
+    def test_save_claims_unique_values_without_watching_the_indexes(self):
+        """ Save Customers without WATCHing the username and email indexes """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        with patch('redis.client.Pipeline.watch', autospec=True,
+                   side_effect=Pipeline.watch) as watch:
+            customer.save()
+            customer.username = 'yjf'
+            customer.save()
+            Customer.update_fields(customer.id, {'email': 'yjf@nyu.edu'})
+        watched = [key for call in watch.call_args_list for key in call[0][1:]]
+        self.assertEqual(set(watched), set(['customer:1']))
+        self.assertEqual(Customer.redis.hgetall('customer:username'), {'yjf': '1'})
+        self.assertEqual(Customer.redis.hgetall('customer:email'), {'yjf@nyu.edu': '1'})
+
+    def test_update_moves_unique_index(self):
+        """ Change a username and email and find it by the new values """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        customer.username = 'yjf'
+        customer.email = 'yjf@nyu.edu'
+        customer.save()
+
+        self.assertEqual(Customer.find_by_username('jf'), [])
+        self.assertEqual(Customer.find_by_email('jy2296@nyu.edu'), [])
+        self.assertEqual(Customer.find_by_username('yjf')[0].id, customer.id)
+        self.assertEqual(Customer.find_by_email('yjf@nyu.edu')[0].id, customer.id)
+
+        # the old username is free to be used again
+        Customer(username='jf', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=True).save()
+        self.assertEqual(len(Customer.find_by_username('jf')), 1)
+
+    def test_delete_removes_unique_index(self):
+        """ Delete a Customer and make sure it can't be found by username """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        customer.delete()
+        self.assertEqual(Customer.find_by_username('jf'), [])
+        self.assertEqual(Customer.find_by_email('jy2296@nyu.edu'), [])
+
+    def test_find_by_lastname_is_case_insensitive(self):
+        """ Find Customers by lastname ignoring case """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='Yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        Customer(username='jfy2', password='1234567',
+                 firstname='jinfan', lastname='yang',
+                 address='eastvillage', phone='123-456-7890',
+                 email='jfy@nyu.edu', active=True, promo=False).save()
+
+        customers = Customer.find_by_lastname("YANG")
+        self.assertEqual(len(customers), 2)
+        self.assertEqual(customers[0].username, 'jf')
+        self.assertEqual(customers[1].username, 'jfy2')
+
+    def test_update_moves_set_index(self):
+        """ Change a lastname and find it by the new value only """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        customer.firstname = 'mary'
+        customer.lastname = 'sue'
+        customer.save()
+
+        self.assertEqual(Customer.find_by_lastname('yang'), [])
+        self.assertEqual(Customer.find_by_firstname('jinfan'), [])
+        self.assertEqual(Customer.find_by_lastname('sue')[0].id, customer.id)
+        self.assertEqual(Customer.find_by_firstname('mary')[0].id, customer.id)
+
+        customer.delete()
+        self.assertEqual(Customer.find_by_lastname('sue'), [])
+        self.assertEqual(Customer.find_by_firstname('mary'), [])
+
+    def test_count_by_active_and_promo(self):
+        """ Count Customers by status and promo from the indexes """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=False, promo=True).save()
+        self.assertEqual(Customer.count_by_active(True), 1)
+        self.assertEqual(Customer.count_by_active(False), 1)
+        self.assertEqual(Customer.count_by_promo(True), 1)
+
+        # flipping the flags moves the id between the index sets
+        customer.active = False
+        customer.promo = True
+        customer.save()
+        self.assertEqual(Customer.count_by_active(True), 0)
+        self.assertEqual(Customer.count_by_active(False), 2)
+        self.assertEqual(Customer.count_by_promo(True), 2)
+        self.assertEqual(Customer.count_by_promo(False), 0)
+        self.assertEqual(len(Customer.find_by_active(False)), 2)
+        self.assertEqual(Customer.find_by_active(True), [])
+
+    @REDIS_ONLY
+    def test_reindex(self):
+        """ Rebuild the indexes from the stored Customers """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        Customer.redis.delete('customer:username', 'customer:email', 'customer:lastname:yang',
+                              *Customer.redis.keys('customer:ngram:*'))
+        self.assertEqual(Customer.find_by_username('jf'), [])
+        self.assertEqual(Customer.find_by_lastname('yang'), [])
+        self.assertEqual(Customer.search('yan'), [])
+
+        self.assertEqual(Customer.reindex(), 1)
+        self.assertEqual(Customer.find_by_username('jf')[0].username, 'jf')
+        self.assertEqual(Customer.find_by_email('jy2296@nyu.edu')[0].username, 'jf')
+        self.assertEqual(Customer.find_by_lastname('yang')[0].username, 'jf')
+        self.assertEqual(Customer.search('yan')[0].username, 'jf')
+
+    @REDIS_ONLY
+    def test_hash_and_pickle_records_coexist(self):
+        """ Read Customers stored with either codec """
+        with pickle_codec():
+            Customer(username='jf', password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email='jy2296@nyu.edu', active=True, promo=False).save()
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=False, promo=True)
+        customer.save()
+        self.assertEqual(Customer.redis.type('customer:1'), 'string')
+        self.assertEqual(Customer.redis.type('customer:2'), 'hash')
+        self.assertEqual(Customer.redis.hget('customer:2', 'lastname'), 'sue')
+        self.assertEqual(Customer.redis.hget('customer:2', '_codec'), 'hash')
+
+        customers = Customer.find_by_lastname('yang') + Customer.find_by_lastname('sue')
+        self.assertEqual([c.username for c in customers], ['jf', 'ms'])
+        self.assertEqual(Customer.find(2).serialize(), customer.serialize())
+        self.assertEqual(Customer.find(2).active, False)
+
+        # saving a pickled record rewrites it with the configured codec
+        pickled = Customer.find(1)
+        pickled.save()
+        self.assertEqual(Customer.redis.type('customer:1'), 'hash')
+        self.assertEqual(Customer.find(1).serialize(), pickled.serialize())
+
+    @REDIS_ONLY
+    def test_fetch_raises_errors_other_than_the_codec_type(self):
+        """ Raise the errors of a read that are not caused by the other codec """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        replies = [ResponseError('LOADING Redis is loading the dataset in memory'), {}]
+        with patch('redis.client.Pipeline.execute', return_value=replies):
+            self.assertRaises(ResponseError, Customer.find, 1)
+        self.assertEqual(Customer.find(1).username, 'jf')
+
+    def test_configure_bad_codec(self):
+        """ Configure a storage codec that does not exist """
+        self.assertRaises(ValueError, Customer.configure, codec='xml')
+        self.assertEqual(Customer.codec, 'hash')
+
+    def test_find_with_fields(self):
+        """ Find Customers loading only some fields """
+        with pickle_codec():
+            Customer(username='jf', password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email='jy2296@nyu.edu', active=True, promo=False).save()
+        Customer(username='jfy2', password='1234567',
+                 firstname='jinfan', lastname='yang',
+                 address='eastvillage', phone='123-456-7890',
+                 email='jfy@nyu.edu', active=False, promo=False).save()
+
+        customer = Customer.find(2, fields=['username', 'active'])
+        self.assertEqual(customer.serialize(['username', 'active']),
+                         {'id': 2, 'username': 'jfy2', 'active': False})
+        self.assertIsNone(customer.password)
+        self.assertIsNone(Customer.find(3, fields=['username']))
+
+        customers = Customer.find_by_lastname('yang', fields=['email'])
+        self.assertEqual([c.serialize(['email']) for c in customers],
+                         [{'id': 1, 'email': 'jy2296@nyu.edu'},
+                          {'id': 2, 'email': 'jfy@nyu.edu'}])
+        self.assertEqual(len(Customer.all(fields=['username'])), 2)
+        self.assertRaises(DataValidationError, Customer.find, 1, ['salary'])
+
+    def test_query_in_pages(self):
+        """ Page through the Customers in id order """
+        for i in range(5):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='jinfan', lastname='yang' if i % 2 else 'sue',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=True, promo=False).save()
+        Customer.find(3).delete()
+
+        customers, cursor = Customer.query(limit=2)
+        self.assertEqual([c.id for c in customers], [1, 2])
+        self.assertEqual(cursor, 2)
+        customers, cursor = Customer.query(limit=2, cursor=cursor)
+        self.assertEqual([c.id for c in customers], [4, 5])
+        self.assertEqual(cursor, None)
+
+        customers, cursor = Customer.query({'lastname': 'sue'}, limit=1, cursor=1)
+        self.assertEqual([c.id for c in customers], [5])
+        self.assertEqual(cursor, None)
+        customers, cursor = Customer.query({'active': True})
+        self.assertEqual([c.id for c in customers], [1, 2, 4, 5])
+
+    @REDIS_ONLY
+    def test_filtered_pages_are_read_from_the_cursor(self):
+        """ Read a filtered page from its cursor without loading every match """
+        for i in range(12):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='jinfan', lastname='sue' if i % 3 == 0 else 'yang',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=True, promo=i % 2 == 0).save()
+        with patch.object(Customer.engine, 'batch_size', 2), \
+                patch.object(Customer.redis, 'zrangebyscore',
+                             wraps=Customer.redis.zrangebyscore) as zrangebyscore:
+            customers, cursor = Customer.query({'promo': True}, limit=2, cursor=4)
+            self.assertEqual([c.id for c in customers], [5, 7])
+            self.assertEqual(cursor, 7)
+            self.assertEqual([call[0][1] for call in zrangebyscore.call_args_list], ['(4', '(7'])
+
+            # the smallest id set is walked and its ids checked against the other one
+            zrangebyscore.reset_mock()
+            customers, cursor = Customer.query({'promo': True, 'lastname': 'yang'},
+                                               limit=2, cursor=1)
+            self.assertEqual([c.id for c in customers], [3, 5])
+            self.assertEqual(cursor, 5)
+            self.assertEqual(set(call[0][0] for call in zrangebyscore.call_args_list),
+                             set(['customer:promo:true']))
+            customers, cursor = Customer.query({'promo': True, 'lastname': 'yang'},
+                                               limit=2, cursor=cursor)
+            self.assertEqual([c.id for c in customers], [9, 11])
+            self.assertIsNone(cursor)
+            self.assertEqual(Customer.count({'promo': True, 'lastname': 'yang'}), 4)
+
+    def test_query_with_combined_filters(self):
+        """ Find the Customers that match several filters """
+        for i in range(6):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='jinfan', lastname='yang' if i % 2 else 'sue',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=i < 4, promo=False).save()
+
+        customers, _ = Customer.query({'lastname': 'Yang', 'active': True})
+        self.assertEqual([c.id for c in customers], [2, 4])
+        customers, _ = Customer.query({'lastname': 'yang', 'active': True, 'promo': True})
+        self.assertEqual(customers, [])
+        customers, _ = Customer.query({'username': 'USER3', 'lastname': 'yang'})
+        self.assertEqual([c.id for c in customers], [4])
+        customers, _ = Customer.query({'username': 'user3', 'lastname': 'sue'})
+        self.assertEqual(customers, [])
+        customers, _ = Customer.query({'username': 'user3', 'email': 'user2@nyu.edu'})
+        self.assertEqual(customers, [])
+        self.assertRaises(DataValidationError, Customer.query, {'phone': '123-456-7890'})
+
+    def test_search_prefix(self):
+        """ Find Customers by the start of their lastname or username """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='Yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        Customer(username='yangm', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=True).save()
+        Customer(username='ms', password='11111',
+                 firstname=u'm\xe1ria', lastname=u'\xc1lvarez',
+                 address='nyu', phone='123-456-7890',
+                 email='ms@gmail.com', active=True, promo=True).save()
+
+        customers = Customer.search_prefix('YA')
+        self.assertEqual([c.username for c in customers], ['jf', 'yangm'])
+        customers = Customer.search_prefix('ya', attributes=['username'])
+        self.assertEqual([c.username for c in customers], ['yangm'])
+        self.assertEqual(len(Customer.search_prefix('ya', limit=1)), 1)
+        self.assertEqual(Customer.search_prefix(u'\xe1l')[0].username, 'ms')
+
+        customer.lastname = 'Smith'
+        customer.save()
+        self.assertEqual([c.username for c in Customer.search_prefix('ya')], ['yangm'])
+        self.assertEqual([c.username for c in Customer.search_prefix('sm')], ['jf'])
+        customer.delete()
+        self.assertEqual(Customer.search_prefix('sm'), [])
+        self.assertRaises(DataValidationError, Customer.search_prefix, 'a', ['address'])
+
+    def test_search_text(self):
+        """ Find Customers by part of a field or with a typo """
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='12 Washington Square', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='70 Washington Place', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=True).save()
+
+        customers = Customer.search('washingtn square')
+        self.assertEqual([c.username for c in customers], ['jf', 'ms'])
+        self.assertEqual([c.username for c in Customer.search('2296')], ['jf'])
+        self.assertEqual([c.username for c in Customer.search('MARYSUE')], ['ms'])
+        self.assertEqual(len(Customer.search('washington', limit=1)), 1)
+        self.assertEqual(Customer.search('zzzz'), [])
+        self.assertEqual(Customer.search('  '), [])
+
+        customer.address = 'Broadway'
+        customer.save()
+        self.assertEqual([c.username for c in Customer.search('square')], [])
+        customer.delete()
+        self.assertEqual(Customer.search('jinfan'), [])
+
+    def test_count(self):
+        """ Count Customers without loading them """
+        for i in range(4):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='jinfan', lastname='yang' if i % 2 else 'sue',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=True, promo=i == 0).save()
+
+        with patch.object(Customer.engine, 'get') as get:
+            self.assertEqual(Customer.count(), 4)
+            self.assertEqual(Customer.count({'lastname': 'sue'}), 2)
+            self.assertEqual(Customer.count({'username': 'USER1'}), 1)
+            self.assertEqual(Customer.count({'lastname': 'sue', 'promo': True}), 1)
+            self.assertEqual(Customer.count({'lastname': 'sue', 'username': 'user1'}), 0)
+        self.assertFalse(get.called)
+
+    def test_create_many(self):
+        """ Save a batch of new Customers """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        customers = [Customer(username='user%d' % i, password='12345',
+                              firstname='mary', lastname='sue',
+                              address='nyu', phone='123-456-7890',
+                              email='user%d@nyu.edu' % i, active=True, promo=False)
+                     for i in range(5)]
+        customers[2].username = 'JF'          # taken by an existing Customer
+        customers[4].email = 'USER0@nyu.edu'  # taken earlier in the batch
+
+        with patch.object(Customer, 'batch_size', 2):
+            errors = Customer.create_many(customers)
+        self.assertEqual([error is None for error in errors], [True, True, False, True, False])
+        self.assertEqual([c.id for c in customers], [2, 3, 0, 5, 0])
+        self.assertEqual(len(Customer.find_by_lastname('sue')), 3)
+        self.assertEqual(Customer.find_by_username('user3')[0].id, 5)
+        # the email claimed by the rejected Customer was given back
+        self.assertEqual(Customer.find_by_email('user2@nyu.edu'), [])
+        self.assertEqual(Customer.count(), 4)
+
+    def test_update_where(self):
+        """ Change a flag on every Customer that matches a filter or an id list """
+        for i in range(5):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='mary', lastname='sue' if i < 4 else 'yang',
+                     address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=i != 0, promo=i == 1).save()
+        with patch.object(Customer, 'batch_size', 2):
+            counts = Customer.update_where({'promo': True}, {'active': True, 'lastname': 'sue'})
+        self.assertEqual(counts, (3, 2))
+        self.assertEqual(sorted(c.id for c in Customer.find_by_promo(True)), [2, 3, 4])
+        self.assertEqual(Customer.find(1).promo, False)
+        self.assertEqual(Customer.count({'promo': False}), 2)
+
+        # Customer 1 is already inactive and there is no Customer 99
+        counts = Customer.update_where({'active': False}, customer_ids=[1, 5, 99])
+        self.assertEqual(counts, (2, 1))
+        self.assertEqual(sorted(c.id for c in Customer.find_by_active(False)), [1, 5])
+        self.assertRaises(DataValidationError, Customer.update_where, {'username': 'x'}, {'active': True})
+        self.assertRaises(DataValidationError, Customer.update_where, {'promo': 'yes'}, {'active': True})
+        self.assertRaises(DataValidationError, Customer.update_where, {'promo': True})
+        self.assertRaises(DataValidationError, Customer.update_where, {'promo': True}, {'lastname': 3})
+
+    @REDIS_ONLY
+    def test_update_where_pauses_between_batches(self):
+        """ Throttle a bulk update """
+        for i in range(3):
+            Customer(username='user%d' % i, password='12345',
+                     firstname='mary', lastname='sue', address='nyu', phone='123-456-7890',
+                     email='user%d@nyu.edu' % i, active=True, promo=False).save()
+        with patch('app.models.time.sleep') as sleep:
+            Customer.update_where({'promo': True}, {'lastname': 'sue'}, batch_size=1, pause=0.5)
+        self.assertEqual(sleep.call_count, 2)
+        sleep.assert_called_with(0.5)
+
+    def test_update_fields(self):
+        """ Change some fields of a Customer """
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=False).save()
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+
+        customer = Customer.update_fields(1, {'phone': '555-555-5555', 'lastname': 'smith'})
+        self.assertEqual(customer.phone, '555-555-5555')
+        self.assertEqual(customer.username, 'ms')
+        self.assertEqual(Customer.find(1).serialize(), customer.serialize())
+        self.assertEqual(Customer.find_by_lastname('sue'), [])
+        self.assertEqual(Customer.find_by_lastname('smith')[0].id, 1)
+        self.assertEqual(Customer.search_prefix('smi')[0].id, 1)
+
+        self.assertRaises(DataValidationError, Customer.update_fields, 1, {'username': 'JF'})
+        self.assertRaises(DataValidationError, Customer.update_fields, 1, {'phone': 5})
+        self.assertRaises(DataValidationError, Customer.update_fields, 1, {'nickname': 'ms'})
+        self.assertRaises(DataValidationError, Customer.update_fields, 1, {'id': 2})
+        self.assertRaises(DataValidationError, Customer.update_fields, 1, {})
+        self.assertEqual(Customer.update_fields(99, {'phone': '555-555-5555'}), None)
+
+    @REDIS_ONLY
+    def test_update_fields_of_pickled_record(self):
+        """ Change some fields of a pickled Customer """
+        with pickle_codec():
+            Customer(username='ms', password='11111',
+                     firstname='mary', lastname='sue',
+                     address='nyu', phone='123-456-7890',
+                     email='marysue@gmail.com', active=True, promo=False).save()
+        customer = Customer.update_fields(1, {'email': 'mary@nyu.edu'})
+        self.assertEqual(Customer.redis.type('customer:1'), 'hash')
+        self.assertEqual(Customer.find(1).serialize(), customer.serialize())
+        self.assertEqual(Customer.find_by_email('marysue@gmail.com'), [])
+        self.assertEqual(Customer.find_by_email('mary@nyu.edu')[0].id, 1)
+
+    def test_set_flag(self):
+        """ Set active or promo with a script or, for pickled records, a save """
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=False).save()
+        with pickle_codec():
+            Customer(username='jf', password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email='jy2296@nyu.edu', active=True, promo=False).save()
+
+        customer = Customer.set_flag(1, 'promo', True)
+        self.assertEqual(customer.promo, True)
+        self.assertEqual(customer.username, 'ms')
+        self.assertEqual(Customer.find(1).promo, True)
+        self.assertEqual([c.id for c in Customer.find_by_promo(True)], [1])
+        self.assertEqual([c.id for c in Customer.find_by_promo(False)], [2])
+
+        customer = Customer.set_flag(2, 'active', False)
+        self.assertEqual(customer.active, False)
+        self.assertEqual([c.id for c in Customer.find_by_active(False)], [2])
+        self.assertEqual(Customer.set_flag(99, 'active', False), None)
+        self.assertRaises(DataValidationError, Customer.set_flag, 1, 'lastname', True)
+
+    @REDIS_ONLY
+    def test_set_flag_keeps_concurrent_writes(self):
+        """ Set a flag on a pickled Customer that is changed while it is being set """
+        with pickle_codec():
+            Customer(username='ms', password='11111',
+                     firstname='mary', lastname='sue',
+                     address='nyu', phone='123-456-7890',
+                     email='marysue@gmail.com', active=True, promo=False).save()
+            fetch = Customer.engine._RedisEngine__fetch
+            written = []
+
+            def write_once(customer_ids, fields=None, client=None):
+                """ Changes the phone of the Customer after the first read """
+                data = fetch(customer_ids, fields, client)
+                if not written:
+                    written.append(True)
+                    Customer.update_fields(1, {'phone': '555-555-5555'})
+                return data
+
+            with patch.object(Customer.engine, '_RedisEngine__fetch', side_effect=write_once):
+                customer = Customer.set_flag(1, 'promo', True)
+        self.assertEqual((customer.phone, customer.promo), ('555-555-5555', True))
+        customer = Customer.find(1)
+        self.assertEqual((customer.phone, customer.promo), ('555-555-5555', True))
+
+    @REDIS_ONLY
+    def test_remove(self):
+        """ Delete Customers and all of their index entries """
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address=None, phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=False).save()
+        with pickle_codec():
+            Customer(username='jf', password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email='jy2296@nyu.edu', active=True, promo=False).save()
+        self.assertTrue(Customer.remove(1))
+        self.assertTrue(Customer.remove(2))
+        self.assertFalse(Customer.remove(2))
+        self.assertEqual(sorted(Customer.redis.keys('customer:*')),
+                         ['customer:generation', 'customer:indexed', 'customer:seq'])
+
+    @REDIS_ONLY
+    def test_remove_retries_when_the_record_changes(self):
+        """ Delete a Customer that is renamed while it is being deleted """
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=True, promo=False)
+        customer.save()
+        fetch = Customer.engine._RedisEngine__fetch
+
+        def rename_once(customer_ids, fields=None, client=None):
+            """ Renames the Customer after the first read """
+            data = fetch(customer_ids, fields, client)
+            if customer.lastname == 'sue':
+                customer.lastname = 'smith'
+                customer.save()
+            return data
+
+        with patch.object(Customer.engine, '_RedisEngine__fetch', side_effect=rename_once) as mock:
+            self.assertTrue(Customer.remove(1))
+        # the first read, the read by save() and the read of the retry
+        self.assertEqual(mock.call_count, 3)
+        self.assertEqual(sorted(Customer.redis.keys('customer:*')),
+                         ['customer:generation', 'customer:indexed', 'customer:seq'])
+
+    @REDIS_ONLY
+    def test_find_with_cache(self):
+        """ Find Customers through the cache and drop them when they change """
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=True, promo=False)
+        customer.save()
+        with patch.object(Customer, 'cache', LRUCache(10)):
+            self.assertEqual(Customer.find(1).serialize(), customer.serialize())
+            with patch.object(Customer.redis, 'pipeline') as pipeline:
+                self.assertEqual(Customer.find(1).serialize(), customer.serialize())
+                self.assertEqual(Customer.find(1, ['phone']).phone, '123-456-7890')
+            self.assertFalse(pipeline.called)
+
+            customer.phone = '555-555-5555'
+            customer.save()
+            self.assertEqual(Customer.find(1).phone, '555-555-5555')
+            Customer.set_flag(1, 'promo', True)
+            self.assertEqual(Customer.find(1).promo, True)
+            Customer.update_fields(1, {'lastname': 'smith'})
+            self.assertEqual(Customer.find(1).lastname, 'smith')
+            Customer.update_where({'active': False}, customer_ids=[1])
+            self.assertEqual(Customer.find(1).active, False)
+            customer.delete()
+            self.assertEqual(Customer.find(1), None)
+            self.assertEqual(Customer.cache.stats()['hits'], 2)
+
+    @REDIS_ONLY
+    def test_find_does_not_cache_data_read_before_a_write(self):
+        """ Keep a Customer changed between its read and the cache fill out of the cache """
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=False).save()
+        fetch = Customer.engine._RedisEngine__fetch
+        written = []
+
+        def write_once(customer_ids, fields=None, client=None):
+            """ Changes the phone of the Customer after the first read """
+            data = fetch(customer_ids, fields, client)
+            if not written:
+                written.append(True)
+                Customer.update_fields(1, {'phone': '999'})
+            return data
+
+        with patch.object(Customer, 'cache', LRUCache(10)):
+            with patch.object(Customer.engine, '_RedisEngine__fetch', side_effect=write_once):
+                self.assertEqual(Customer.find(1).phone, '123-456-7890')
+            self.assertEqual(len(Customer.cache), 0)
+            self.assertEqual(Customer.find(1).phone, '999')
+            self.assertEqual(Customer.find(1).phone, '999')
+            self.assertEqual(Customer.cache.stats()['hits'], 1)
+
+    @REDIS_ONLY
+    def test_writes_publish_events(self):
+        """ Publish the id and version of every Customer written """
+        pubsub = Customer.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Customer.engine.events_channel)
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=True, promo=False)
+        customer.save()
+        Customer.set_flag(1, 'promo', True)
+        Customer.update_fields(1, {'phone': '555-555-5555'})
+        version = Customer.version(1)
+        customer.delete()
+        Customer.remove_all()
+        events = []
+        for _ in range(20):
+            message = pubsub.get_message(timeout=0.1)
+            if message:
+                events.append(message['data'])
+            if len(events) == 5:
+                break
+        pubsub.close()
+        self.assertEqual(len(events), 5)
+        self.assertEqual(events[2], '1:{}'.format(version))
+        self.assertEqual(events[3:], ['1:', '*'])
+
+    @REDIS_ONLY
+    def test_listen_for_changes(self):
+        """ Evict the Customers written by another process from the cache """
+        with patch.object(Customer, 'cache', LRUCache(10)):
+            Customer.listen_for_changes()
+            listener = Customer.listener
+            Customer.listen_for_changes()
+            self.assertIs(Customer.listener, listener)
+            for _ in range(50):
+                if Customer.redis.pubsub_numsub(Customer.engine.events_channel)[0][1]:
+                    break
+                time.sleep(0.02)
+            Customer.cache.put(1, {'id': 1})
+            Customer.cache.put(2, {'id': 2})
+            Customer.redis.publish(Customer.engine.events_channel, '1:7')
+            for _ in range(50):
+                if len(Customer.cache) == 1:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(Customer.cache.get(1), None)
+            self.assertEqual(Customer.cache.get(2), {'id': 2})
+
+    def test_configure_cache(self):
+        """ Turn the cache on and off """
+        with patch.object(Customer, 'cache', None):
+            Customer.configure(cache_size=5, cache_ttl=30)
+            self.assertEqual(Customer.cache.size, 5)
+            self.assertEqual(Customer.cache.ttl, 30)
+            Customer.configure(cache_size=0)
+            self.assertEqual(Customer.cache, None)
+
+    def test_versions(self):
+        """ Bump the version of a Customer and the generation on every write """
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=True, promo=False)
+        customer.save()
+        versions = [Customer.version(1)]
+        customer.phone = '555-555-5555'
+        customer.save()
+        versions.append(Customer.version(1))
+        Customer.set_flag(1, 'promo', True)
+        versions.append(Customer.version(1))
+        Customer.set_flag(1, 'promo', True)  # no change
+        versions.append(Customer.version(1))
+        Customer.update_fields(1, {'lastname': 'smith'})
+        versions.append(Customer.version(1))
+        Customer.update_where({'active': False}, customer_ids=[1])
+        versions.append(Customer.version(1))
+        self.assertEqual(versions[3], versions[2])
+        del versions[3]
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(Customer.generation(), versions[-1])
+
+        customer.delete()
+        self.assertEqual(Customer.version(1), None)
+        self.assertEqual(Customer.generation(), versions[-1] + 1)
+        Customer.remove_all()
+        self.assertEqual(Customer.generation(), versions[-1] + 2)
+
+    @REDIS_ONLY
+    def test_reindex_sets_missing_versions(self):
+        """ Give a version to Customers written before versions existed """
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=False).save()
+        version = Customer.version(1)
+        Customer.redis.delete(Customer.engine.versions_key)
+        self.assertEqual(Customer.version(1), None)
+        Customer.reindex()
+        self.assertEqual(Customer.version(1), version + 1)
+
+    @REDIS_ONLY
+    def test_reindex_while_customers_change(self):
+        """ Index the Customers written during a reindex as they are stored """
+        for username in ('jf', 'ms', 'joe'):
+            Customer(username=username, password='12345',
+                     firstname='jinfan', lastname=username,
+                     address='nyu', phone='123-456-7890',
+                     email=username + '@nyu.edu', active=True, promo=False).save()
+        scan = Customer.engine._RedisEngine__scan_ids
+        duplicate = Customer(username='joe', password='12345',
+                             firstname='jinfan', lastname='yang',
+                             address='nyu', phone='123-456-7890',
+                             email='other@nyu.edu', active=True, promo=False)
+
+        def write_after_scan(client, batch_size=None):
+            """ Deletes and renames Customers once they have been scanned """
+            for customer_ids in scan(client, batch_size):
+                Customer.remove(1)
+                Customer.update_fields(2, {'username': 'mary', 'lastname': 'sue'})
+                # the usernames stay unique throughout
+                self.assertRaises(DataValidationError, duplicate.save)
+                yield customer_ids
+
+        with patch.object(Customer.engine, '_RedisEngine__scan_ids', side_effect=write_after_scan):
+            self.assertEqual(Customer.reindex(), 2)
+        self.assertEqual(Customer.count(), 2)
+        self.assertEqual(Customer.find_by_lastname('jf'), [])
+        self.assertEqual(Customer.find_by_lastname('ms'), [])
+        self.assertEqual(Customer.find_by_lastname('sue')[0].id, 2)
+        self.assertEqual(Customer.search_prefix('j', ['username'])[0].id, 3)
+        # the usernames they gave up can be taken again
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jf@nyu.edu', active=True, promo=False).save()
+        Customer.update_fields(3, {'username': 'ms'})
+
+    @REDIS_ONLY
+    def test_reindex_removes_stale_entries(self):
+        """ Remove the index entries that no Customer matches """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        Customer.redis.zadd('customer:lastname:ghost', {1: 1})
+        Customer.redis.hset('customer:username', 'ghost', 1)
+        Customer.redis.hset('customer:username', 'pending', 9)
+        Customer.redis.zadd(Customer.engine.ids_key, {7: 7})
+        Customer.redis.hset(Customer.engine.versions_key, 7, 1)
+        Customer.redis.zadd('customer:lex:username', {'ghost\x001': 0})
+        Customer.redis.sadd('customer:ngram:xyz', 1)
+
+        self.assertEqual(Customer.reindex(), 1)
+        self.assertFalse(Customer.redis.exists('customer:lastname:ghost'))
+        self.assertIsNone(Customer.redis.hget('customer:username', 'ghost'))
+        self.assertIsNone(Customer.redis.zscore(Customer.engine.ids_key, 7))
+        self.assertIsNone(Customer.redis.hget(Customer.engine.versions_key, 7))
+        self.assertIsNone(Customer.redis.zscore('customer:lex:username', 'ghost\x001'))
+        self.assertFalse(Customer.redis.exists('customer:ngram:xyz'))
+        # an id reserved after the reindex started may belong to a Customer being written
+        self.assertEqual(Customer.redis.hget('customer:username', 'pending'), '9')
+        self.assertEqual(Customer.find_by_username('jf')[0].id, 1)
+        self.assertEqual(Customer.find_by_lastname('yang')[0].id, 1)
+        self.assertEqual(Customer.search('yan')[0].id, 1)
+
+    @REDIS_ONLY
+    def test_reindex_reports_shared_usernames(self):
+        """ Fail a reindex that finds a username held by two Customers """
+        for username in ('jf', 'ms'):
+            Customer(username=username, password='12345',
+                     firstname='jinfan', lastname='yang',
+                     address='nyu', phone='123-456-7890',
+                     email=username + '@nyu.edu', active=True, promo=False).save()
+        Customer.redis.delete('customer:username')
+        Customer.redis.hset('customer:2', 'username', 'JF')
+        with self.assertRaisesRegexp(DataValidationError, "has the username 'JF' of Customer 1"):
+            with patch.object(Customer.engine, '_RedisEngine__scan_ids', return_value=iter([[1, 2]])):
+                Customer.reindex()
+        self.assertTrue(Customer.engine.indexes_built)
+        self.assertEqual(Customer.redis.hget('customer:username', 'jf'), '1')
+        self.assertEqual(Customer.redis.hget('customer:email', 'ms@nyu.edu'), '2')
+
+    @REDIS_ONLY
+    def test_unique_writes_wait_for_the_indexes(self):
+        """ Refuse to take usernames and emails until the indexes are built """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        # a database written before the indexes existed
+        Customer.redis.delete(Customer.engine.indexed_key)
+        Customer.init_db()
+        self.assertFalse(Customer.engine.indexes_built)
+        customer = Customer(username='ms', password='11111',
+                            firstname='mary', lastname='sue',
+                            address='nyu', phone='123-456-7890',
+                            email='marysue@gmail.com', active=True, promo=False)
+        self.assertRaises(DatabaseNotReadyError, customer.save)
+        self.assertRaises(DatabaseNotReadyError, Customer.create_many, [customer])
+        self.assertRaises(DatabaseNotReadyError, Customer.update_fields, 1, {'email': 'jf@nyu.edu'})
+        self.assertRaises(DatabaseNotReadyError, Customer.query, {'lastname': 'yang'})
+        self.assertRaises(DatabaseNotReadyError, Customer.count)
+        self.assertRaises(DatabaseNotReadyError, Customer.search, 'yang')
+        self.assertRaises(DatabaseNotReadyError, Customer.find_by_username, 'jf')
+        # the writes that keep the username and email and the reads by id still work
+        self.assertEqual(Customer.update_fields(1, {'address': 'soho'}).address, 'soho')
+        self.assertEqual(Customer.update_fields(1, {'email': 'JY2296@nyu.edu'}).email,
+                         'JY2296@nyu.edu')
+        self.assertTrue(Customer.set_flag(1, 'promo', True).promo)
+        stored = Customer.find(1)
+        stored.lastname = 'sue'
+        stored.save()
+        self.assertEqual(Customer.find(1).lastname, 'sue')
+
+        # a reindex run by another process is noticed after the interval
+        Customer.redis.set(Customer.engine.indexed_key, Customer.engine.index_layout)
+        self.assertRaises(DatabaseNotReadyError, Customer.count)
+        with patch('app.storage.time.time', return_value=time.time() + 31):
+            self.assertEqual(Customer.count(), 1)
+        customer.save()
+        self.assertEqual(Customer.find_by_username('ms')[0].id, 2)
+
+        Customer.redis.delete(Customer.engine.indexed_key)
+        Customer.init_db()
+        self.assertEqual(Customer.reindex(), 2)
+        self.assertTrue(Customer.engine.indexes_built)
+        self.assertEqual(Customer.count({'promo': True}), 1)
+
+    @REDIS_ONLY
+    def test_migrate_legacy_keys(self):
+        """ Move Customers from bare integer keys to the customer namespace """
+        for customer_id in range(1, 4):
+            data = Customer(customer_id, username='user%d' % customer_id, password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='user%d@nyu.edu' % customer_id,
+                            active=True, promo=False).serialize()
+            Customer.redis.set(customer_id, pickle.dumps(data))
+        Customer.redis.set('index', 3)
+        Customer.init_db()
+        Customer.reindex()
+        self.assertTrue(Customer.engine.legacy_keys)
+
+        # legacy records are served while they wait to be migrated
+        self.assertEqual(Customer.find(2).username, 'user2')
+        self.assertEqual(len(Customer.all()), 3)
+        customer = Customer(username='jf', password='12345',
+                            firstname='jinfan', lastname='yang',
+                            address='nyu', phone='123-456-7890',
+                            email='jy2296@nyu.edu', active=True, promo=False)
+        customer.save()
+        self.assertEqual(customer.id, 4)
+        updated = Customer.find(1)
+        updated.address = 'eastvillage'
+        updated.save()
+        self.assertFalse(Customer.redis.exists('1'))
+
+        self.assertEqual(Customer.migrate_keys(batch_size=1), 2)
+        self.assertFalse(Customer.redis.exists('index'))
+        self.assertFalse(Customer.redis.exists('2'))
+        self.assertEqual(Customer.redis.get('customer:seq'), '4')
+        self.assertFalse(Customer.engine.legacy_keys)
+
+        # another process notices the migration on its next read after the interval
+        with patch.object(Customer.engine, 'legacy_keys', True):
+            self.assertEqual(Customer.find(2).username, 'user2')
+            self.assertTrue(Customer.engine.legacy_keys)
+            with patch('app.storage.time.time', return_value=time.time() + 31):
+                self.assertEqual(Customer.find(2).username, 'user2')
+            self.assertFalse(Customer.engine.legacy_keys)
+
+        Customer.init_db()
+        self.assertFalse(Customer.engine.legacy_keys)
+        self.assertEqual(len(Customer.all()), 4)
+        self.assertEqual(Customer.find(1).address, 'eastvillage')
+        self.assertEqual(Customer.find_by_username('user3')[0].id, 3)
+
+    @REDIS_ONLY
+    def test_remove_all_keeps_other_keys(self):
+        """ Remove all Customers without touching other data """
+        Customer(username='jf', password='12345',
+                 firstname='jinfan', lastname='yang',
+                 address='nyu', phone='123-456-7890',
+                 email='jy2296@nyu.edu', active=True, promo=False).save()
+        Customer.redis.set('other-service', 'data')
+        Customer.remove_all()
+        self.assertEqual(Customer.all(), [])
+        self.assertEqual(Customer.redis.get('other-service'), 'data')
+        Customer.redis.delete('other-service')
+
     def test_save_customer_with_no_username(self):
         """ Save a Customer with no username """
         customer = Customer(0, password='2345',
@@ -462,17 +1437,87 @@ class TestCustomers(unittest.TestCase):
         customer = Customer(0)
         self.assertRaises(DataValidationError, customer.deserialize, "string data")
 
+    @REDIS_ONLY
+    @patch.object(Customer, 'pool_warm', 2)
+    @patch.object(Customer, 'pool_options', dict(Customer.pool_options))
+    def test_connection_pool(self):
+        """ Connect through a warmed up pool with the configured settings """
+        Customer.configure(pool_size=3, pool_timeout=0.1, socket_timeout=1, pool_warm=2)
+        Customer.init_db()
+        pool = Customer.redis.connection_pool
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual(pool.timeout, 0.1)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 1)
+        self.assertEqual(Customer.pool_stats(),
+                         {'max_connections': 3, 'created': 2, 'in_use': 0, 'idle': 2})
+        connection = pool.get_connection('GET')
+        self.assertEqual(Customer.pool_stats()['in_use'], 1)
+        pool.release(connection)
+
+    @REDIS_ONLY
+    def test_pool_stats_of_a_client_connection(self):
+        """ Get the pool counters of a connection passed to init_db """
+        Customer.init_db(Redis(host='127.0.0.1', port=6379))
+        stats = Customer.pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], stats['created'])
+
+    @REDIS_ONLY
+    def test_reads_go_to_the_replica(self):
+        """ Send queries to the replica unless the thread reads from the primary """
+        Customer(username='ms', password='11111',
+                 firstname='mary', lastname='sue',
+                 address='nyu', phone='123-456-7890',
+                 email='marysue@gmail.com', active=True, promo=False).save()
+        replica = MagicMock(wraps=Customer.redis)
+        with patch.object(Customer.router, 'replica', replica):
+            self.assertEqual(Customer.find(1).username, 'ms')
+            self.assertEqual(len(Customer.find_by_lastname('sue')), 1)
+            self.assertEqual(len(Customer.all()), 1)
+            self.assertEqual(Customer.count({'active': True}), 1)
+            self.assertEqual(len(replica.pipeline.mock_calls) > 0, True)
+            self.assertEqual(replica.scan.called, True)
+
+            customer = Customer.find(1)
+            replica.reset_mock()
+            customer.phone = '555-555-5555'
+            customer.save()
+            Customer.set_flag(1, 'promo', True)
+            self.assertEqual(replica.pipeline.called, False)
+
+            Customer.read_from_primary()
+            try:
+                self.assertEqual(Customer.find(1).phone, '555-555-5555')
+                self.assertEqual(len(Customer.search_prefix('su')), 1)
+            finally:
+                Customer.read_from_primary(False)
+            self.assertEqual(replica.mock_calls, [])
+
+    @REDIS_ONLY
+    @patch.object(Customer, 'replica_endpoint', None)
+    def test_connect_to_replica(self):
+        """ Connect to the configured replica, or read from the primary if it is down """
+        Customer.configure(replica_host='127.0.0.1', replica_port=6379)
+        Customer.init_db()
+        self.assertIsNotNone(Customer.router.replica)
+        Customer.configure(replica_host='127.0.0.1', replica_port=6300)
+        Customer.init_db()
+        self.assertIsNone(Customer.router.replica)
+
+    @REDIS_ONLY
     def test_passing_bad_connection(self):
         """ Pass in a bad Redis connection """
         self.assertRaises(ConnectionError, Customer.init_db, Redis(host='127.0.0.1', port=6300))
         self.assertIsNone(Customer.redis)
 
+    @REDIS_ONLY
     @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
     def test_vcap_services(self):
         """ Test if VCAP_SERVICES works """
         Customer.init_db()
         self.assertIsNotNone(Customer.redis)
 
+    @REDIS_ONLY
     @patch('redis.Redis.ping')
     def test_redis_connection_error(self, ping_error_mock):
         """ Test a Bad Redis connection """
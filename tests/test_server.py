@@ -8,15 +8,21 @@ Test cases can be run with the following:
 """
 
 import os
+import time
 import unittest
 import logging
 import json
 from app import server
 from flask_api import status
 from app.models import Customer
+from app.cache import LRUCache, QueryCache
 from app.custom_exceptions import DataValidationError
 from mock import MagicMock, patch
 
+# the storage engine the service is tested on ('redis' or 'memory')
+ENGINE = os.getenv('STORAGE_ENGINE', 'redis')
+REDIS_ONLY = unittest.skipIf(ENGINE != 'redis', 'tests the Redis storage engine')
+
 
 ######################################################################
 #  T E S T   C A S E S
@@ -44,6 +50,25 @@ class TestCustomerServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data['message'], "Healthy")
 
+    def test_metrics(self):
+        """ Get the counters of the Customer cache """
+        with patch.object(Customer, 'cache', None):
+            resp = self.app.get('/metrics')
+            self.assertEqual(json.loads(resp.data)['customer_cache'], None)
+        with patch.object(Customer, 'cache', LRUCache(10)):
+            self.app.get('/customers/1')
+            self.app.get('/customers/1')
+            resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['customer_cache']['hits'], 1)
+        self.assertEqual(data['customer_cache']['misses'], 1)
+        self.assertEqual(data['customer_cache']['size'], 1)
+        if ENGINE == 'redis':
+            self.assertEqual(data['redis_pool']['in_use'], 0)
+        else:
+            self.assertIsNone(data['redis_pool'])
+
     def test_index(self):
         """ Test the Home Page """
         resp = self.app.get('/')
@@ -126,6 +151,208 @@ class TestCustomerServer(unittest.TestCase):
         resp = self.app.get('/customers?active=false')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_customer_list_with_fields(self):
+        """ Get a list of Customers with only some fields """
+        resp = self.app.get('/customers?fields=username,active')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 3)
+        for customer in data:
+            self.assertEqual(sorted(customer.keys()), ['active', 'id', 'username'])
+
+    def test_query_customers_with_fields(self):
+        """ Query Customers by lastname with only some fields """
+        resp = self.app.get('/customers?lastname=yang&fields=email')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(sorted(data[0].keys()), ['email', 'id'])
+
+    def test_get_customer_with_fields(self):
+        """ Get a single Customer with only some fields """
+        customer = Customer.find_by_username('jf')[0]
+        resp = self.app.get('/customers/{}?fields=id,username,promo'.format(customer.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {'id': customer.id, 'username': 'jf', 'promo': False})
+
+    def test_get_customer_with_unknown_fields(self):
+        """ Get a Customer with a field that does not exist """
+        customer = Customer.find_by_username('jf')[0]
+        resp = self.app.get('/customers/{}?fields=username,salary'.format(customer.id))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers?fields=salary')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_list_in_pages(self):
+        """ Get the list of Customers one page at a time """
+        resp = self.app.get('/customers?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        first_page = json.loads(resp.data)
+        self.assertEqual(len(first_page), 2)
+        link = resp.headers.get('Link')
+        self.assertIn('rel="next"', link)
+        next_url = link[link.index('<') + 1:link.index('>')]
+        self.assertIn('cursor={}'.format(first_page[1]['id']), next_url)
+
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        second_page = json.loads(resp.data)
+        self.assertEqual(len(second_page), 1)
+        self.assertIsNone(resp.headers.get('Link'))
+        ids = [customer['id'] for customer in first_page + second_page]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_query_customers_in_pages(self):
+        """ Page through the Customers that match a filter """
+        resp = self.app.get('/customers?lastname=yang&limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['username'], 'jf')
+        resp = self.app.get('/customers?lastname=yang&limit=1&cursor={}'.format(data[0]['id']))
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['username'], 'jfy2')
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_get_customer_if_none_match(self):
+        """ Get a Customer only if it changed since the ETag """
+        resp = self.app.get('/customers/2')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/customers/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.data, '')
+
+        # another representation of the Customer has another ETag
+        resp = self.app.get('/customers/2?fields=phone', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        self.app.put('/customers/2/subscribe')
+        resp = self.app.get('/customers/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(json.loads(resp.data)['promo'], True)
+
+    def test_get_cached_customer_if_none_match(self):
+        """ Answer a cached Customer and its ETag without reading the version again """
+        with patch.object(Customer, 'cache', LRUCache(10)):
+            etag = self.app.get('/customers/2').headers['ETag']
+            with patch.object(Customer.engine, 'version') as version:
+                resp = self.app.get('/customers/2')
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.headers['ETag'], etag)
+                resp = self.app.get('/customers/2', headers={'If-None-Match': etag})
+                self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertFalse(version.called)
+
+    def test_list_customers_if_none_match(self):
+        """ List Customers only if any changed since the ETag """
+        resp = self.app.get('/customers?active=true')
+        etag = resp.headers['ETag']
+        with patch.object(Customer, 'query') as query:
+            resp = self.app.get('/customers?active=true', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(query.called)
+        resp = self.app.get('/customers?active=false', headers={'If-None-Match': etag})
+        self.assertNotEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.app.delete('/customers/3')
+        resp = self.app.get('/customers?active=true', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_list_customers_from_query_cache(self):
+        """ List Customers from the query cache until a Customer changes """
+        with patch.object(server, 'query_cache', QueryCache(10)):
+            resp = self.app.get('/customers?active=true&limit=2')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            with patch.object(Customer, 'query') as query:
+                cached = self.app.get('/customers?limit=2&active=True')
+            self.assertFalse(query.called)
+            self.assertEqual(cached.data, resp.data)
+            self.assertEqual(cached.headers['Link'], resp.headers['Link'])
+            self.assertEqual(cached.headers['Content-Type'], 'application/json')
+            self.assertEqual(cached.headers['ETag'], resp.headers['ETag'])
+
+            self.app.put('/customers/1/deactivate')
+            resp = self.app.get('/customers?active=true&limit=2')
+            self.assertEqual(len(json.loads(resp.data)), 2)
+            self.assertNotIn('Link', resp.headers)
+            self.assertEqual(server.query_cache.stats()['hits'], 1)
+
+    def test_get_customer_list_bad_limit(self):
+        """ Get a page of Customers with a bad limit """
+        resp = self.app.get('/customers?limit=ten')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_customers_with_combined_filters(self):
+        """ Get the Customers that match several filters """
+        resp = self.app.get('/customers?firstname=jinfan&lastname=yang&address=ignored')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+        resp = self.app.get('/customers?lastname=yang&promo=false&email=jfy@nyu.edu')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['username'], 'jfy2')
+
+        resp = self.app.get('/customers?lastname=yang&promo=true')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/customers?username=jf&email=jfy@nyu.edu')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get(u'/customers?lastname=m\xfcller')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn(u"lastname 'm\xfcller'", json.loads(resp.data)['message'])
+
+    def test_count_customers(self):
+        """ Count the Customers with and without filters """
+        resp = self.app.get('/customers/count')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'count': 3})
+        resp = self.app.get('/customers/count?promo=true')
+        self.assertEqual(json.loads(resp.data)['count'], 1)
+        resp = self.app.get('/customers/count?lastname=yang&active=true')
+        self.assertEqual(json.loads(resp.data)['count'], 2)
+        resp = self.app.get('/customers/count?username=jf&promo=true')
+        self.assertEqual(json.loads(resp.data)['count'], 0)
+        resp = self.app.get('/customers/count?active=maybe')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_customers_by_prefix(self):
+        """ Search Customers by the start of their lastname or username """
+        resp = self.app.get('/customers/search?prefix=Ya')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([c['username'] for c in data], ['jf', 'jfy2'])
+
+        resp = self.app.get('/customers/search?prefix=jf&field=username&fields=username&limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(sorted(data[0].keys()), ['id', 'username'])
+
+        resp = self.app.get('/customers/search?prefix=zzz')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_search_customers_by_text(self):
+        """ Search Customers by a misspelt part of their address """
+        resp = self.app.get('/customers/search?q=eastvilage')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['username'], 'jfy2')
+
+    def test_search_customers_bad_request(self):
+        """ Search Customers without a prefix or by an unknown field """
+        resp = self.app.get('/customers/search')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/customers/search?prefix=a&field=password')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_customer(self):
         """ Get a single Customer """
         # get the id of a customer
@@ -171,6 +398,166 @@ class TestCustomerServer(unittest.TestCase):
         self.assertEqual(len(data), customer_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_customer_with_duplicate_username(self):
+        """ Create a Customer with a username that is already taken """
+        new_customer = {"username": "JF",
+                        "password": "11111",
+                        "firstname": "mary",
+                        "lastname": "sue",
+                        "address": "nyu",
+                        "phone": "123-456-7890",
+                        "email": "marysue@gmail.com",
+                        "active": True,
+                        "promo": False}
+        data = json.dumps(new_customer)
+        resp = self.app.post('/customers', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_customer_count(), 3)
+
+    def test_create_customer_with_duplicate_non_ascii_username(self):
+        """ Create a Customer with a non ASCII username that is already taken """
+        new_customer = {"username": u"zo\xeb",
+                        "password": "11111",
+                        "firstname": "zoe",
+                        "lastname": "sue",
+                        "address": "nyu",
+                        "phone": "123-456-7890",
+                        "email": "zoe@gmail.com",
+                        "active": True,
+                        "promo": False}
+        resp = self.app.post('/customers', data=json.dumps(new_customer),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        new_customer.update(username=u"ZO\xcb", email="zoe2@gmail.com")
+        resp = self.app.post('/customers', data=json.dumps(new_customer),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(resp.data)['message'],
+                         u"Customer with username 'ZO\xcb' already exists")
+
+    @REDIS_ONLY
+    def test_requests_wait_for_the_indexes(self):
+        """ Answer 503 to the requests that need the indexes until they are built """
+        new_customer = {"username": "ms", "password": "11111", "firstname": "mary",
+                        "lastname": "sue", "address": "nyu", "phone": "123-456-7890",
+                        "email": "marysue@gmail.com", "active": True, "promo": False}
+        with patch.object(Customer.engine, 'indexes_built', False), \
+                patch.object(Customer.engine, 'layout_check_interval', 3600):
+            resp = self.app.post('/customers', data=json.dumps(new_customer),
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn('reindex', json.loads(resp.data)['message'])
+            resp = self.app.get('/customers?lastname=yang')
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            resp = self.app.get('/customers/1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            # an update that keeps the username and email is not refused
+            customer = json.loads(resp.data)
+            customer['address'] = 'soho'
+            resp = self.app.put('/customers/1', data=json.dumps(customer),
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_customer_count(), 3)
+
+    def test_create_customers_in_bulk(self):
+        """ Create several Customers in one request """
+        new_customers = [{"username": "ms", "password": "11111", "firstname": "mary",
+                          "lastname": "sue", "address": "nyu", "phone": "123-456-7890",
+                          "email": "marysue@gmail.com", "active": True, "promo": False},
+                         {"username": "ms2"},
+                         {"username": "jf", "password": "11111", "firstname": "jinfan",
+                          "lastname": "yang", "address": "nyu", "phone": "123-456-7890",
+                          "email": "jf@gmail.com", "active": True, "promo": False},
+                         {"username": "jk", "password": "249", "firstname": "jahn",
+                          "lastname": "kalyani", "address": "raleigh", "phone": "632-262-6362",
+                          "email": "jk1378@nyu.edu", "active": True, "promo": True}]
+        resp = self.app.post('/customers/bulk', data=json.dumps(new_customers),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([r['status'] for r in data['results']], [201, 400, 400, 201])
+        self.assertIn('already exists', data['results'][2]['error'])
+        self.assertEqual(self.get_customer_count(), 5)
+
+        resp = self.app.get('/customers/{}'.format(data['results'][3]['id']))
+        self.assertEqual(json.loads(resp.data)['username'], 'jk')
+        self.assertEqual(len(Customer.find_by_lastname('kalyani')), 1)
+
+    def test_create_customers_in_bulk_without_optional_fields(self):
+        """ Create Customers in bulk that have no address or phone """
+        new_customers = [{"username": "ms", "password": "11111", "firstname": "mary",
+                          "lastname": "sue", "phone": "123-456-7890",
+                          "email": "marysue@gmail.com", "active": True, "promo": False},
+                         {"username": "jk", "password": "249", "firstname": "jahn",
+                          "lastname": "kalyani", "email": "jk1378@nyu.edu",
+                          "active": True, "promo": True}]
+        resp = self.app.post('/customers/bulk', data=json.dumps(new_customers),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([r['status'] for r in data['results']], [201, 201])
+        resp = self.app.get('/customers/{}'.format(data['results'][1]['id']))
+        customer = json.loads(resp.data)
+        self.assertIsNone(customer['address'])
+        self.assertIsNone(customer['phone'])
+
+    def test_create_customers_in_bulk_ndjson(self):
+        """ Create several Customers from newline delimited JSON """
+        lines = [json.dumps({"username": "ms", "password": "11111", "firstname": "mary",
+                             "lastname": "sue", "address": "nyu", "phone": "123-456-7890",
+                             "email": "marysue@gmail.com", "active": True, "promo": False}),
+                 '{not json',
+                 '']
+        resp = self.app.post('/customers/bulk', data='\n'.join(lines),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([r['status'] for r in data['results']], [201, 400])
+
+    def test_create_customers_in_bulk_bad_body(self):
+        """ Create Customers in bulk without a JSON array """
+        resp = self.app.post('/customers/bulk', data=json.dumps({"username": "ms"}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/customers/bulk', data='username=ms',
+                             content_type='text/plain')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_update_customers_in_bulk(self):
+        """ Subscribe every active Customer with a lastname """
+        resp = self.app.put('/customers/bulk',
+                            data=json.dumps({'filters': {'lastname': 'yang', 'active': True},
+                                             'changes': {'promo': True}}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {'matched': 2, 'updated': 2})
+        resp = self.app.get('/customers?promo=true')
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+        resp = self.app.put('/customers/bulk',
+                            data=json.dumps({'ids': [1, 2], 'changes': {'active': False},
+                                             'batch_size': 1}),
+                            content_type='application/json')
+        self.assertEqual(json.loads(resp.data), {'matched': 2, 'updated': 2})
+        resp = self.app.get('/customers?active=false')
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_update_customers_in_bulk_bad_request(self):
+        """ Update Customers in bulk with bad requests """
+        for body in [{'filters': {'lastname': 'yang'}},
+                     {'filters': {'lastname': 'yang'}, 'changes': {'username': 'x'}},
+                     {'filters': {'lastname': 'yang'}, 'changes': 'promo'},
+                     {'changes': {'promo': True}},
+                     {'ids': 'all', 'changes': {'promo': True}},
+                     {'filters': {'phone': '123'}, 'changes': {'promo': True}},
+                     ['promo']]:
+            resp = self.app.put('/customers/bulk', data=json.dumps(body),
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_customer(self):
         """ Update an existing Customer """
         customer = Customer.find_by_username('jf')[0]
@@ -190,6 +577,26 @@ class TestCustomerServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['active'], False)
 
+    def test_patch_customer(self):
+        """ Update some fields of an existing Customer """
+        customer = Customer.find_by_username('jf')[0]
+        resp = self.app.patch('/customers/{}'.format(customer.id),
+                              data=json.dumps({'phone': '555-555-5555', 'promo': True}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['phone'], '555-555-5555')
+        self.assertEqual(new_json['promo'], True)
+        self.assertEqual(new_json['email'], customer.email)
+
+        resp = self.app.patch('/customers/{}'.format(customer.id),
+                              data=json.dumps({'promo': 'yes'}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch('/customers/0', data=json.dumps({'promo': True}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_subscribe_customer(self):
         """ Subscribe an existing Customer"""
         customer = Customer.find_by_username('jf')[0]
@@ -241,6 +648,28 @@ class TestCustomerServer(unittest.TestCase):
         new_count = self.get_customer_count()
         self.assertEqual(new_count, customer_count - 1)
 
+    def test_subscribe_missing_customer(self):
+        """ Subscribe and deactivate a Customer that does not exist """
+        resp = self.app.put('/customers/0/subscribe')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put('/customers/0/deactivate')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_your_writes(self):
+        """ Read from the primary right after a write """
+        resp = self.app.put('/customers/1/subscribe')
+        last_write = resp.headers['X-Last-Write']
+        self.assertIn('last_write=' + last_write, resp.headers['Set-Cookie'])
+        with patch.object(Customer, 'read_from_primary') as read_from_primary:
+            self.app.get('/customers/1', headers={'X-Last-Write': last_write})
+            read_from_primary.assert_called_with(True)
+            self.app.get('/customers/1', headers={'X-Last-Write': str(time.time() - 60)})
+            read_from_primary.assert_called_with(False)
+            self.app.get('/customers/1', headers={'X-Last-Write': 'soon'})
+            read_from_primary.assert_called_with(False)
+        resp = self.app.get('/customers/1')
+        self.assertNotIn('X-Last-Write', resp.headers)
+
     def test_not_found_error(self):
         """ Test showing exception handling 404 """
         rv = self.app.get('/4444')
@@ -0,0 +1,274 @@
+"""
+Test cases for the sharded Customer storage
+
+The shards are databases 1 to 3 of the local Redis by default. Set
+TEST_REDIS_SHARDS to comma separated redis:// URLs to run them against
+several redis-server processes instead.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import unittest
+from collections import Counter
+from redis import Redis
+from app.models import Customer
+from app.sharding import HashRing
+from app.custom_exceptions import DataValidationError
+
+SHARD_URLS = os.getenv('TEST_REDIS_SHARDS', 'redis://127.0.0.1:6379/1,'
+                       'redis://127.0.0.1:6379/2,redis://127.0.0.1:6379/3').split(',')
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestHashRing(unittest.TestCase):
+    """ Test Cases for the consistent hash ring """
+
+    def test_empty_ring(self):
+        """ Map a key on a ring without nodes """
+        ring = HashRing()
+        self.assertEqual(len(ring), 0)
+        self.assertIsNone(ring.get(1))
+
+    def test_keys_are_spread(self):
+        """ Spread keys evenly over the nodes """
+        ring = HashRing({'a': 1, 'b': 2, 'c': 3})
+        counts = Counter(ring.get(key) for key in range(3000))
+        self.assertEqual(sorted(counts), [1, 2, 3])
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300, counts)
+        self.assertEqual(ring.get(42), ring.get('42'))
+
+    def test_add_moves_keys_to_the_new_node_only(self):
+        """ Move only the keys the new node takes over """
+        ring = HashRing({'a': 'a', 'b': 'b', 'c': 'c'})
+        before = dict((key, ring.get(key)) for key in range(3000))
+        ring.add('d', 'd')
+        moved = [key for key in before if ring.get(key) != before[key]]
+        self.assertTrue(500 < len(moved) < 1000, len(moved))
+        self.assertTrue(all(ring.get(key) == 'd' for key in moved))
+
+    def test_remove_node(self):
+        """ Give the keys of a node back to the others """
+        ring = HashRing({'a': 'a', 'b': 'b'})
+        before = dict((key, ring.get(key)) for key in range(1000))
+        ring.add('c', 'c')
+        ring.remove('c')
+        ring.remove('unknown')
+        self.assertEqual(dict((key, ring.get(key)) for key in range(1000)), before)
+        self.assertEqual(sorted(ring.nodes), ['a', 'b'])
+
+
+class TestShardedCustomers(unittest.TestCase):
+    """ Test Cases for Customers spread over several Redis nodes """
+
+    def setUp(self):
+        """ Spread the Customers over the test shards """
+        Customer.configure(shard_urls=SHARD_URLS, engine='redis')
+        Customer.init_db()
+        Customer.remove_all()
+
+    def tearDown(self):
+        """ Go back to storing the Customers on the primary """
+        Customer.remove_all()
+        Customer.configure(shard_urls=[])
+        Customer.use_shards([])
+
+    def create(self, count, lastname='sue', promo=False):
+        """ Saves count Customers and returns them """
+        customers = []
+        for i in range(count):
+            customer = Customer(username='user{}'.format(i), password='secret',
+                                firstname='mary', lastname=lastname, address='nyu',
+                                phone='123-456-7890', email='user{}@nyu.edu'.format(i),
+                                active=True, promo=promo and i % 2 == 0)
+            customer.save()
+            customers.append(customer)
+        return customers
+
+    def records(self, node):
+        """ Returns the ids of the Customer records stored on a node """
+        return sorted(int(key.split(':')[1]) for key in node.scan_iter('customer:[0-9]*'))
+
+    def test_customers_are_spread_over_the_shards(self):
+        """ Store each Customer with its indexes on the shard of its id """
+        self.create(30)
+        self.assertEqual(len(Customer.router.shards), 3)
+        stored = []
+        for shard in Customer.router.shards:
+            customer_ids = self.records(shard)
+            self.assertTrue(customer_ids)
+            for customer_id in customer_ids:
+                self.assertIs(Customer.router.ring.get(customer_id), shard)
+            self.assertEqual(shard.zcard(Customer.engine.ids_key), len(customer_ids))
+            self.assertFalse(shard.exists('customer:username'))
+            stored += customer_ids
+        self.assertEqual(sorted(stored), range(1, 31))
+        # the primary only keeps the id counter and the unique indexes
+        self.assertEqual(self.records(Customer.redis), [])
+        self.assertEqual(Customer.redis.hlen('customer:username'), 30)
+        self.assertEqual(int(Customer.redis.get('customer:seq')), 30)
+
+    def test_find_and_query_across_shards(self):
+        """ Gather the Customers of every shard in id order """
+        self.create(25, promo=True)
+        self.assertEqual(Customer.find(7).username, 'user6')
+        self.assertIsNone(Customer.find(99))
+        self.assertEqual(sorted(customer.id for customer in Customer.all()), range(1, 26))
+        self.assertEqual(len(list(Customer.iter_all(batch_size=5))), 25)
+        customers, cursor = Customer.query(limit=10)
+        self.assertEqual([customer.id for customer in customers], range(1, 11))
+        self.assertEqual(cursor, 10)
+        customers, cursor = Customer.query(limit=10, cursor=20)
+        self.assertEqual([customer.id for customer in customers], range(21, 26))
+        self.assertIsNone(cursor)
+        customers, _ = Customer.query({'promo': True}, fields=['username'])
+        self.assertEqual([customer.id for customer in customers], range(1, 26, 2))
+        self.assertEqual(Customer.count(), 25)
+        self.assertEqual(Customer.count({'promo': True}), 13)
+        self.assertEqual(Customer.count({'username': 'user3'}), 1)
+        self.assertEqual(Customer.count({'username': 'user3', 'promo': True}), 0)
+        self.assertEqual(Customer.count_by_promo(False), 12)
+        self.assertEqual(Customer.find_by_email('USER4@nyu.edu')[0].id, 5)
+        self.assertEqual(len(Customer.find_by_lastname('sue')), 25)
+
+    def test_search_across_shards(self):
+        """ Search the prefix and trigram indexes of every shard """
+        self.create(12)
+        found = Customer.search_prefix('user1', limit=5)
+        self.assertEqual([customer.username for customer in found],
+                         ['user1', 'user10', 'user11'])
+        found = Customer.search('user7@nyu', limit=3)
+        self.assertEqual(found[0].username, 'user7')
+        self.assertEqual(len(found), 3)
+
+    def test_usernames_are_unique_across_shards(self):
+        """ Reject a username held by a Customer on another shard """
+        first, second = self.create(2)
+        self.assertIsNot(Customer.router.ring.get(first.id), Customer.router.ring.get(3))
+        duplicate = Customer(username='USER0', password='secret', firstname='joe',
+                             lastname='doe', address='nyu', phone='123-456-7890',
+                             email='joe@nyu.edu')
+        self.assertRaises(DataValidationError, duplicate.save)
+        self.assertEqual(duplicate.id, 0)
+        # the email it claimed is given back
+        self.assertFalse(Customer.redis.hexists('customer:email', 'joe@nyu.edu'))
+        # a renamed Customer gives its old username back
+        first.username = 'mary'
+        first.save()
+        duplicate.save()
+        self.assertEqual(Customer.find_by_username('user0')[0].id, duplicate.id)
+        self.assertEqual(Customer.find_by_username('mary')[0].id, first.id)
+        self.assertRaises(DataValidationError, Customer.update_fields,
+                          second.id, {'email': 'JOE@nyu.edu'})
+        self.assertEqual(Customer.find(second.id).email, 'user1@nyu.edu')
+
+    def test_writes_on_shards(self):
+        """ Update and delete Customers on their shards """
+        customers = self.create(10)
+        generation = Customer.generation()
+        customer = Customer.update_fields(4, {'lastname': 'smith', 'email': 'new@nyu.edu'})
+        self.assertEqual(customer.email, 'new@nyu.edu')
+        self.assertIsNone(Customer.update_fields(99, {'lastname': 'smith'}))
+        self.assertGreater(Customer.generation(), generation)
+        self.assertEqual(Customer.find_by_email('user3@nyu.edu'), [])
+        self.assertEqual(Customer.count({'lastname': 'smith'}), 1)
+        self.assertTrue(Customer.set_flag(5, 'promo', True).promo)
+        self.assertEqual(Customer.update_where({'active': False}, {'promo': False}), (9, 9))
+        self.assertEqual(Customer.count({'active': False}), 9)
+        version = Customer.router.ring.get(4).hget(Customer.engine.versions_key, 4)
+        self.assertEqual(Customer.version(4), int(version))
+        self.assertTrue(Customer.remove(4))
+        self.assertFalse(Customer.remove(4))
+        self.assertFalse(Customer.redis.hexists('customer:email', 'new@nyu.edu'))
+        customers[0].delete()
+        self.assertEqual(Customer.count(), 8)
+
+    def test_create_many_on_shards(self):
+        """ Save a batch of Customers on their shards """
+        customers = [Customer(username='user{}'.format(i % 5), password='secret',
+                              firstname='mary', lastname='sue', address='nyu',
+                              phone='123-456-7890', email='user{}@nyu.edu'.format(i))
+                     for i in range(8)]
+        errors = Customer.create_many(customers)
+        self.assertEqual(errors.count(None), 5)
+        self.assertEqual(sorted(customer.id for customer in Customer.all()), range(1, 6))
+        for shard in Customer.router.shards:
+            for customer_id in self.records(shard):
+                self.assertIs(Customer.router.ring.get(customer_id), shard)
+        self.assertEqual(Customer.redis.hlen('customer:email'), 5)
+
+    def test_rebalance_after_adding_a_shard(self):
+        """ Move only the Customers whose shard changed when a node is added """
+        Customer.use_shards(Customer.router.shards[:2])
+        self.create(60, lastname='smith')
+        Customer.use_shards([Customer.connect_to_shard(url) for url in SHARD_URLS])
+        new_shard = Customer.router.shards[2]
+        strays = [customer_id for customer_id in range(1, 61)
+                  if Customer.router.ring.get(customer_id) is new_shard]
+        self.assertTrue(0 < len(strays) < 40)
+        # they can still be read from the node they are on
+        self.assertEqual(Customer.find(strays[0]).id, strays[0])
+        self.assertEqual(len(Customer.all()), 60)
+        self.assertEqual(Customer.count({'lastname': 'smith'}), 60)
+        # and written, which puts them on their shard
+        Customer.set_flag(strays[0], 'promo', True)
+        self.assertEqual(Customer.update_fields(strays[0], {'phone': '555'}).phone, '555')
+        self.assertEqual(len(Customer.all()), 60)
+
+        self.assertEqual(Customer.rebalance(), len(strays))
+        self.assertEqual(self.records(new_shard), strays)
+        for shard in Customer.router.shards:
+            self.assertEqual(shard.zcard(Customer.engine.ids_key), len(self.records(shard)))
+        self.assertTrue(Customer.find(strays[0]).promo)
+        self.assertEqual(Customer.find(strays[0]).phone, '555')
+        self.assertEqual(Customer.count({'lastname': 'smith'}), 60)
+        self.assertEqual(len(Customer.find_by_lastname('smith')), 60)
+        self.assertEqual(Customer.count(), 60)
+        self.assertEqual(Customer.rebalance(), 0)
+
+    def test_reindex_on_shards(self):
+        """ Rebuild the indexes of every shard and the unique indexes on the primary """
+        self.create(12)
+        Customer.redis.delete('customer:username')
+        Customer.redis.hset('customer:email', 'gone@nyu.edu', 3)
+        shard = Customer.router.ring.get(5)
+        shard.delete('customer:lastname:sue')
+        shard.zadd('customer:lastname:ghost', {5: 5})
+        self.assertEqual(Customer.reindex(), 12)
+        self.assertEqual(Customer.redis.hlen('customer:username'), 12)
+        self.assertIsNone(Customer.redis.hget('customer:email', 'gone@nyu.edu'))
+        self.assertFalse(shard.exists('customer:lastname:ghost'))
+        self.assertEqual(len(Customer.find_by_lastname('sue')), 12)
+        self.assertEqual(Customer.find_by_username('user4')[0].id, 5)
+
+    def test_rebalance_from_the_primary(self):
+        """ Spread Customers that were all stored on the primary """
+        Customer.use_shards([])
+        self.create(10)
+        Customer.use_shards([Customer.connect_to_shard(url) for url in SHARD_URLS])
+        self.assertEqual(Customer.rebalance(batch_size=3), 10)
+        self.assertEqual(self.records(Customer.redis), [])
+        self.assertFalse(Customer.redis.exists(Customer.engine.ids_key))
+        self.assertEqual(Customer.find_by_username('user3')[0].id, 4)
+        self.assertEqual(Customer.count(), 10)
+
+    def test_primary_as_a_shard(self):
+        """ Use the same connection for the primary and a shard """
+        Customer.use_shards([Redis(host='127.0.0.1', port=6379), Redis(db=1)])
+        self.assertIs(Customer.router.shards[0], Customer.redis)
+        self.create(10)
+        self.assertEqual(Customer.count(), 10)
+        self.assertEqual(Customer.redis.hlen('customer:username'), 10)
+
+    def test_no_shards(self):
+        """ Keep the Customers on the primary without shards """
+        Customer.use_shards([])
+        self.assertIsNone(Customer.router.ring)
+        self.assertEqual(Customer.rebalance(), 0)
+        self.create(2)
+        self.assertEqual(self.records(Customer.redis), [1, 2])
@@ -0,0 +1,158 @@
+"""
+Test cases for the storage engines
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from app.storage import MemoryEngine
+from app.custom_exceptions import DuplicateValueError
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMemoryEngine(unittest.TestCase):
+    """ Test Cases for the in process storage engine """
+
+    def setUp(self):
+        """ Index usernames, names, flags and username prefixes """
+        self.engine = MemoryEngine(unique=('username',), sets=('lastname', 'promo'),
+                                   prefixes=('username',),
+                                   normalize=lambda value: str(value).lower(),
+                                   ngrams=lambda data: set([data['username'][:3].lower()])
+                                   if data else set())
+
+    def put(self, record_id, username, lastname='sue', promo=False):
+        """ Stores a record and returns its data """
+        data = {'id': record_id, 'username': username, 'lastname': lastname, 'promo': promo}
+        self.engine.put(record_id, data)
+        return data
+
+    def test_put_and_get(self):
+        """ Store records and read them back """
+        self.assertEqual(self.engine.next_id(2), 2)
+        self.assertEqual(self.engine.next_id(), 3)
+        data = self.put(1, 'mary')
+        self.put(2, 'joe')
+        self.assertEqual(len(self.engine), 2)
+        self.assertEqual(self.engine.get([1, '2', 3], ['username']),
+                         [{'username': 'mary'}, {'username': 'joe'}, None])
+        # the stored data is a copy
+        data['username'] = 'changed'
+        self.assertEqual(self.engine.get([1])[0]['username'], 'mary')
+        self.assertEqual(self.engine.version(1), 1)
+        self.assertEqual(self.engine.generation(), 2)
+
+    def test_unique_values(self):
+        """ Reject a unique value held by another record """
+        self.put(1, 'mary')
+        with self.assertRaises(DuplicateValueError) as context:
+            self.put(2, 'MARY')
+        self.assertEqual(context.exception.duplicates, [(2, 'username', 'MARY', 1)])
+        self.assertEqual(self.engine.get([2]), [None])
+        # a record can keep its own value and give it up
+        self.put(1, 'mary', lastname='smith')
+        self.engine.update(1, {'username': 'joe'})
+        self.put(2, 'mary')
+        self.assertEqual(self.engine.match({'username': 'Mary'}), [2])
+        self.assertRaises(DuplicateValueError, self.engine.update, 2, {'username': 'joe'})
+
+    def test_match(self):
+        """ Match records through the unique and set indexes """
+        self.put(1, 'mary', promo=True)
+        self.put(2, 'joe')
+        self.put(3, 'jane', lastname='doe', promo=True)
+        self.assertEqual(self.engine.match({'lastname': 'sue'}), [1, 2])
+        self.assertEqual(self.engine.match({'promo': True, 'lastname': 'SUE'}), [1])
+        self.assertEqual(self.engine.match({'username': 'jane', 'promo': True}), [3])
+        self.assertEqual(self.engine.match({'username': 'jane', 'lastname': 'sue'}), [])
+        self.assertEqual(self.engine.match({'username': 'nobody'}), [])
+        self.assertEqual(self.engine.match({'lastname': 'smith'}), [])
+        self.assertEqual(self.engine.match({}), [1, 2, 3])
+        self.assertEqual(self.engine.match({'lastname': 'sue'}, cursor=1, limit=1), [2])
+        self.assertEqual(self.engine.count(), 3)
+        self.assertEqual(self.engine.count({'promo': False}), 1)
+
+    def test_update(self):
+        """ Move the index entries of the changed fields """
+        self.put(1, 'mary')
+        version = self.engine.version(1)
+        old_data, new_data = self.engine.update(1, {'lastname': 'smith'})
+        self.assertEqual((old_data['lastname'], new_data['lastname']), ('sue', 'smith'))
+        self.assertEqual(self.engine.match({'lastname': 'sue'}), [])
+        self.assertEqual(self.engine.match({'lastname': 'smith'}), [1])
+        self.assertGreater(self.engine.version(1), version)
+        # a change that changes nothing is not written unless forced
+        version = self.engine.version(1)
+        self.engine.update(1, {'lastname': 'smith'}, force=False)
+        self.assertEqual(self.engine.version(1), version)
+        self.assertEqual(self.engine.update(9, {'lastname': 'doe'}), (None, None))
+
+    def test_insert_and_update_many(self):
+        """ Write batches of records, refusing the ones with a taken unique value """
+        self.put(1, 'mary')
+        errors = self.engine.insert_many([(2, {'id': 2, 'username': 'joe', 'lastname': 'sue',
+                                               'promo': False}),
+                                          (3, {'id': 3, 'username': 'Mary', 'lastname': 'doe',
+                                               'promo': False})])
+        self.assertIsNone(errors[0])
+        self.assertEqual(errors[1].duplicates, [(3, 'username', 'Mary', 1)])
+        self.assertEqual(self.engine.ids(), [1, 2])
+        self.put(3, 'jane', promo=True)
+        self.assertEqual(self.engine.update_many([1, 3, 9], {'promo': True}), (2, 1))
+        self.assertEqual(self.engine.match({'promo': True}), [1, 3])
+
+    def test_delete_and_clear(self):
+        """ Delete records with their index entries """
+        self.put(1, 'mary')
+        self.put(2, 'joe')
+        self.assertTrue(self.engine.delete(1))
+        self.assertFalse(self.engine.delete(1))
+        self.assertIsNone(self.engine.version(1))
+        self.assertEqual(self.engine.match({'lastname': 'sue'}), [2])
+        self.assertEqual(self.engine.prefix('username', 'm'), [])
+        self.assertEqual(self.engine.trigram(['mar']), {})
+        self.put(3, 'mary')
+        self.engine.next_id(3)
+        generation = self.engine.generation()
+        self.engine.clear()
+        self.assertEqual(len(self.engine), 0)
+        self.assertEqual(self.engine.match({'username': 'mary'}), [])
+        self.assertEqual(self.engine.next_id(), 1)
+        self.assertGreater(self.engine.generation(), generation)
+
+    def test_ids_and_scan(self):
+        """ Page through the ids in order and scan the records in batches """
+        for record_id in (5, 1, 3, 2, 4):
+            self.put(record_id, 'user{}'.format(record_id))
+        self.assertEqual(self.engine.ids(), [1, 2, 3, 4, 5])
+        self.assertEqual(self.engine.ids(cursor=2, limit=2), [3, 4])
+        self.assertEqual(self.engine.ids(cursor=5), [])
+        scanned = list(self.engine.scan(batch_size=2, fields=['id']))
+        self.assertEqual(scanned, [{'id': record_id} for record_id in range(1, 6)])
+
+    def test_prefix_and_trigrams(self):
+        """ Look up records by the prefix of a value and by trigram """
+        self.put(1, 'mary')
+        self.put(2, 'Marc')
+        self.put(3, 'joe')
+        self.put(4, 'mark')
+        self.assertEqual(self.engine.prefix('username', 'MAR'),
+                         [('marc', 2), ('mark', 4), ('mary', 1)])
+        self.assertEqual(self.engine.prefix('username', 'mar', limit=1), [('marc', 2)])
+        self.assertEqual(self.engine.prefix('username', 'x'), [])
+        self.assertEqual(self.engine.trigram(['Mar']), {})
+        self.assertEqual(self.engine.trigram(['mar', 'joe']), {1: 1, 2: 1, 3: 1, 4: 1})
+
+    def test_reindex(self):
+        """ Rebuild the indexes and keep the versions """
+        self.put(1, 'mary')
+        self.put(2, 'joe', promo=True)
+        version = self.engine.version(2)
+        self.assertEqual(self.engine.reindex(), 2)
+        self.assertEqual(self.engine.match({'promo': True}), [2])
+        self.assertEqual(self.engine.prefix('username', 'jo'), [('joe', 2)])
+        self.assertEqual(self.engine.version(2), version)